@@ -0,0 +1,689 @@
+#!/usr/bin/env python3
+# Yet Another Video Download Tool: Download information from youtube
+# Copyright (C) 2026  Sebastian Hagen
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Caching HTTP proxy, for sharing fetched metadata between hosts and runs
+
+import collections
+import hashlib
+import http.server
+import json
+import logging
+import os
+import os.path
+import re
+import socketserver
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Headers that only apply to a single connection, or which we compute ourselves when serving stored responses.
+_HEADERS_HOP = frozenset(('connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'proxy-connection', 'te',
+   'trailers', 'transfer-encoding', 'upgrade'))
+_HEADERS_NOSTORE = _HEADERS_HOP | frozenset(('content-length', 'content-range', 'accept-ranges', 'set-cookie', 'date'))
+_HEADERS_NOFWD = _HEADERS_HOP | frozenset(('host', 'range', 'if-none-match', 'if-modified-since', 'if-range',
+   'if-match', 'if-unmodified-since'))
+# Request headers that select between different responses for the same url often enough to make them part of the key.
+_HEADERS_KEY = ('cookie', 'authorization')
+# Url schemes we fetch; anything else would let clients read local files, or reach other services through us.
+_URL_SCHEMES = ('http', 'https')
+
+
+def _build_url_opener():
+   """Return url opener for http and https urls only; urllib's default one handles file, ftp and data urls, too."""
+   proxies = dict((scheme, url) for (scheme, url) in urllib.request.getproxies().items() if (scheme in _URL_SCHEMES))
+   od = urllib.request.OpenerDirector()
+   for cls in (urllib.request.UnknownHandler, urllib.request.HTTPHandler, urllib.request.HTTPSHandler,
+         urllib.request.HTTPDefaultErrorHandler, urllib.request.HTTPRedirectHandler, urllib.request.HTTPErrorProcessor):
+      od.add_handler(cls())
+   od.add_handler(urllib.request.ProxyHandler(proxies))
+   return od
+
+
+def _get_header(headers, name):
+   """Return value of header name from sequence of (name, value) tuples, or None if it's not there."""
+   name = name.lower()
+   for (key, val) in headers:
+      if (key.lower() == name):
+         return val
+   return None
+
+
+class HTTPCacheEntry(collections.namedtuple('_HTTPCacheEntry', 'url headers size ts_validated vary')):
+   """Metadata of a stored response: url, list of (name, value) header tuples, body size, last validation time and list
+   of (name, value) tuples of the request headers named in the response's Vary header."""
+   def get_header(self, name):
+      return _get_header(self.headers, name)
+
+   def has_validator(self):
+      return not ((self.get_header('ETag') is None) and (self.get_header('Last-Modified') is None))
+
+   def matches(self, headers):
+      """Return whether this response is valid for a request with the specified headers."""
+      return all((_get_header(headers, name) == val) for (name, val) in self.vary)
+
+
+class _HTTPCacheTee:
+   """Pass-through reader for an upstream response, which stores the body as it's read.
+
+   This doesn't hold the key lock of its request while the body is passed on, so a slow client only holds up itself; the
+   lock is only taken to store the body once it's complete. If the body turns out to be larger than the cache's
+   entry_size_max, or isn't read to its end, it's passed through without being stored."""
+   def __init__(self, cache, key, url, res, vary):
+      self.cache = cache
+      self.key = key
+      self.url = url
+      self.res = res
+      self.vary = vary
+      self.headers = res.headers
+      self.size = 0
+      fn = cache._get_fn(key)
+      os.makedirs(os.path.dirname(fn), exist_ok=True)
+      self.fn_tmp = '{0}.{1}.{2}.tmp'.format(fn, os.getpid(), threading.get_ident())
+      self.f = open(self.fn_tmp, 'wb')
+
+   def getcode(self):
+      return self.res.getcode()
+
+   def _abort(self):
+      if (self.f is None):
+         return
+      self.f.close()
+      self.f = None
+      os.unlink(self.fn_tmp)
+
+   def read(self, size=-1):
+      return self._feed(self.res.read(size))
+
+   def read1(self, size=-1):
+      return self._feed(self.res.read1(size))
+
+   def _feed(self, data):
+      if (self.f is None):
+         return data
+      try:
+         if not (data):
+            self.f.close()
+            self.f = None
+            self.cache._lock_key(self.key)
+            try:
+               self.cache._commit(self.key, self.url, self.res, self.vary, self.fn_tmp, self.size)
+            finally:
+               self.cache._unlock_key(self.key)
+            return data
+
+         self.size += len(data)
+         if (self.size > self.cache.entry_size_max):
+            self.cache.log(15, 'Response for {0!a} exceeds entry size limit; not storing it.'.format(self.url))
+            self._abort()
+         else:
+            self.f.write(data)
+      except BaseException:
+         self._abort()
+         raise
+      return data
+
+   def close(self):
+      try:
+         self._abort()
+      finally:
+         self.res.close()
+
+
+class HTTPCache:
+   """Disk store for HTTP responses, with validator-based revalidation and LRU eviction.
+
+   Each entry is stored as a body file and a JSON metadata file, below a subdirectory named for the first two digits of
+   the entry key (the sha256 of its url). Entries are validated upstream (using ETag and Last-Modified, where available)
+   once they're older than fresh_time seconds, and the least recently used ones are evicted once the stored bodies take
+   up more than size_max bytes. Responses larger than entry_size_max bytes aren't stored.
+   Request cookies and credentials are part of the key, too. For other request headers named in a response's Vary
+   header, the stored response only serves requests that match the one it was fetched with; the others go upstream.
+
+   Lookup and validation of concurrent requests for the same key are serialized, so only one of them revalidates a
+   stored response, and the others are served from its result. Bodies are passed through without holding the key,
+   though; requests arriving while one is still being fetched go upstream themselves."""
+   logger = logging.getLogger('HTTPCache')
+   log = logger.log
+
+   def __init__(self, path, size_max, entry_size_max=None, fresh_time=300, url_opener=None):
+      self.path = path
+      self.size_max = size_max
+      if (entry_size_max is None):
+         entry_size_max = size_max // 8
+      self.entry_size_max = entry_size_max
+      self.fresh_time = fresh_time
+      if (url_opener is None):
+         url_opener = _build_url_opener()
+      self.url_opener = url_opener
+      self._lock = threading.Lock()
+      self._key_locks = {}
+      # key -> body size, least recently used first
+      self._index = collections.OrderedDict()
+      self._size = 0
+      self._load_index()
+
+   @staticmethod
+   def get_key(url, headers=()):
+      data = url
+      for name in _HEADERS_KEY:
+         val = _get_header(headers, name)
+         if not (val is None):
+            data += '\n{0}: {1}'.format(name, val)
+      return hashlib.sha256(data.encode('utf-8', 'surrogateescape')).hexdigest()
+
+   def _get_fn(self, key, ext=''):
+      return os.path.join(self.path, key[:2], key + ext)
+
+   def _load_index(self):
+      entries = []
+      os.makedirs(self.path, exist_ok=True)
+      for (dirpath, dirnames, filenames) in os.walk(self.path):
+         for fn in filenames:
+            if not (fn.endswith('.meta')):
+               continue
+            fn_meta = os.path.join(dirpath, fn)
+            fn_body = fn_meta[:-5]
+            try:
+               entries.append((os.path.getmtime(fn_meta), fn[:-5], os.path.getsize(fn_body)))
+            except OSError:
+               self.log(30, 'Discarding stored response {0!a} without body.'.format(fn_meta))
+               os.unlink(fn_meta)
+
+      entries.sort()
+      for (ts, key, size) in entries:
+         self._index[key] = size
+         self._size += size
+      self.log(20, 'Loaded {0} stored responses ({1} bytes).'.format(len(self._index), self._size))
+
+   def _lock_key(self, key):
+      with self._lock:
+         try:
+            kl = self._key_locks[key]
+         except KeyError:
+            kl = self._key_locks[key] = [threading.Lock(), 0]
+         kl[1] += 1
+      kl[0].acquire()
+
+   def _unlock_key(self, key):
+      with self._lock:
+         kl = self._key_locks[key]
+         kl[0].release()
+         kl[1] -= 1
+         if (kl[1] == 0):
+            del(self._key_locks[key])
+
+   def _read_entry(self, key):
+      """Return (HTTPCacheEntry, body file) for specified key, or None if we don't have it."""
+      try:
+         f = open(self._get_fn(key, '.meta'), 'rb')
+      except IOError:
+         return None
+      try:
+         data = json.loads(f.read().decode('utf-8'))
+      finally:
+         f.close()
+
+      entry = HTTPCacheEntry(data['url'], [tuple(h) for h in data['headers']], data['size'], data['ts_validated'],
+         [tuple(h) for h in data.get('vary', ())])
+      try:
+         f_body = open(self._get_fn(key), 'rb')
+      except IOError:
+         return None
+      return (entry, f_body)
+
+   def _write_meta(self, key, entry):
+      fn = self._get_fn(key, '.meta')
+      fn_tmp = '{0}.{1}.{2}.tmp'.format(fn, os.getpid(), threading.get_ident())
+      f = open(fn_tmp, 'wb')
+      try:
+         f.write(json.dumps(entry._asdict()).encode('utf-8'))
+      finally:
+         f.close()
+      os.replace(fn_tmp, fn)
+
+   def _touch(self, key):
+      with self._lock:
+         if (key in self._index):
+            self._index.move_to_end(key)
+      try:
+         os.utime(self._get_fn(key, '.meta'))
+      except OSError:
+         pass
+
+   def _evict(self):
+      """Drop least recently used entries until we're within our size limit; call with self._lock held."""
+      while ((self._size > self.size_max) and self._index):
+         (key, size) = self._index.popitem(last=False)
+         self._size -= size
+         self.log(15, 'Evicting stored response {0}.'.format(key))
+         for ext in ('.meta', ''):
+            try:
+               os.unlink(self._get_fn(key, ext))
+            except OSError:
+               pass
+
+   def _commit(self, key, url, res, vary, fn_tmp, size):
+      """Store headers of urllib response res, and the body we've written to fn_tmp for it."""
+      headers = [(name, val) for (name, val) in res.getheaders() if not (name.lower() in _HEADERS_NOSTORE)]
+      entry = HTTPCacheEntry(url, headers, size, time.time(), vary)
+      try:
+         os.replace(fn_tmp, self._get_fn(key))
+      except BaseException:
+         os.unlink(fn_tmp)
+         raise
+
+      self._write_meta(key, entry)
+      with self._lock:
+         self._size -= self._index.pop(key, 0)
+         self._index[key] = size
+         self._size += size
+         self._evict()
+
+   @staticmethod
+   def _get_vary(res, headers):
+      """Return list of (name, value) tuples of the request headers res varies on, or None if it varies on everything."""
+      names = [name.strip().lower() for name in (res.getheader('Vary') or '').split(',')]
+      if ('*' in names):
+         return None
+      return [(name, _get_header(headers, name)) for name in names if (name and not (name in _HEADERS_KEY))]
+
+   @staticmethod
+   def _is_storable(res):
+      if (res.getcode() != 200):
+         return False
+      cc = (res.getheader('Cache-Control') or '').lower()
+      if (('no-store' in cc) or ('private' in cc)):
+         return False
+      return True
+
+   def get(self, url, headers, range_spec=None, method='GET'):
+      """Retrieve url, sending the specified request headers upstream where needed.
+
+      Returns ('stored', HTTPCacheEntry, body file) if the response can be served from our store, or ('direct', response,
+      None) with a response (or HTTPError) object to pass through otherwise; storable responses are stored as their body
+      is read from that object, so it needs to be closed once the caller is done with it. If a range_spec is given,
+      responses we don't have yet are requested with that Range header and passed through instead of being stored; the
+      same goes for responses to HEAD requests. Raises ValueError for urls with schemes other than http and https."""
+      if not (urllib.parse.urlsplit(url).scheme.lower() in _URL_SCHEMES):
+         raise ValueError('Unsupported url scheme in {0!a}.'.format(url))
+      headers_req = list(headers.items())
+      key = self.get_key(url, headers_req)
+      self._lock_key(key)
+      try:
+         stored = self._read_entry(key)
+         if not ((stored is None) or stored[0].matches(headers_req)):
+            self.log(15, 'Stored response for {0!a} is for different request headers; ignoring it.'.format(url))
+            stored[1].close()
+            stored = None
+
+         if not (stored is None):
+            (entry, f_body) = stored
+            if (time.time() - entry.ts_validated < self.fresh_time):
+               self._touch(key)
+               return ('stored', entry, f_body)
+
+            headers = dict(headers)
+            etag = entry.get_header('ETag')
+            if not (etag is None):
+               headers['If-None-Match'] = etag
+            lm = entry.get_header('Last-Modified')
+            if not (lm is None):
+               headers['If-Modified-Since'] = lm
+         elif not (range_spec is None):
+            headers = dict(headers)
+            headers['Range'] = range_spec
+
+         req = urllib.request.Request(url, headers=headers, method=method)
+         try:
+            res = self.url_opener.open(req)
+         except urllib.error.HTTPError as exc:
+            if ((exc.code == 304) and not (stored is None)):
+               exc.close()
+               self.log(15, 'Revalidated stored response for {0!a}.'.format(url))
+               entry = entry._replace(ts_validated=time.time())
+               self._write_meta(key, entry)
+               self._touch(key)
+               return ('stored', entry, f_body)
+            if not (stored is None):
+               f_body.close()
+            return ('direct', exc, None)
+
+         if (stored is None):
+            if not (range_spec is None):
+               return ('direct', res, None)
+         else:
+            f_body.close()
+         if (method == 'HEAD'):
+            return ('direct', res, None)
+
+         length = res.getheader('Content-Length')
+         vary = self._get_vary(res, headers_req)
+         if ((vary is None) or (not self._is_storable(res)) or
+               ((not (length is None)) and (int(length) > self.entry_size_max))):
+            return ('direct', res, None)
+
+         self.log(15, 'Storing response for {0!a}.'.format(url))
+         try:
+            tee = _HTTPCacheTee(self, key, url, res, vary)
+         except BaseException:
+            res.close()
+            raise
+         return ('direct', tee, None)
+      finally:
+         self._unlock_key(key)
+
+
+class HTTPCacheRequestHandler(http.server.BaseHTTPRequestHandler):
+   """Request handler for HTTPCacheServer.
+
+   Requests can be sent either proxy-style (with absolute urls on the request line; this works for http urls only), or
+   as '/get?url=<urlencoded target url>' requests, which is what url manglers need."""
+   logger = logging.getLogger('HTTPCacheRequestHandler')
+   log = logger.log
+
+   re_range = re.compile(r'^bytes=(?P<first>[0-9]*)-(?P<last>[0-9]*)$')
+
+   def log_message(self, fmt, *args):
+      self.log(15, '{0}: {1}'.format(self.address_string(), fmt % args))
+
+   def _get_target_url(self):
+      if (self.path.startswith(('http://', 'https://'))):
+         return self.path
+      (path, sep, query) = self.path.partition('?')
+      if (path == '/get'):
+         try:
+            return urllib.parse.parse_qs(query)['url'][0]
+         except KeyError:
+            pass
+      return None
+
+   def _parse_range(self, size):
+      """Return (first, last) byte offsets requested by the client's Range header, None to send the full body, or False
+      if the range can't be satisfied."""
+      spec = self.headers.get('Range')
+      if (spec is None):
+         return None
+      m = self.re_range.match(spec.strip())
+      if (m is None):
+         # Multiple or malformed ranges; we're allowed to ignore those.
+         return None
+      (first, last) = m.group('first', 'last')
+      if (first == ''):
+         if (last == ''):
+            return None
+         first = max(size - int(last), 0)
+         last = size - 1
+      else:
+         first = int(first)
+         if (last == ''):
+            last = size - 1
+         else:
+            last = min(int(last), size - 1)
+      if ((first > last) or (first >= size)):
+         return False
+      return (first, last)
+
+   def _send_body(self, f, size):
+      while (size > 0):
+         data = f.read(min(size, 1024*1024))
+         if not (data):
+            break
+         self.wfile.write(data)
+         size -= len(data)
+
+   def _serve_stored(self, entry, f_body, head):
+      rng = self._parse_range(entry.size)
+      if (rng is False):
+         self.send_response(416)
+         self.send_header('Content-Range', 'bytes */{0}'.format(entry.size))
+         self.send_header('Content-Length', '0')
+         self.end_headers()
+         return
+
+      if (rng is None):
+         (first, last) = (0, entry.size - 1)
+         self.send_response(200)
+      else:
+         (first, last) = rng
+         self.send_response(206)
+         self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(first, last, entry.size))
+
+      for (name, val) in entry.headers:
+         self.send_header(name, val)
+      self.send_header('Accept-Ranges', 'bytes')
+      self.send_header('Content-Length', str(last - first + 1))
+      self.end_headers()
+      if not (head):
+         f_body.seek(first)
+         self._send_body(f_body, last - first + 1)
+
+   def _serve_direct(self, res, head):
+      self.send_response(res.getcode())
+      for (name, val) in res.headers.items():
+         if not (name.lower() in _HEADERS_HOP):
+            self.send_header(name, val)
+      self.end_headers()
+      if (head):
+         return
+      # Pass data on as it arrives, rather than waiting for entire blocks.
+      read = getattr(res, 'read1', res.read)
+      while (True):
+         data = read(1024*1024)
+         if not (data):
+            break
+         self.wfile.write(data)
+
+   def _handle(self, head):
+      url = self._get_target_url()
+      if (url is None):
+         self.send_error(400, 'No target url in request.')
+         return
+      if not (urllib.parse.urlsplit(url).scheme.lower() in _URL_SCHEMES):
+         self.send_error(400, 'Unsupported target url scheme.')
+         return
+
+      headers = {}
+      for (name, val) in self.headers.items():
+         if not (name.lower() in _HEADERS_NOFWD):
+            headers[name] = val
+
+      try:
+         (src, obj, f_body) = self.server.cache.get(url, headers, self.headers.get('Range'), self.command)
+      except (urllib.error.URLError, OSError) as exc:
+         self.log(30, 'Failed to retrieve {0!a}: {1!a}'.format(url, exc))
+         self.send_error(502, 'Upstream request failed.')
+         return
+
+      if (src == 'stored'):
+         try:
+            self._serve_stored(obj, f_body, head)
+         finally:
+            f_body.close()
+         return
+
+      try:
+         self._serve_direct(obj, head)
+      finally:
+         obj.close()
+
+   def do_GET(self):
+      self._handle(False)
+
+   def do_HEAD(self):
+      self._handle(True)
+
+
+class HTTPCacheServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+   daemon_threads = True
+
+   def __init__(self, addr, cache):
+      http.server.HTTPServer.__init__(self, addr, HTTPCacheRequestHandler)
+      self.cache = cache
+
+
+def _parse_size(s):
+   mult = 1
+   if (s[-1:] in ('k', 'M', 'G')):
+      mult = 1024**('kMG'.index(s[-1]) + 1)
+      s = s[:-1]
+   return int(s) * mult
+
+def _selftest():
+   """Run module selftests against a local upstream server."""
+   import http.client
+   import shutil
+   import tempfile
+
+   # Large enough not to fit into socket buffers.
+   size_big = 32*1024*1024
+   methods = []
+
+   class UpstreamHandler(http.server.BaseHTTPRequestHandler):
+      def log_message(self, fmt, *args):
+         pass
+
+      def _get_body(self):
+         if (self.path == '/big'):
+            return b'x' * size_big
+         return self.path.encode('ascii')
+
+      def do_GET(self):
+         methods.append(self.command)
+         body = self._get_body()
+         self.send_response(200)
+         self.send_header('Content-Length', str(len(body)))
+         self.end_headers()
+         self.wfile.write(body)
+
+      def do_HEAD(self):
+         methods.append(self.command)
+         self.send_response(200)
+         self.send_header('Content-Length', str(len(self._get_body())))
+         self.end_headers()
+
+   path = tempfile.mkdtemp()
+   upstream = http.server.ThreadingHTTPServer(('127.0.0.1', 0), UpstreamHandler)
+   server = HTTPCacheServer(('127.0.0.1', 0), HTTPCache(path, size_big * 8))
+   for s in (upstream, server):
+      threading.Thread(target=s.serve_forever, daemon=True).start()
+
+   def request(target, method='GET'):
+      conn = http.client.HTTPConnection(*server.server_address, timeout=10)
+      conn.request(method, '/get?' + urllib.parse.urlencode({'url': target}))
+      return (conn, conn.getresponse())
+
+   def fetch(target, method='GET'):
+      (conn, res) = request(target, method)
+      rv = (res.status, res.read())
+      conn.close()
+      return rv
+
+   try:
+      url_upstream = 'http://{0}:{1}/selftest'.format(*upstream.server_address)
+      for i in range(2):
+         rv = fetch(url_upstream)
+         if (rv != (200, b'/selftest')):
+            raise Exception('Failed passthrough testcase (round {0}): got {1}.'.format(i, rv))
+      if (server.cache._size != len(b'/selftest')):
+         raise Exception('Failed storage testcase: stored {0} bytes.'.format(server.cache._size))
+
+      url_big = 'http://{0}:{1}/big'.format(*upstream.server_address)
+      del(methods[:])
+      rv = fetch(url_big, 'HEAD')
+      if ((rv != (200, b'')) or (methods != ['HEAD']) or (server.cache._size != len(b'/selftest'))):
+         raise Exception('Failed HEAD testcase: got {0}, upstream requests {1}.'.format(rv, methods))
+
+      # A client that doesn't read its response mustn't hold up others requesting the same url.
+      (conn_slow, res_slow) = request(url_big)
+      try:
+         rv = fetch(url_big)
+      except OSError as exc:
+         raise Exception('Failed concurrent request testcase: {0!a}'.format(exc)) from exc
+      if (rv != (200, b'x' * size_big)):
+         raise Exception('Failed concurrent request testcase: got {0} byte body.'.format(len(rv[1])))
+      if (res_slow.read() != b'x' * size_big):
+         raise Exception('Failed concurrent request testcase: bad body for slow client.')
+      conn_slow.close()
+      if (server.cache._size != size_big + len(b'/selftest')):
+         raise Exception('Failed concurrent storage testcase: stored {0} bytes.'.format(server.cache._size))
+
+      fn = os.path.join(path, 'local')
+      with open(fn, 'wb') as f:
+         f.write(b'secret')
+      for url in ('file://' + fn, 'FILE://' + fn, 'ftp://127.0.0.1/', 'data:,secret'):
+         (status, body) = fetch(url)
+         if ((status != 400) or (b'secret' in body)):
+            raise Exception('Failed scheme rejection testcase for {0!a}: got {1}.'.format(url, (status, body)))
+         try:
+            server.cache.get(url, {})
+         except ValueError:
+            pass
+         else:
+            raise Exception('Failed scheme rejection testcase for {0!a}: HTTPCache.get() accepted it.'.format(url))
+         try:
+            server.cache.url_opener.open(url)
+         except urllib.error.URLError:
+            pass
+         else:
+            raise Exception('Failed url opener testcase for {0!a}.'.format(url))
+   finally:
+      for s in (server, upstream):
+         s.shutdown()
+         s.server_close()
+      shutil.rmtree(path)
+   print('All selftests passed.')
+
+def main():
+   import optparse
+
+   op = optparse.OptionParser(usage='%prog [options]')
+   oa = op.add_option
+   oa('-l', '--listen', dest='listen', default='127.0.0.1:8123', metavar='ADDR:PORT', help='Address to listen on.')
+   oa('-d', '--dir', dest='path', default='~/.yavdlt/httpcache', metavar='PATH', help='Directory to store responses in.')
+   oa('-s', '--size', dest='size', default='512M', metavar='SIZE', help="Maximum total size of stored responses (with optional 'k', 'M' or 'G' suffix).")
+   oa('--entry-size', dest='entry_size', default=None, metavar='SIZE', help='Maximum size of a single stored response.')
+   oa('--fresh-time', dest='fresh_time', type=float, default=300, metavar='SECONDS', help='Serve stored responses without revalidation for this long.')
+   oa('--loglevel', '-L', dest='loglevel', type=int, default=20, help='Log level to use.')
+   oa('--selftest', dest='selftest', action='store_true', default=False, help='Run selftests and exit.')
+   (opts, args) = op.parse_args()
+
+   logging.getLogger().setLevel(opts.loglevel)
+   logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', stream=None)
+
+   if (opts.selftest):
+      _selftest()
+      return
+
+   (host, sep, port) = opts.listen.rpartition(':')
+   if (opts.entry_size is None):
+      entry_size = None
+   else:
+      entry_size = _parse_size(opts.entry_size)
+   cache = HTTPCache(os.path.expanduser(opts.path), _parse_size(opts.size), entry_size, opts.fresh_time)
+   server = HTTPCacheServer((host, int(port)), cache)
+   logging.getLogger('HTTPCacheServer').log(20, 'Serving on {0}:{1}.'.format(host, port))
+   try:
+      server.serve_forever()
+   except KeyboardInterrupt:
+      pass
+   finally:
+      server.server_close()
+
+if (__name__ == '__main__'):
+   main()
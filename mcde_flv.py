@@ -751,8 +751,55 @@ class FLVReader:
       
       return (version, data_off, has_video, has_audio)
    
-   def make_mkvb(self):
-      from collections import deque
+   def get_keyframe_index(self):
+      """Return (times, filepositions) of the keyframes index from the onMetaData tag at the start of the tag data.
+      
+      The file position is left unchanged."""
+      off = self.f.tell()
+      try:
+         for tag in self.parse_tags():
+            if (tag.type != FLVScriptData.type):
+               break
+            md = tag.get_metadata()
+            if (md is None):
+               continue
+            try:
+               kf = md['keyframes']
+               rv = ([float(t) for t in kf['times']], [int(p) for p in kf['filepositions']])
+            except (KeyError, TypeError, ValueError) as exc:
+               raise FLVParserError('No usable keyframes index in metadata.') from exc
+            if ((len(rv[0]) != len(rv[1])) or (len(rv[1]) == 0)):
+               raise FLVParserError('Inconsistent keyframes index in metadata.')
+            return rv
+      finally:
+         self.f.seek(off)
+      raise FLVParserError('No onMetaData tag preceding AV data.')
+   
+   def get_range_spans(self, t_range):
+      """Return ((head_start, head_end), (body_start, body_end)) byte ranges needed for time range (t_start, t_end).
+      
+      The head contains the metadata and codec init tags, and the body all tags from the keyframe preceding t_start to
+      the first keyframe at or after t_end; body_end is None if that's the end of the file. Must be called with the file
+      positioned at the first tag."""
+      (t_start, t_end) = t_range
+      (times, fposs) = self.get_keyframe_index()
+      i_first = 0
+      i_end = None
+      for (i, t) in enumerate(times):
+         if (t <= t_start):
+            i_first = i
+         if ((not (t_end is None)) and (t >= t_end) and (i > i_first)):
+            i_end = i
+            break
+      
+      if (i_end is None):
+         body_end = None
+      else:
+         body_end = fposs[i_end]
+      return ((self.f.tell(), fposs[0]), (fposs[i_first], body_end))
+   
+   def make_mkvb(self, t_range=None):
+      from itertools import chain
       import mcio_matroska
       from mcio_matroska import MatroskaBuilder
       
@@ -762,7 +809,9 @@ class FLVReader:
       ad = {}
       
       for d in (ad, vd):
-         d['data'] = deque()
+         d['data'] = FrameTable(self.f)
+         d['tag_last'] = None
+         d['ts_first'] = None
          d['init_data'] = None
       
       avtmap = {8:ad, 9: vd}
@@ -777,7 +826,15 @@ class FLVReader:
       prev_vn = None
       #vfbuf = []
       
-      for tag in self.parse_tags():
+      if (t_range is None):
+         tags = self.parse_tags()
+      else:
+         (span_head, span_body) = self.get_range_spans(t_range)
+         # Only keep metadata and codec init data from the head; AV data before the range is skipped entirely.
+         tags = chain((t for t in self.parse_tags((span_head,)) if not ((t.type in avtmap) and not t.is_header())),
+            self.parse_tags((span_body,)))
+      
+      for tag in tags:
          try:
             d = avtmap[tag.type]
          except KeyError:
@@ -787,9 +844,8 @@ class FLVReader:
                   md.update(md_add)
             continue
          
-         try:
-            tag_last = d['data'][-1]
-         except IndexError:
+         tag_last = d['tag_last']
+         if (tag_last is None):
             d['codec'] = tag.codec
             if (isinstance(tag, FLVAudioData)):
                d['sfreq'] = tag.sample_freq
@@ -797,12 +853,18 @@ class FLVReader:
                
          else:
             if not (tag_last.check_stream_consistency(tag)):
-               raise FLVParserError('Stream metadata inconsistency between {0} and {1}.'.format(tag_prev, tag))
+               raise FLVParserError('Stream metadata inconsistency between {0} and {1}.'.format(tag_last, tag))
          
          if (tag.is_header()):
             d['init_data'] = tag.data_r.get_data()
          else:
-            d['data'].append(tag)
+            # Only the frame table is kept for AV data tags; holding on to the tag objects themselves would cost an
+            # order of magnitude more memory per frame.
+            (ts, dur, data_r, is_keyframe) = tag.get_framedata()
+            d['data'].append(ts, dur, data_r.off, data_r.size, is_keyframe)
+            d['tag_last'] = tag
+            if (d['ts_first'] is None):
+               d['ts_first'] = tag.ts
             
          #if ((tag.type == 9) and (tag.codec == 7)):
             ## H264 data ... try reordering.
@@ -818,7 +880,20 @@ class FLVReader:
                   #del(vfbuf[:])
                #vfbuf.append(tag)
                
-      mb = MatroskaBuilder(1000000, md['duration'])
+      ts_base = 0
+      dur = md['duration']
+      if not (t_range is None):
+         ts_base = min(d['ts_first'] for d in (vd, ad) if d['data'])
+         if not ((dur is None) or (t_range[1] is None)):
+            dur = min(dur, t_range[1])
+         if not (dur is None):
+            dur -= ts_base/1000
+      
+      if (ts_base):
+         for d in (vd, ad):
+            d['data'].shift_tc(-ts_base)
+      
+      mb = MatroskaBuilder(1000000, dur)
       
       try:
          vc_id = self.CODEC2ID_V[vd['codec']]
@@ -831,7 +906,7 @@ class FLVReader:
          width = int(width)
       if not (height is None):
          height = int(height)
-      mb.add_track((t.get_framedata() for t in vd['data']), mcio_matroska.TRACKTYPE_VIDEO, vc_id, vd['init_data'], True,
+      mb.add_track(vd['data'], mcio_matroska.TRACKTYPE_VIDEO, vc_id, vd['init_data'], True,
          width, height)
          
       try:
@@ -839,52 +914,107 @@ class FLVReader:
       except KeyError:
          raise FLVParserError('Unknown audio codec {0}.'.format(ad['codec']))
       
-      mb.add_track((t.get_framedata() for t in ad['data']), mcio_matroska.TRACKTYPE_AUDIO, ac_id, ad['init_data'], False,
+      mb.add_track(ad['data'], mcio_matroska.TRACKTYPE_AUDIO, ac_id, ad['init_data'], False,
          ad['sfreq'], ad['channel_count'])
       
       return mb
    
-   def parse_tags(self):
-      off = self.f.tell()
-      while (True):         
-         header_data = self.f.read(self.bfmt_tag_header_len)
-         if (header_data == b''):
-            # End of FLV data.
-            break
-         if (len(header_data) != self.bfmt_tag_header_len):
-            raise FLVParserError('Failed to read another full tag header; expected {0} bytes, but only got {1!a}.'.format(
-               self.bfmt_tag_header_len, header_data))
-         
-         hdr2_data = bytearray(8)
-         # Stupid 24bit-sized ints, and middle-endian 32bit ints.
-         (ttype, hdr2_data[1:4], hdr2_data[5:8], hdr2_data[4]) = struct.unpack(self.bfmt_tag_header, header_data)
-
-         (body_size, ts) = struct.unpack(self.bfmt_tag_header2, hdr2_data)
-         tag_size = body_size + self.bfmt_tag_header_len
-         
-         try:
-            tcls = self.tagtype_cls_map[ttype]
-         except KeyError:
-            tag = FLVDummyTag.build_from_file(self.f, body_size, ts, ttype)
-         else:
-            tag = tcls.build_from_file(self.f, body_size, ts)
-         
-         self.f.seek(off + tag_size)
-         
-         (tag_size2,) = struct.unpack('>L', self.f.read(4))
-         if (tag_size != tag_size2):
-            raise FLVParserError("Tag header-derived size == {0} != {1} == post-tag size.".format(tag_size,tag_size2))
-         
-         yield(tag)
-         
-         off += tag_size + 4
+   @classmethod
+   def parse_tag_header(cls, header_data):
+      """Parse FLV tag header data; returns (tag type, body size, timestamp)."""
+      hdr2_data = bytearray(8)
+      # Stupid 24bit-sized ints, and middle-endian 32bit ints.
+      (ttype, hdr2_data[1:4], hdr2_data[5:8], hdr2_data[4]) = struct.unpack(cls.bfmt_tag_header, header_data)
+      
+      (body_size, ts) = struct.unpack(cls.bfmt_tag_header2, hdr2_data)
+      return (ttype, body_size, ts)
+   
+   def parse_tags(self, spans=None):
+      """Parse tags from the current file position to EOF, or from each (off_start, off_end) byte range in spans."""
+      if (spans is None):
+         spans = ((self.f.tell(), None),)
+      
+      for (off, off_end) in spans:
          self.f.seek(off)
+         while ((off_end is None) or (off < off_end)):
+            header_data = self.f.read(self.bfmt_tag_header_len)
+            if (header_data == b''):
+               # End of FLV data.
+               break
+            if (len(header_data) != self.bfmt_tag_header_len):
+               raise FLVParserError('Failed to read another full tag header; expected {0} bytes, but only got {1!a}.'.format(
+                  self.bfmt_tag_header_len, header_data))
+            
+            (ttype, body_size, ts) = self.parse_tag_header(header_data)
+            tag_size = body_size + self.bfmt_tag_header_len
+            
+            try:
+               tcls = self.tagtype_cls_map[ttype]
+            except KeyError:
+               tag = FLVDummyTag.build_from_file(self.f, body_size, ts, ttype)
+            else:
+               tag = tcls.build_from_file(self.f, body_size, ts)
+            
+            self.f.seek(off + tag_size)
+            
+            (tag_size2,) = struct.unpack('>L', self.f.read(4))
+            if (tag_size != tag_size2):
+               raise FLVParserError("Tag header-derived size == {0} != {1} == post-tag size.".format(tag_size,tag_size2))
+            
+            yield(tag)
+            
+            off += tag_size + 4
+            self.f.seek(off)
          
 
-def make_mkvb_from_file(f):
+def make_mkvb_from_file(f, t_range=None):
    flvr = FLVReader(f)
    flvr.parse_header()
-   return flvr.make_mkvb()
+   return flvr.make_mkvb(t_range)
+
+def fetch_index(f, fetch, length):
+   """Copy FLV file header and tags up to and including the onMetaData tag of a remote file into local file f.
+   
+   fetch(off, size) is called to retrieve remote data. Data is written at its original offsets, and the rest of f is left
+   sparse; this is enough to determine which data to fetch for a given time range using get_range_spans()."""
+   f.truncate(length)
+   data = fetch(0, FLVReader.bfmt_file_header_len)
+   (sig, version, flags, data_off) = struct.unpack(FLVReader.bfmt_file_header, data)
+   if (sig != b'FLV'):
+      raise FLVParserError("Header didn't start with b'FLV'.")
+   
+   off = data_off + 4
+   f.seek(0)
+   f.write(fetch(0, off))
+   while (off < length):
+      (ttype, body_size, ts) = FLVReader.parse_tag_header(fetch(off, FLVReader.bfmt_tag_header_len))
+      tag_len = FLVReader.bfmt_tag_header_len + body_size + 4
+      f.seek(off)
+      f.write(fetch(off, tag_len))
+      if (ttype == FLVScriptData.type):
+         f.seek(off + FLVReader.bfmt_tag_header_len)
+         md = FLVScriptData.build_from_file(f, body_size, ts).get_metadata()
+         if ((not (md is None)) and ('keyframes' in md)):
+            f.flush()
+            return
+      elif (ttype in FLVReader.tagtype_cls_map):
+         break
+      off += tag_len
+   raise FLVParserError('No keyframes index found ahead of AV data.')
+
+def get_range_spans(f, t_range, length):
+   """Return sequence of (offset, size) tuples of the data needed to demux time range t_range from f."""
+   flvr = FLVReader(f)
+   flvr.parse_header(0)
+   (span_head, (body_start, body_end)) = flvr.get_range_spans(t_range)
+   if (body_end is None):
+      body_end = length
+   rv = [(0, span_head[1])]
+   if (body_start <= span_head[1]):
+      rv[0] = (0, body_end)
+   else:
+      rv.append((body_start, body_end - body_start))
+   return rv
 
 def _main():
    import sys
@@ -739,7 +739,72 @@ class MovBoxMovie(MovBoxBranch):
    _HTYPE_SOUN = FourCC(b'soun')
    _HTYPE_VIDE = FourCC(b'vide')
    
-   def make_mkvb(self):
+   @classmethod
+   def get_track_type(cls, htype):
+      """Return mcio_matroska track type for specified handler type, or None if it isn't an AV one."""
+      import mcio_matroska
+      return {cls._HTYPE_VIDE: mcio_matroska.TRACKTYPE_VIDEO, cls._HTYPE_SOUN: mcio_matroska.TRACKTYPE_AUDIO}.get(htype)
+   
+   def get_av_tracks(self):
+      """Return sequence of (track, handler type) tuples for all audio and video tracks."""
+      rv = []
+      for track in self.find_subboxes('trak'):
+         htype = track.find_subbox(b'mdia').find_subbox(b'hdlr').handler_type
+         if (htype in (self._HTYPE_VIDE, self._HTYPE_SOUN)):
+            rv.append((track, htype))
+      return rv
+   
+   def get_range_selection(self, t_range):
+      """Map time range (t_start, t_end) in seconds to samples of our AV tracks.
+      
+      The start is moved back to the closest preceding keyframe of the video track(s); t_end may be None for an open
+      range. Returns ({track: (first sample, end sample)}, base time), with the base time in seconds being the earliest
+      decode time of any selected sample."""
+      (t_start, t_end) = t_range
+      tracks = self.get_av_tracks()
+      rv = {}
+      t_key = t_start
+      for (track, htype) in tracks:
+         if (htype != self._HTYPE_VIDE):
+            continue
+         (s_first, s_end, tv_first) = track.get_sample_range(t_start, t_end)
+         rv[track] = (s_first, s_end)
+         t_key = min(t_key, tv_first/track.get_mdhd().time_scale)
+      
+      t_base = t_key
+      for (track, htype) in tracks:
+         if (track in rv):
+            continue
+         (s_first, s_end, tv_first) = track.get_sample_range(t_key, t_end)
+         rv[track] = (s_first, s_end)
+         t_base = min(t_base, tv_first/track.get_mdhd().time_scale)
+      
+      return (rv, t_base)
+   
+   def get_range_spans(self, t_range, track_types=None):
+      """Return sorted sequence of (offset, size) tuples of the media data needed for time range t_range.
+      
+      If track_types is given, only data of tracks of those (mcio_matroska) track types is included."""
+      (sel, t_base) = self.get_range_selection(t_range)
+      spans = []
+      for (track, htype) in self.get_av_tracks():
+         if not ((track_types is None) or (self.get_track_type(htype) in track_types)):
+            continue
+         s_range = sel[track]
+         for (timeval, dur, data_ref, sync) in track.get_sample_data(1, s_range=s_range):
+            spans.append((data_ref.off, data_ref.size))
+      spans.sort()
+      
+      rv = []
+      for (off, size) in spans:
+         if (rv and (off <= rv[-1][0] + rv[-1][1])):
+            (off_p, size_p) = rv[-1]
+            rv[-1] = (off_p, max(size_p, off + size - off_p))
+         else:
+            rv.append((off, size))
+      return rv
+   
+   def make_mkvb(self, t_range=None):
       import mcio_matroska
       from mcio_matroska import MatroskaBuilder
       
@@ -750,6 +815,15 @@ class MovBoxMovie(MovBoxBranch):
       
       mvhd = self.find_subbox('mvhd')
       dur = max(dur, mvhd.get_dur())
+      if (t_range is None):
+         sel = {}
+         t_base = 0
+      else:
+         (sel, t_base) = self.get_range_selection(t_range)
+         if not (t_range[1] is None):
+            dur = min(dur, t_range[1])
+         dur -= t_base
+      
       (tcs, elmult, _tcs_err) = MatroskaBuilder.tcs_from_secdiv(ts_base, td_gcd)
       mb = MatroskaBuilder(tcs, dur)
       
@@ -770,7 +844,8 @@ class MovBoxMovie(MovBoxBranch):
          codec_id = se.get_codec()
          ts_fact = (ts_base / mdhd.time_scale)
          mcd = track._get_most_common_dur()
-         mb.add_track(track.get_sample_data(elmult*ts_fact, mcd), ttype, codec_id, se.get_codec_init_data(),
+         sample_data = track.get_sample_data(elmult*ts_fact, mcd, sel.get(track), t_base*mdhd.time_scale)
+         mb.add_track(sample_data, ttype, codec_id, se.get_codec_init_data(),
             not (track.stts is None), default_dur=round(10**9*mcd/mdhd.time_scale), *at_args)
       
       return mb
@@ -844,7 +919,39 @@ class MovBoxTrack(MovBoxBranch):
       
       return max((val,key) for (key, val) in dur_freqs.items())[1]
    
-   def get_sample_data(self, time_mult, default_dur=None):
+   def get_sample_range(self, t_start, t_end=None):
+      """Determine samples covering the time range [t_start, t_end) (in seconds, by decode time).
+      
+      The start is moved back to the closest preceding sync sample. Returns (first sample, end sample, decode time of
+      first sample), with the latter in units of the media time scale."""
+      time_scale = self.get_mdhd().time_scale
+      tv_start = t_start*time_scale
+      if (t_end is None):
+         tv_end = None
+      else:
+         tv_end = t_end*time_scale
+      
+      if (self.stss is None):
+         sync = None
+      else:
+         sync = set(self.stss.entry_data)
+      
+      s_first = 0
+      tv_first = 0
+      s_end = self.stsz.get_ss_count()
+      timeval = 0
+      for (s, timedelta) in enumerate(self.stts):
+         if ((not (tv_end is None)) and (timeval >= tv_end)):
+            s_end = s
+            break
+         if ((timeval <= tv_start) and ((sync is None) or ((s + 1) in sync))):
+            s_first = s
+            tv_first = timeval
+         timeval += timedelta
+      
+      return (s_first, s_end, tv_first)
+   
+   def get_sample_data(self, time_mult, default_dur=None, s_range=None, tv_base=0):
       if not (self.edts is None):
          raise MovParserError('EDTS support is currently unimplemented.')
       
@@ -869,6 +976,11 @@ class MovBoxTrack(MovBoxBranch):
       s = 0
       s_lim = self.stsz.get_ss_count()
       s_sublim = 0
+      if (s_range is None):
+         s_first = 0
+      else:
+         (s_first, s_end) = s_range
+         s_lim = min(s_lim, s_end)
       
       c = 0
       c_lim = 0
@@ -909,7 +1021,8 @@ class MovBoxTrack(MovBoxBranch):
             dur = round(dur*time_mult)
          
          size = get_sz(s)
-         yield ((round(tv_d*time_mult), dur, DataRefFile(self.c.f, s_off, size), is_sync))
+         if (s >= s_first):
+            yield ((round((tv_d-tv_base)*time_mult), dur, DataRefFile(self.c.f, s_off, size), is_sync))
          s_off += size
          s += 1
          timeval += timedelta
@@ -1013,15 +1126,49 @@ def _dump_atoms(seq, depth=0):
       if (hasattr(atom, 'sub')):
          _dump_atoms(atom.sub, depth+1)
    
-def make_mkvb_from_file(f, *args, **kwargs):
+def _find_movie_box(f, *args, **kwargs):
    boxes = MovBox.build_seq_from_file(f, *args, **kwargs)
    for box in boxes:
       if isinstance(box, MovBoxMovie):
-         break
-   else:
-      raise ValueError('No movie box in MP4 file; got: {0!a}.'.format(boxes))
+         return box
+   raise ValueError('No movie box in MP4 file; got: {0!a}.'.format(boxes))
+
+def make_mkvb_from_file(f, *args, t_range=None, **kwargs):
+   return _find_movie_box(f, *args, **kwargs).make_mkvb(t_range)
+
+def fetch_index(f, fetch, length):
+   """Copy top-level box headers and the movie box of a remote MP4 file into local file f, at their original offsets.
+   
+   fetch(off, size) is called to retrieve remote data. The rest of f is left sparse; this is enough to parse the file and
+   determine which media data to fetch for a given time range using get_range_spans()."""
+   f.truncate(length)
+   off = 0
+   while (off < length):
+      header = fetch(off, min(16, length - off))
+      (size, btype) = struct.unpack('>LL', header[:8])
+      if (size == 1):
+         (size,) = struct.unpack('>Q', header[8:16])
+      elif (size == 0):
+         size = length - off
+      if ((size < 8) or (off + size > length)):
+         raise MovParserError('Invalid size {0} for top-level box at offset {1}.'.format(size, off))
+      
+      if (btype == MovBoxMovie.type):
+         data = fetch(off, size)
+      else:
+         data = header[:size]
+      f.seek(off)
+      f.write(data)
+      off += size
+   f.flush()
+
+def get_range_spans(f, t_range, length=None, track_types=None):
+   """Return sorted sequence of (offset, size) tuples of the media data needed to demux time range t_range from f.
    
-   return box.make_mkvb()
+   If track_types is given, only data of tracks of those (mcio_matroska) track types is included; the data of other tracks
+   is left unretrieved, so they need to be dropped before muxing."""
+   f.seek(0)
+   return _find_movie_box(f).get_range_spans(t_range, track_types)
 
 def main():
    import sys
@@ -17,6 +17,7 @@
 
 # Media container I/O: Base types
 
+from array import array
 import struct
 
 class ContainerError(Exception):
@@ -80,6 +81,63 @@ class DataRefNull(DataRef):
       return self._size
 
 
+class FrameTable:
+   """Compact store for the frames of one track, with frame data located in a single file.
+   
+   Timecodes, durations, data offsets and sizes are kept in array('q') columns, and keyframe flags in a bitmap, instead
+   of in per-frame objects; (timecode, duration, data_r, is_keyframe) tuples for individual frames are built on
+   demand. Durations of None are stored as DUR_NONE."""
+   DUR_NONE = -1
+   def __init__(self, f):
+      self.f = f
+      self.tc = array('q')
+      self.dur = array('q')
+      self.off = array('q')
+      self.size = array('q')
+      self.kf = bytearray()
+   
+   def __len__(self):
+      return len(self.tc)
+   
+   def append(self, tc, dur, off, size, is_keyframe):
+      i = len(self.tc)
+      self.tc.append(tc)
+      self.dur.append(self.DUR_NONE if (dur is None) else dur)
+      self.off.append(off)
+      self.size.append(size)
+      if not (i & 7):
+         self.kf.append(0)
+      if (is_keyframe):
+         self.kf[i >> 3] |= (1 << (i & 7))
+   
+   def shift_tc(self, delta):
+      """Add delta to all frame timecodes."""
+      self.tc = array('q', (tc + delta for tc in self.tc))
+   
+   def is_keyframe(self, i):
+      return bool(self.kf[i >> 3] & (1 << (i & 7)))
+   
+   def get_dur(self, i):
+      dur = self.dur[i]
+      if (dur == self.DUR_NONE):
+         return None
+      return dur
+   
+   def get_data_r(self, i):
+      return DataRefFile(self.f, self.off[i], self.size[i])
+   
+   def get_frame(self, i, tc_off=0):
+      return (self.tc[i] + tc_off, self.get_dur(i), self.get_data_r(i), self.is_keyframe(i))
+   
+   def iter_frames(self, tc_off=0):
+      """Iterate over frame tuples, shifting timecodes by tc_off."""
+      for i in range(len(self.tc)):
+         yield self.get_frame(i, tc_off)
+   
+   def __iter__(self):
+      return self.iter_frames()
+
+
 class FourCC(int):
    def __new__(cls, x):
       if (isinstance(x, str)):
@@ -20,7 +20,10 @@
 from collections import deque
 from copy import deepcopy
 import datetime
-import math
+import heapq
+import io
+import itertools
+import os
 import random
 import struct
 import time
@@ -38,16 +41,60 @@ class EBMLError(MatroskaBaseError):
 class MatroskaError(MatroskaBaseError):
    pass
 
+# Each vint byte carries 7 payload bits. These tables map payload bit lengths to encoding lengths, and the first byte of
+# an encoding to its total length (for vints of up to 8 bytes; longer ones start with a zero byte).
+_VINT_LEN_BY_BITS = tuple(max((bits+6)//7, 1) for bits in range(65))
+_VINT_LEN_BY_B0 = (None,) + tuple(9 - b.bit_length() for b in range(1, 256))
+# Encodings of small unsigned values, which make up most element sizes.
+_VINT_BYTES_SMALL = tuple(bytes((0x80 | i,)) for i in range(127))
+
 def _calc_vint_size(i, signed):
    payload_len = (i+1-signed).bit_length() + signed
-   rv = 1
-   while ((rv*8 - rv) < payload_len):
-      rv += 1
+   if (payload_len < len(_VINT_LEN_BY_BITS)):
+      return _VINT_LEN_BY_BITS[payload_len]
+   return (payload_len+6)//7
+
+def _vint_size(i):
+   """Return length of shortest vint encoding of unsigned int i."""
+   return _VINT_LEN_BY_BITS[(i+1).bit_length()]
+
+def _vint_bytes(i):
+   """Return shortest vint encoding of unsigned int i."""
+   if (i < 127):
+      return _VINT_BYTES_SMALL[i]
+   size = _VINT_LEN_BY_BITS[(i+1).bit_length()]
+   return (i | (1 << (7*size))).to_bytes(size, 'big')
+
+def _vint_decode(bd, off=0, signed=False):
+   """Decode vint at offset off of bd; returns (value, encoded length)."""
+   l = _VINT_LEN_BY_B0[bd[off]]
+   if (l is None):
+      idx = off
+      while (bd[idx] == 0):
+         idx += 1
+      l = 8*(idx-off) + 9 - bd[idx].bit_length()
+   if (off + l > len(bd)):
+      raise IndexError('Vint at offset {0} extends past end of data.'.format(off))
+   
+   marker = 1 << (7*l)
+   val = int.from_bytes(bd[off:off+l], 'big') ^ marker
+   if (val == marker - 1):
+      raise EBMLError('Reserved int values are currently unimplemented.')
+   if (signed):
+      val -= (marker >> 1) - 1
+   return (val, l)
+
+_id_bindata = {}
+def _get_id_bindata(etype):
+   """Return cached encoding of element id etype."""
+   try:
+      return _id_bindata[etype]
+   except KeyError:
+      pass
+   rv = _id_bindata[etype] = etype.get_bindata()
    return rv
 
 class EBMLVInt(int):
-   lt_sbit = (None,) + tuple(int(math.log(i,2)) for i in range(1,2**8))
-   lt_prefix_reserved = tuple(not bool(math.log(i+1,2) % 1) for i in range(0,2**8))
    SIGNED = False
    
    def __init__(self, x):
@@ -55,62 +102,22 @@ class EBMLVInt(int):
    
    def get_bindata(self):
       """Return binary string representing this VInt."""
-      rv = bytearray(self.size)
-      (prefix_bytes, prefix_bits) = divmod(self.size-1, 8)
-      
-      databits = (8*len(rv) - 8*prefix_bytes - prefix_bits - 1)
-      mult = 1 << (8*(len(rv)-prefix_bytes-1))
       val = int(self)
       if (self.SIGNED):
-         val += 2**(databits-1)-1
-      
-      for i in range(prefix_bytes, len(rv)):
-         rv[i] = val // mult
-         val %= mult
-         mult >>= 8
-      
-      rv[prefix_bytes] |= (1 << (7-prefix_bits))
-      return rv
+         val += (1 << (7*self.size-1)) - 1
+      return (val | (1 << (7*self.size))).to_bytes(self.size, 'big')
    
    def write_to_file(self, c):
       bd = self.get_bindata()
-      return c.f.write(bd)
+      return c.write(bd)
    
    def new(cls, *args, **kwargs):
       return cls(*args, **kwargs)
    
    @classmethod
    def build_from_bindata(cls, bd):
-      bd = memoryview(bd)
-      idx = 0
-      l = 0
-      while (bd[idx][0] == 0):
-         l += 8
-         idx += 1
-      
-      sbits = cls.lt_sbit[bd[idx][0]]
-      prefix_val = bd[idx][0] & (2**sbits-1)
-      l += 7-sbits
-      
-      bid = bd[idx+1:l+1]
-      bd[idx+l][0]
-      
-      # Test for reserved val
-      if ((cls.lt_prefix_reserved[bd[idx][0]]) and (bid == (b'\xFF'*l))):
-         raise EBMLError('Reserved int values are currently unimplemented.')
-      
-      # Can't reverse it directly, since it might be a memoryview object
-      mult = 1
-      ival = 0
-      for i in reversed(range(len(bid))):
-         ival += bid[i][0]*mult
-         mult <<= 8
-      
-      ival += prefix_val*mult
-      if (cls.SIGNED):
-         ival -= 2**(sbits+l*8-1)-1
-      
-      return (cls(ival), l+1)
+      (val, l) = _vint_decode(bd, 0, cls.SIGNED)
+      return (cls(val), l)
    
    @classmethod
    def build_from_file(cls, f):
@@ -157,9 +164,14 @@ class EBMLElement:
       raise EBMLError('Unrecognized element of type {0}; unable to dump.'.format(self.type))
 
    def _write_header(self, c, size):
-      if not (isinstance(size, MatroskaVInt)):
-         size = MatroskaVInt(size)
-      return self.type.write_to_file(c) + size.write_to_file(c)
+      if (isinstance(size, EBMLVInt)):
+         # Might have a non-minimal encoding length set.
+         sz_bd = size.get_bindata()
+      elif (size > MatroskaVInt.val_lim):
+         raise MatroskaError('VInt val {0} outside of defined domain.'.format(size))
+      else:
+         sz_bd = _vint_bytes(size)
+      return c.write(_get_id_bindata(self.type) + sz_bd)
 
 class EBMLElementUnknown(EBMLElement):
    def __init__(self, type, size, f):
@@ -172,8 +184,8 @@ class EBMLElementUnknown(EBMLElement):
       return type(self)(self.type, self.data_r.size, self.data_r.f)
 
    def get_size(self):
-      bd_size = MatroskaVInt(self.data_r.size)
-      return (self.type.size + bd_size.size + bd_size)
+      bd_size = self.data_r.size
+      return (self.type.size + _vint_size(bd_size) + bd_size)
 
    @classmethod
    def _bff_curry(cls, etype):
@@ -187,29 +199,109 @@ class EBMLElementUnknown(EBMLElement):
 
    def write_to_file(self, c):
       hl = self._write_header(c, self.data_r.size)
-      return (hl + c.f.write(self.data_r.get_data()))
+      return (hl + c.write(self.data_r.get_data()))
 
 class MatroskaElement(EBMLElement):
    @classmethod
    def new(cls, *args, **kwargs):
       return cls(*args, **kwargs)
 
+class _ElementList(list):
+   """List of subelements of a master element, invalidating the cached sizes of its owner when modified."""
+   __slots__ = ('owner',)
+   def __init__(self, seq=(), owner=None):
+      list.__init__(self, seq)
+      self.owner = owner
+   
+   def __deepcopy__(self, mdict):
+      return _ElementList([deepcopy(e, mdict) for e in self])
+
+def _elementlist_wrap(name):
+   meth = getattr(list, name)
+   def rv(self, *args, **kwargs):
+      if not (self.owner is None):
+         self.owner._size_changed()
+      return meth(self, *args, **kwargs)
+   rv.__name__ = name
+   return rv
+
+for _name in ('__setitem__', '__delitem__', '__iadd__', 'append', 'extend', 'insert', 'pop', 'remove', 'clear', 'sort',
+      'reverse'):
+   setattr(_ElementList, _name, _elementlist_wrap(_name))
+del(_name)
+
 class MatroskaElementMaster(MatroskaElement):
-   __slots__ = ('type', 'sub')
+   __slots__ = ('type', '_sub', '_size', '_parents', '_src')
+   # Body sizes are cached per element. Computing one links the master subelements involved to us, so modifying their
+   # subelement lists later on invalidates our cached size, too. Trees are independent of each other this way; modifying
+   # one doesn't affect cached sizes in any other, so separate threads can each work on their own. Modifying a tree
+   # while another thread is writing it isn't supported.
+   size_cache = True
    def __init__(self, sub):
       super().__init__()
-      self.sub = sub
+      self._set_sub(sub)
+      self._src = None
 
    def __deepcopy__(self, mdict):
       return type(self)(deepcopy(self.sub,mdict))
+   
+   def _set_sub(self, sub):
+      if (isinstance(sub, list) and not (isinstance(sub, _ElementList) and (sub.owner in (None, self)))):
+         sub = _ElementList(sub)
+      if (isinstance(sub, _ElementList)):
+         sub.owner = self
+      self._sub = sub
+      self._size = None
+      self._parents = None
+   
+   def _size_changed(self):
+      """Invalidate cached sizes of this element and its ancestors; call after modifying subelement values in place."""
+      todo = [self]
+      while (todo):
+         e = todo.pop()
+         e._size = None
+         if not (e._parents is None):
+            # Ancestors with valid cached sizes have valid ones for their descendants, too; so we can stop at any
+            # element which doesn't have one.
+            todo.extend(p for p in e._parents if not (p._size is None))
+   
+   def _add_parent(self, parent):
+      parents = self._parents
+      if (parents is None):
+         self._parents = [parent]
+      elif not (any((p is parent) for p in parents)):
+         parents.append(parent)
+
+   @property
+   def sub(self):
+      if (self._sub is None):
+         self._load_sub()
+      return self._sub
+   
+   @sub.setter
+   def sub(self, sub):
+      parents = self._parents
+      self._set_sub(sub)
+      self._parents = parents
+      self._size_changed()
 
    @property
    def val(self):
       return self.sub
 
+   def _get_body_size(self):
+      if ((self._size is None) or (not self.size_cache)):
+         size = 0
+         for e in self.sub:
+            size += e.get_size()
+            if (isinstance(e, MatroskaElementMaster)):
+               e._add_parent(self)
+         self._size = size
+      return self._size
+
    def write_to_file(self, c):
-      blen = sum(e.get_size() for e in self.sub)
-      hlen = self._write_header(c, MatroskaVInt(blen))
+      blen = self._get_body_size()
+      hlen = self._write_header(c, blen)
       
       blen2 = sum(e.write_to_file(c) for e in self.sub)
       if (blen != blen2):
@@ -218,8 +310,8 @@ class MatroskaElementMaster(MatroskaElement):
       return (blen + hlen)
 
    def get_size(self):
-      bd_size = MatroskaVInt(sum(c.get_size() for c in self.sub))
-      return (self.type.size + bd_size.size + bd_size)
+      bd_size = self._get_body_size()
+      return (self.type.size + _vint_size(bd_size) + bd_size)
 
    def get_sub_by_cls(self, cls):
       for e in self.sub:
@@ -248,10 +340,43 @@ class MatroskaElementMaster(MatroskaElement):
    def remove_subvals_by_cls(self, cls):
       self.sub = [e for e in self.sub if not (isinstance(e,cls))]
    
+   def _load_sub(self):
+      src = self._src
+      if (src is None):
+         return
+      src.f.seek(src.off)
+      self._sub = _ElementList(ebml_ns_mkv.build_seq_from_file(src.f, src.size), self)
+   
+   def _iter_sub(self, start=0):
+      """Iterate over subelements without keeping them around.
+      
+      For elements read from a file whose subelements haven't been parsed yet, this reads them from disk one at a time
+      instead of building the full list. If start is specified, iteration begins with the subelement at that offset
+      relative to our body; this requires us to have been read from a file."""
+      src = self._src
+      if ((not start) and ((not (self._sub is None)) or (src is None))):
+         yield from self.sub
+         return
+      
+      f = src.f
+      off = src.off + start
+      off_lim = src.off + src.size
+      while (off < off_lim):
+         # Other readers may have moved the file pointer while we were suspended; always seek explicitly.
+         f.seek(off)
+         (el, size) = ebml_ns_mkv.build_from_file(f)
+         yield el
+         off += size
+      
+      if (off != off_lim):
+         raise EBMLError('Element size / filesize mismatch.')
+   
    @classmethod
    def _build_from_file(cls, body_size, f):
-      sub = ebml_ns_mkv.build_seq_from_file(f, body_size)
-      return cls(sub)
+      # Subelements are parsed lazily, on first access to .sub.
+      rv = cls(None)
+      rv._src = DataRefFile(f, f.tell(), body_size)
+      return rv
 
 
 class MatroskaElementBinary(MatroskaElement):
@@ -271,16 +396,16 @@ class MatroskaElementBinary(MatroskaElement):
       return '<{0} {1}>'.format(self.__class__.__name__, self.data_r)
 
    def _get_body_size(self):
-      return MatroskaVInt(self.data_r.get_size())
+      return self.data_r.get_size()
 
    def get_size(self):
       bd_size = self._get_body_size()
-      return (self.type.size + bd_size.size + bd_size)
+      return (self.type.size + _vint_size(bd_size) + bd_size)
    
    def write_to_file(self, c):
       bd = self.data_r.get_data()
       hl = self._write_header(c, self._get_body_size())
-      blw = c.f.write(bd)
+      blw = c.write(bd)
       if (blw != len(bd)):
          raise IOError()
       return (hl+blw)
@@ -317,12 +442,12 @@ class MatroskaElementBaseNum(MatroskaElement):
       body_data = struct.pack(self._get_bfmt(bd_len), _val)
       rv = self._write_header(c, bd_len)
       if (bd_len):
-         rv += c.f.write(body_data[-1*bd_len:])
+         rv += c.write(body_data[-1*bd_len:])
       return rv
 
    def get_size(self):
       bd_size = self._get_body_size()
-      return (self.type.size + MatroskaVInt(bd_size).size + bd_size)
+      return (self.type.size + _vint_size(bd_size) + bd_size)
 
    @classmethod
    def _get_bfmt(cls, size):
@@ -366,7 +491,7 @@ class MatroskaElementUInt(MatroskaElementBaseNum):
    
    def _get_body_size(self):
       # While EBML allows for 0-byte ints, matroska sets a minimum length of 1 byte for ... some reason.
-      return math.ceil(self.val.bit_length()/8) or 1
+      return ((self.val.bit_length()+7) >> 3) or 1
 
 class MatroskaElementSInt(MatroskaElementBaseNum):
    bfmt = '>q'
@@ -375,7 +500,7 @@ class MatroskaElementSInt(MatroskaElementBaseNum):
       super().__init__(val, *args, **kwargs)
    
    def _get_body_size(self):
-      return math.ceil(((self.val + (self.val < 0)).bit_length() + 1)/8)
+      return ((self.val + (self.val < 0)).bit_length() + 8) >> 3
    
    @classmethod
    def _adjust_padding(cls, buf, pad_sz):
@@ -442,13 +567,13 @@ class MatroskaElementStringBase(MatroskaElement):
 
    def write_to_file(self, c):
       body_data = self.val.encode(self.codec)
-      rv = self._write_header(c, MatroskaVInt(len(body_data)))
-      rv += c.f.write(body_data)
+      rv = self._write_header(c, len(body_data))
+      rv += c.write(body_data)
       return rv
 
    def get_size(self):
       bd_size = len(self.val.encode(self.codec))
-      return (self.type.size + MatroskaVInt(bd_size).size + bd_size)
+      return (self.type.size + _vint_size(bd_size) + bd_size)
 
    def __format__(self, fs):
       return '<{0} {1!a}>'.format(self.__class__.__name__, self.val)
@@ -505,18 +630,26 @@ class EBMLNamespace:
       if ((not default_ok) or (self.cls_build_default is None)):
          return None
       
-      return self.cls_build_default._bff_curry(etype)
+      return self.cls_build_default._bff_curry(self.vint_type(etype))
    
    def build_from_file(self, f):
       """Deserialize one EBML element from filelike, returning it and the number of bytes consumed."""
-      bufsize = 8
+      bs = 16
       off = f.tell()
-      (etype, sz_et) = self.vint_type.build_from_file(f)
-      off += sz_et
-      f.seek(off)
-      (size, sz_sz) = self.vint_type.build_from_file(f)
-      off += sz_sz
-      f.seek(off)
+      while (True):
+         data = f.read(bs)
+         try:
+            (etype, sz_et) = _vint_decode(data)
+            (size, sz_sz) = _vint_decode(data, sz_et)
+         except IndexError:
+            if (len(data) != bs):
+               raise
+            f.seek(off)
+            bs *= 2
+         else:
+            break
+      
+      f.seek(off + sz_et + sz_sz)
       bff = self._etype2bff(etype)
       rv = (bff(size, f), sz_sz+sz_et+size)
       return rv
@@ -558,29 +691,104 @@ class MatroskaElementSignatureSlot(MatroskaElementMaster):
 @_mkv_type_reg
 class MatroskaElementSegment(MatroskaElementMaster):
    type = EBMLVInt(139690087)
-   def _iter_frames(self, tn, default_dur):
-      for c in self.get_subl_by_cls(MatroskaElementCluster):
-         tc = c.get_subval_by_cls(MatroskaElementTimecode)
-         for bc in c.get_subl_by_cls((MatroskaElementSimpleBlock, MatroskaElementBlockGroup)):
-            block = bc.get_block()
-            (btn, btc, lacing, frame_count, hdrlen) = block._get_hd()
-            if (btn != tn):
-               continue
-            
-            dur = bc.get_dur()
-            if not (dur is None):
-               dur = round(dur/frame_count)
-            else:
-               dur = default_dur
-            
-            is_kf = bc.is_keyframe()
-            ftc_delta = 0
-            ftc = tc + btc
-            for frame_data in block:
-               ftc += ftc_delta
-               yield(ftc, dur, frame_data, is_kf)
-               ftc_delta = dur
+   def _get_sub_by_seek(self, cls):
+      """Look up top-level subelement of type cls through our SeekHead, if we have one pointing at it."""
+      src = self._src
+      if (src is None):
+         return None
+      
+      sh = next(self._iter_sub(), None)
+      if not (isinstance(sh, MatroskaElementSeekHead)):
+         return None
       
+      etype_bd = _get_id_bindata(cls.type)
+      for seek in sh.get_subl_by_cls(MatroskaElementSeek):
+         seek_id = seek.get_subval_by_cls(MatroskaElementSeekID)
+         if ((seek_id is None) or (bytes(seek_id.get_data()) != etype_bd)):
+            continue
+         pos = seek.get_subval_by_cls(MatroskaElementSeekPosition)
+         if ((pos is None) or (pos >= src.size)):
+            continue
+         src.f.seek(src.off + pos)
+         (el, size) = ebml_ns_mkv.build_from_file(src.f)
+         if (isinstance(el, cls)):
+            return el
+      return None
+   
+   def get_sub_by_cls(self, cls):
+      if (self._sub is None):
+         rv = self._get_sub_by_seek(cls)
+         if not (rv is None):
+            return rv
+      for e in self._iter_sub():
+         if (isinstance(e, cls)):
+            return e
+   
+   def get_subval_by_cls(self, cls):
+      e = self.get_sub_by_cls(cls)
+      if not (e is None):
+         return e.val
+   
+   def get_subl_by_cls(self, cls):
+      for e in self._iter_sub():
+         if (isinstance(e, cls)):
+            yield e
+   
+   def iter_clusters(self, start=0):
+      """Iterate over our clusters; for segments read from a file, each one is read from disk as it's reached.
+      
+      If specified, start is the segment position (as used in SeekHeads and Cues) to begin reading at."""
+      for e in self._iter_sub(start):
+         if (isinstance(e, MatroskaElementCluster)):
+            yield e
+   
+   @staticmethod
+   def _get_default_dur(te, tcs):
+      """Return default frame duration of TrackEntry te in units of segment timecode scale tcs, or None."""
+      default_dur = te.get_subval_by_cls(MatroskaElementDefaultDuration)
+      if (default_dur is None):
+         return None
+      return round(default_dur/tcs)
+   
+   @staticmethod
+   def _iter_cluster_frames(c, default_durs, block_skip=0, skip_tracks=None):
+      """Iterate over (tracknum, frame) pairs for all frames in cluster c of tracks in default_durs.
+      
+      Frames of tracks in skip_tracks (default: all tracks) are dropped from the first block_skip blocks of the cluster.
+      Laced frames after the first of their block get a timecode of None if their duration is unknown."""
+      tc = c.get_subval_by_cls(MatroskaElementTimecode)
+      for bc in c.get_subl_by_cls((MatroskaElementSimpleBlock, MatroskaElementBlockGroup)):
+         skip = (block_skip > 0)
+         if (skip):
+            block_skip -= 1
+            if (skip_tracks is None):
+               continue
+         block = bc.get_block()
+         (btn, btc, lacing, frame_count, hdrlen) = block._get_hd()
+         if ((not (btn in default_durs)) or (skip and (btn in skip_tracks))):
+            continue
+         
+         dur = bc.get_dur()
+         if not (dur is None):
+            dur = round(dur/frame_count)
+         else:
+            dur = default_durs[btn]
+         
+         is_kf = bc.is_keyframe()
+         ftc = tc + btc
+         for frame_data in block:
+            yield (btn, (ftc, dur, frame_data, is_kf))
+            if (dur is None):
+               ftc = None
+            elif not (ftc is None):
+               ftc += dur
+   
+   def _iter_frames(self, tn, default_dur):
+      dds = {tn:default_dur}
+      for c in self.iter_clusters():
+         for (btn, frame) in self._iter_cluster_frames(c, dds):
+            yield frame
+   
    def make_mkvb(self):
       info = self.get_sub_by_cls(MatroskaElementInfo)
       
@@ -593,7 +801,10 @@ class MatroskaElementSegment(MatroskaElementMaster):
       tracks.sort(key=lambda t:t.get_subval_by_cls(MatroskaElementTrackNumber))
       
       cue_track_set = set()
-      for cp in self.get_sub_by_cls(MatroskaElementCues).sub:
+      default_durs = {}
+      demux = _SegmentDemuxer(self, default_durs)
+      cues = self.get_sub_by_cls(MatroskaElementCues)
+      for cp in (() if (cues is None) else cues.sub):
          for ctp in cp.get_subl_by_cls(MatroskaElementCueTrackPositions):
             tn = ctp.get_subval_by_cls(MatroskaElementCueTrack)
             cue_track_set.add(tn)
@@ -601,31 +812,73 @@ class MatroskaElementSegment(MatroskaElementMaster):
       for te in tracks:
          te_cp = deepcopy(te)
          tn = te.get_subval_by_cls(MatroskaElementTrackNumber)
-         default_dur = te.get_subval_by_cls(MatroskaElementDefaultDuration)
-         if (default_dur is None):
-            sdd = None
-         else:
-            sdd = round(default_dur/tcs)
-         
-         
-         mb.add_track_by_entry(self._iter_frames(tn, sdd), te_cp, make_cues=(tn in cue_track_set))
+         default_durs[tn] = self._get_default_dur(te, tcs)
+         mb.add_track_by_entry(demux.iter_frames(tn), te_cp, make_cues=(tn in cue_track_set))
       
       return mb
    
    def write_to_file(self, c):
-      rv = self._write_header(c, MatroskaVInt(sum(e.get_size() for e in self.sub)))
-      c.seg_off = c.f.tell()
+      rv = self._write_header(c, self._get_body_size())
+      c.seg_off = c.tell()
       for e in self.sub:
          rv += e.write_to_file(c)
       return rv
 
+class _SegmentDemuxer:
+   """Splits the frames of a segment into per-track queues.
+   
+   Clusters are read one at a time, whenever the iterator of a track runs out of queued frames; this way each cluster
+   is only parsed once, and only the frames between the positions of the slowest and fastest track readers are kept
+   around."""
+   def __init__(self, seg, default_durs):
+      self._clusters = seg.iter_clusters()
+      self._default_durs = default_durs
+      self._queues = {}
+      self._tcs_last = {}
+   
+   def _read_cluster(self):
+      for c in self._clusters:
+         break
+      else:
+         return False
+      
+      queues = self._queues
+      tcs_last = self._tcs_last
+      for (tn, frame) in MatroskaElementSegment._iter_cluster_frames(c, self._default_durs):
+         if (frame[0] is None):
+            # Laced frame of unknown duration. MatroskaBuilder laces those again, keeping only the timecode of the first
+            # frame in each block; so any timecode that keeps them in order will do.
+            frame = (tcs_last[tn],) + frame[1:]
+         else:
+            tcs_last[tn] = frame[0]
+         queues.setdefault(tn, deque()).append(frame)
+      return True
+   
+   def iter_frames(self, tn):
+      q = self._queues.setdefault(tn, deque())
+      while (True):
+         while (q):
+            yield q.popleft()
+         if not (self._read_cluster()):
+            break
+
 @_mkv_type_reg
 class MatroskaElementSeekHead(MatroskaElementMaster):
    type = EBMLVInt(21863284)
+   @classmethod
+   def new(cls, entries):
+      """Build seekhead from sequence of (element type, segment offset) pairs."""
+      return super().new([MatroskaElementSeek.new(etype, off) for (etype, off) in entries])
 
 @_mkv_type_reg
 class MatroskaElementSeek(MatroskaElementMaster):
    type = EBMLVInt(3515)
+   @classmethod
+   def new(cls, etype, off):
+      return super().new([
+         MatroskaElementSeekID.new(bytes(etype.get_bindata())),
+         MatroskaElementSeekPosition.new(off)
+      ])
 
 @_mkv_type_reg
 class MatroskaElementInfo(MatroskaElementMaster):
@@ -646,7 +899,7 @@ class MatroskaElementCluster(MatroskaElementMaster):
    
    def write_to_file(self, c):
       if not (c.callback_cluster is None):
-         c.callback_cluster(self, c.f.tell() - c.seg_off)
+         c.callback_cluster(self, c.tell() - c.seg_off)
       return super().write_to_file(c)
    
    def _get_tc(self):
@@ -699,6 +952,7 @@ class MatroskaElementTracks(MatroskaElementMaster):
          id2 = t.get_sub_by_cls(MatroskaElementTrackUID)
          rv[id1.val] = MatroskaVInt(i + 1)
          id1.val = id2.val = i + 1
+         t._size_changed()
       return rv
    
    def get_track(self, idx):
@@ -765,15 +1019,16 @@ class MatroskaElementCues(MatroskaElementMaster):
    type = EBMLVInt(206814059)
    def write_to_file(self, c):
       if not (c.callback_cues is None):
-         c.callback_cues(c.f.tell())
+         c.callback_cues(c.tell())
       
       return super().write_to_file(c)
    
-   def update_ccps(self, co_map):
-      for cp in self.sub:
-         for ctp in cp.get_subl_by_cls(MatroskaElementCueTrackPositions):
-            ccp = ctp.get_sub_by_cls(MatroskaElementCueClusterPosition)
-            ccp.val = co_map[ccp._clust_id]
+   @classmethod
+   def new(cls, cues):
+      """Build cues from sequence of (timecode, track number, cluster offset, block number) tuples, sorted by timecode.
+      
+      The cue point elements are generated from the tuples whenever they're iterated over, instead of being kept around."""
+      return super().new(_CuePointSeq(cues))
 
 @_mkv_type_reg
 class MatroskaElementCuePoint(MatroskaElementMaster):
@@ -787,16 +1042,30 @@ class MatroskaElementCueTrackPositions(MatroskaElementMaster):
    type = EBMLVInt(55)
    
    @classmethod
-   def new(cls, tracknum, clust_id, cbn):
-      ccp = MatroskaElementCueClusterPosition.new()
-      ccp._clust_id = clust_id
+   def new(cls, tracknum, c_off, cbn):
       rv = super().new([
          MatroskaElementCueTrack.new(tracknum),
-         ccp,
+         MatroskaElementCueClusterPosition.new(c_off),
          MatroskaElementCueBlockNumber.new(cbn),
       ])
       return rv
 
+class _CuePointSeq:
+   def __init__(self, cues):
+      self._cues = cues
+   
+   def __iter__(self):
+      cp = None
+      for (tc, tn, c_off, bn) in self._cues:
+         if ((cp is None) or (tc != cp_tc)):
+            if not (cp is None):
+               yield cp
+            cp = MatroskaElementCuePoint.new(tc)
+            cp_tc = tc
+         cp.sub.append(MatroskaElementCueTrackPositions.new(tn, c_off, bn))
+      if not (cp is None):
+         yield cp
+
 @_mkv_type_reg
 class MatroskaElementCueReference(MatroskaElementMaster):
    type = EBMLVInt(1)
@@ -864,7 +1133,11 @@ class MatroskaElementVoid(MatroskaElementBinary):
    def __init__(self, *args, **kwargs):
       super().__init__(*args, **kwargs)
       self._bd_size = MatroskaVInt(self.data_r.get_size())
-      
+   
+   def get_size(self):
+      bd_size = self._get_body_size()
+      return (self.type.size + bd_size.size + bd_size)
+   
    def _get_body_size(self):
       rv = self._bd_size
       if (rv != self.data_r.get_size()):
@@ -911,11 +1184,15 @@ class MatroskaElementVoid(MatroskaElementBinary):
 class MatroskaElementSegmentUID(MatroskaElementBinary):
    type = EBMLVInt(13220)
 
+@_mkv_type_reg
+class MatroskaElementSeekID(MatroskaElementBinary):
+   type = EBMLVInt(5035)
+
 class MatroskaElementBlockBase(MatroskaElementBinary):
    type = EBMLVInt(33)
    def _get_hd(self):
       data = self.data_r.get_data()
-      (tn,off) = MatroskaVInt.build_from_bindata(data)
+      (tn,off) = _vint_decode(data)
       (tc,flags) = struct.unpack('>hB', data[off:off+3])
       lacing = (flags >> 1) & 3
       off += 3
@@ -926,13 +1203,20 @@ class MatroskaElementBlockBase(MatroskaElementBinary):
       off += 1
       return (tn, tc, lacing, frame_count, off)
    
+   def _get_frame_ref(self, data, off, size):
+      data_r = self.data_r
+      if (isinstance(data_r, DataRefFile)):
+         # Keep frames of blocks read from a file on disk until they're needed.
+         return DataRefFile(data_r.f, data_r.off + off, size)
+      return DataRefMemoryView(data[off:off+size])
+   
    def __iter__(self):
       data = memoryview(self.data_r.get_data())
       (tn, tc, lacing, frame_count, off) = self._get_hd()
       ldata = len(data)
       
       if (lacing == 0):
-         yield DataRefMemoryView(data[off:])
+         yield self._get_frame_ref(data, off, ldata-off)
          return
       
       elif (lacing == 1):
@@ -956,11 +1240,11 @@ class MatroskaElementBlockBase(MatroskaElementBinary):
 
       else: # lacing == 3
          frame_lengths = [None]*(frame_count-1)
-         (frame_lengths[0],off_i) = MatroskaVInt.build_from_bindata(data[off:])
+         (frame_lengths[0],off_i) = _vint_decode(data, off)
          off += off_i
          
          for i in range(frame_count-2):
-            (sval, off_i) = MatroskaSVInt.build_from_bindata(data[off:])
+            (sval, off_i) = _vint_decode(data, off, True)
             frame_lengths[i+1] = sval + frame_lengths[i]
             off += off_i
 
@@ -968,9 +1252,9 @@ class MatroskaElementBlockBase(MatroskaElementBinary):
          raise MatroskaError('Bogus lacing: {0} bytes header, and alleged frame size list {1} in {2} bytes.'.format(off, frame_lengths, len(data)))
 
       for frame_len in frame_lengths:
-         yield DataRefMemoryView(data[off:off+frame_len])
+         yield self._get_frame_ref(data, off, frame_len)
          off += frame_len
-      yield DataRefMemoryView(data[off:])
+      yield self._get_frame_ref(data, off, ldata-off)
         
 
 @_mkv_type_reg
@@ -988,7 +1272,7 @@ class MatroskaElementSimpleBlock(MatroskaElementBlockBase):
       
    def is_keyframe(self):
       data = self.data_r.get_data()
-      off = MatroskaVInt.build_from_bindata(data)[1]
+      off = _vint_decode(data)[1]
       return bool(data[off+2] >> 7)
 
 @_mkv_type_reg
@@ -1016,7 +1300,7 @@ class MatroskaElementBlock_r(MatroskaElement):
       self.type = etype
       
       struct.pack(self._bfmt_subhdr, timecode, flags)
-      self.tracknum = MatroskaVInt(tracknum)
+      self.tracknum = tracknum
       self.timecode = timecode
       self.flags = flags
       self.frame_data = frame_data
@@ -1035,8 +1319,8 @@ class MatroskaElementBlock_r(MatroskaElement):
       return cls(MatroskaElementSimpleBlock.type, tracknum, timecode, flags, keyframe, *args, **kwargs)
    
    def get_size(self):
-      bd_size = self._bfmt_subhdr_len + self.tracknum.size + self._get_lacehdr_size() + self._get_data_size()
-      return (self.type.size + MatroskaVInt(bd_size).size + bd_size)
+      bd_size = self._bfmt_subhdr_len + _vint_size(self.tracknum) + self._get_lacehdr_size() + self._get_data_size()
+      return (self.type.size + _vint_size(bd_size) + bd_size)
    
    def _get_data_size(self):
       return sum(d.get_size() for d in self.frame_data)
@@ -1061,15 +1345,15 @@ class MatroskaElementBlock_r(MatroskaElement):
       flags = self.flags & ~6
       if not (ld is None):
          flags |= self._LT_MAP[ld.LT] << 1
-      shdr = b''.join((self.tracknum.get_bindata(), struct.pack(self._bfmt_subhdr, self.timecode, flags), lh))
+      shdr = b''.join((_vint_bytes(self.tracknum), struct.pack(self._bfmt_subhdr, self.timecode, flags), lh))
       bd_sz = len(shdr) + ls + self._get_data_size()
       
-      hl = self._write_header(c, MatroskaVInt(bd_sz))
-      bl = c.f.write(shdr)
+      hl = self._write_header(c, bd_sz)
+      bl = c.write(shdr)
       if not (ld is None):
          bl += ld.write_to_file(c)
       for data_r in self.frame_data:
-         bl += c.f.write(data_r.get_data())
+         bl += c.write(data_r.get_data())
       
       if (bl != bd_sz):
          raise IOError()
@@ -1108,6 +1392,10 @@ class EBMLElementDocTypeReadVersion(MatroskaElementUInt):
 class MatroskaElementPrevSize(MatroskaElementUInt):
    type = EBMLVInt(43)
 
+@_mkv_type_reg
+class MatroskaElementSeekPosition(MatroskaElementUInt):
+   type = EBMLVInt(5036)
+
 @_mkv_type_reg
 class MatroskaElementFlagLacing(MatroskaElementUInt):
    type = EBMLVInt(28)
@@ -1302,10 +1590,73 @@ class MatroskaCodec(str):
       return cls(cls.CODEC_ID2MKV[codec_id])
 
 class _OutputCtx:
+   """Output sink for element serialization.
+   
+   Written data is kept by reference, and handed to the OS in large batches using os.writev() (where available), so
+   element headers don't cost a write call each and frame payloads don't get copied into an intermediate buffer. Only
+   the ctx methods may be used for output and positioning while it's in use; the file position is brought up to date
+   by flush() and seek()."""
+   buf_size = 1024*1024
+   try:
+      iov_max = os.sysconf('SC_IOV_MAX')
+   except (AttributeError, ValueError, OSError):
+      iov_max = 16
+   
    def __init__(self, f):
       self.f = f
       self.callback_cluster = None
       self.callback_cues = None
+      self._fd = None
+      if (hasattr(os, 'writev')):
+         try:
+            self._fd = f.fileno()
+         except (AttributeError, io.UnsupportedOperation):
+            pass
+      
+      f.flush()
+      self._off = f.tell()
+      self._iov = []
+      self._iov_len = 0
+   
+   def tell(self):
+      return self._off + self._iov_len
+   
+   def write(self, data):
+      self._iov.append(data)
+      self._iov_len += len(data)
+      if (self._iov_len >= self.buf_size):
+         self.flush()
+      return len(data)
+   
+   def seek(self, off):
+      self.flush()
+      self._off = self.f.seek(off)
+      return self._off
+   
+   def _writev(self, iov):
+      while (iov):
+         done = os.writev(self._fd, iov[:self.iov_max])
+         if (done <= 0):
+            raise IOError('writev() made no progress.')
+         
+         i = 0
+         while ((i < len(iov)) and (done >= len(iov[i]))):
+            done -= len(iov[i])
+            i += 1
+         iov = iov[i:]
+         if (done):
+            iov[0] = memoryview(iov[0])[done:]
+   
+   def flush(self):
+      if (self._fd is None):
+         for data in self._iov:
+            self.f.write(data)
+      else:
+         self._writev(self._iov)
+      
+      self._off += self._iov_len
+      self._iov = []
+      self._iov_len = 0
 
 class MatroskaFrame:
    def __init__(self, timecode, flags, tc_dependencies, data_r, dur=None):
@@ -1360,80 +1711,59 @@ class BitmapInfoHeader:
          struct.pack('>L', self.codec), 0, self.x_ppm, self.y_ppm, 0, 0)
 
 class _LaceLengthSeq(deque):
-   pass
+   """Sequence of encoded lace frame sizes."""
+   def get_size(self):
+      return sum(len(e) for e in self)
+   
+   def write_to_file(self, c):
+      return c.write(b''.join(self))
 
 class _LaceLengthSeqEBML(_LaceLengthSeq):
    LT = _MATROSKA_LT_EBML
    @classmethod
-   def build_from_frames(cls, frames):
-      sz_prev = frames[0].data_r.get_size()
-      rv = cls((MatroskaVInt(sz_prev),))
-      for frame in frames[1:-1]:
-         sz = frame.data_r.get_size()
-         rv.append(MatroskaSVInt(sz - sz_prev))
+   def build_from_sizes(cls, sizes):
+      sz_prev = sizes[0]
+      rv = cls((_vint_bytes(sz_prev),))
+      for sz in sizes[1:-1]:
+         rv.append(MatroskaSVInt(sz - sz_prev).get_bindata())
          sz_prev = sz
       return rv
-   
-   def get_size(self):
-      return sum(i.size for i in self)
-   
-   def write_to_file(self, c):
-      rv = 0
-      for e in self:
-         rv += e.write_to_file(c)
-      return rv
 
 class _LaceLengthSeqXiph(_LaceLengthSeq):
    LT = _MATROSKA_LT_XIPH
    @classmethod
-   def build_from_frames(cls, frames):
+   def build_from_sizes(cls, sizes):
       rv = cls()
-      for frame in frames[:-1]:
-         (pl, mod) = divmod(frame.data_r.get_size(),255)
+      for sz in sizes[:-1]:
+         (pl, mod) = divmod(sz,255)
          rv.append(b'\xFF'*pl + struct.pack('>B', mod))
    
       return rv
-   
-   def get_size(self):
-      return sum(len(e) for e in self)
-   
-   def write_to_file(self, c):
-      rv = 0
-      for e in self:
-         rv += c.f.write(e)
-      return rv
 
 
 class _FrameQueue:
+   """Frame source for one track, pulling frames from the underlying iterator as they're needed.
+
+   Only a single frame of lookahead is kept; lacing decisions are made per block, based on the frames that go into it."""
    def __init__(self, frames, lace_mask):
-      self._f = frames
-      self._i = 0
-      self._lm = lace_mask
-      
-      if (frames):
-         if (self._lm):
-            dur = frames[0].dur
-            for frame in frames[1:]:
-               if (frame.dur != dur):
-                  self._lm = False
-                  break
-       
-         if (self._lm & _MATROSKA_LT_FIXED):
-            sz = frames[0].dur
-            for frame in frames[1:]:
-               if (frame.data_r.get_size() != sz):   
-                  self._lm &= ~_MATROSKA_LT_FIXED
-                  break
+      self._f = iter(frames)
+      # Fixed-size lacing is currently unimplemented.
+      self._lm = lace_mask & ~_MATROSKA_LT_FIXED
+      self._next = None
+      self._pop_frame()
    
    def __bool__(self):
-      return (self._i < len(self._f))
+      return not (self._next is None)
    
    def get_frame(self):
-      return self._f[self._i]
+      return self._next
    
    def _pop_frame(self):
-      rv = self._f[self._i]
-      self._i += 1
+      rv = self._next
+      try:
+         self._next = self._f.__next__()
+      except StopIteration:
+         self._next = None
       return rv
       
    def make_blockthing(self, lace_limit, *args, **kwargs):
@@ -1441,35 +1771,88 @@ class _FrameQueue:
       frame0 = self._pop_frame()
       kf = frame0.is_keyframe()
       bt = frame0.build_blockthing(*args, **kwargs)
+      # Only SimpleBlocks are laced; frames with explicit durations each get their own BlockGroup.
+      if ((not self._lm) or (not (frame0.dur is None))):
+         return bt
+      
       fl = [frame0]
-      if (self._lm):
-         while (self and (len(fl) < ll)):
-            frame = self._pop_frame()
-            if (frame.is_keyframe() != kf):
-               self._i -= 1
-               break
-            fl.append(frame)
-      
-      if ((not self._lm) or (len(fl) <= 1)):
+      while (self and (len(fl) < ll)):
+         frame = self.get_frame()
+         if ((frame.is_keyframe() != kf) or (not (frame.dur is None))):
+            break
+         fl.append(self._pop_frame())
+      
+      if (len(fl) <= 1):
          return bt
       
-      if (self._lm & _MATROSKA_LT_FIXED):
-         lt = _MATROSKA_LT_FIXED
-      else:
-         lls = None
-         for lls_cls in (_LaceLengthSeqXiph, _LaceLengthSeqEBML):
-            if not (lls_cls.LT & self._lm):
-               continue
-            lls_n = lls_cls.build_from_frames(fl)
-            if ((lls is None) or (lls_n.get_size() < lls.get_size())):
-               lls = lls_n
-         
-         if (lls is None):
-            raise MatroskaError("Lacing type choosing failed. :( This shouldn't happen, and indicates a bug in yavdlt.")
-
-      bt.lace_data = lls
+      bt.lace_data = self._make_lace_data([frame.data_r.get_size() for frame in fl])
       bt.frame_data = [frame.data_r for frame in fl]
       return bt
+   
+   def _make_lace_data(self, sizes):
+      lls = None
+      for lls_cls in (_LaceLengthSeqXiph, _LaceLengthSeqEBML):
+         if not (lls_cls.LT & self._lm):
+            continue
+         lls_n = lls_cls.build_from_sizes(sizes)
+         if ((lls is None) or (lls_n.get_size() < lls.get_size())):
+            lls = lls_n
+      
+      if (lls is None):
+         raise MatroskaError("Lacing type choosing failed. :( This shouldn't happen, and indicates a bug in yavdlt.")
+      return lls
+
+
+class _FrameTableQueue(_FrameQueue):
+   """Frame source for one track backed by a FrameTable.
+   
+   Frame objects are only built for the first frame of each block; which frames to lace with it is decided from the
+   table's columns directly."""
+   def __init__(self, ft, lace_mask):
+      self._ft = ft
+      self._lm = lace_mask & ~_MATROSKA_LT_FIXED
+      self._i = 0
+      self._next = None
+      self._load_frame()
+   
+   def __bool__(self):
+      return (self._i < len(self._ft))
+   
+   def _load_frame(self):
+      i = self._i
+      ft = self._ft
+      if (i >= len(ft)):
+         self._next = None
+         return
+      if ((i == 0) or ft.is_keyframe(i)):
+         tc_dependencies = ()
+      else:
+         tc_dependencies = (ft.tc[i-1] - ft.tc[i],)
+      self._next = MatroskaFrame(ft.tc[i], 0, tc_dependencies, ft.get_data_r(i), ft.get_dur(i))
+   
+   def make_blockthing(self, lace_limit, *args, **kwargs):
+      ft = self._ft
+      i = self._i
+      frame0 = self._next
+      bt = frame0.build_blockthing(*args, **kwargs)
+      
+      j = i + 1
+      # Only SimpleBlocks are laced; frames with explicit durations each get their own BlockGroup.
+      if (self._lm and (frame0.dur is None)):
+         j_lim = min(i + min(lace_limit, 256), len(ft))
+         kf = frame0.is_keyframe()
+         dur_col = ft.dur
+         DUR_NONE = ft.DUR_NONE
+         while ((j < j_lim) and (dur_col[j] == DUR_NONE) and (ft.is_keyframe(j) == kf)):
+            j += 1
+      
+      if (j - i > 1):
+         bt.lace_data = self._make_lace_data(ft.size[i:j])
+         bt.frame_data = [ft.get_data_r(k) for k in range(i, j)]
+      
+      self._i = j
+      self._load_frame()
+      return bt
 
 
 class MatroskaBuilder:
@@ -1533,6 +1916,8 @@ class MatroskaBuilder:
       
       self.tcs = tcs
       self.tracks = MatroskaElementTracks.new([])
+      # Additional top-level elements (Attachments, Chapters, Tags, ...) to write ahead of the clusters.
+      self.elements_extra = []
       self.frames = {}
       self.lace_mask = lace_mask
    
@@ -1545,19 +1930,14 @@ class MatroskaBuilder:
    def set_track_name(self, tid, name):
       self.tracks.sub[tid].set_sub(MatroskaElementName.new(name))
    
+   def add_element(self, e):
+      """Add top-level element e (e.g. Attachments or Tags) to the segment, replacing any earlier one of its type."""
+      self.elements_extra = [e2 for e2 in self.elements_extra if (e2.type != e.type)]
+      self.elements_extra.append(e)
+   
    def _get_muxapp(self):
       return 'yavdlt.mcio_matroska pre-versioning-version'
    
-   def _add_frame(self, tracknum, *args, **kwargs):
-      frame = MatroskaFrame(*args, **kwargs)
-      try:
-         fl = self.frames[tracknum]
-      except KeyError:
-         fl = self.frames[tracknum] = []
-      
-      fl.append(frame)
-      return frame
-   
    def get_tracks_by_type(self, tt):
       return [t for t in self.tracks.sub if (t.get_track_type() == tt)]
    
@@ -1565,16 +1945,30 @@ class MatroskaBuilder:
       del(self.tracks.sub[tid-1])
       del(self.frames[tid])
    
-   def _build_clusters(self):
+   def _build_clusters(self, cues):
+      """Interleave frames from all tracks into clusters, yielding each cluster as soon as it's complete.
+      
+      Cue entries are appended to cues as (timecode, track number, cluster index, block number) tuples; block numbers
+      count from 1, as per the matroska spec."""
       frames = {}
       for (key, val) in self.frames.items():
-         frames[key] = _FrameQueue(val, self.lace_mask)
+         if (isinstance(val, FrameTable)):
+            fq = _FrameTableQueue(val, self.lace_mask)
+         else:
+            fq = _FrameQueue(val, self.lace_mask)
+         if (fq):
+            frames[key] = fq
+      
+      # K-way merge of the tracks: a heap of (next frame timecode, track number) entries, with one entry per track that
+      # has frames left. Ties go to the lower track number.
+      heap = [(fq.get_frame().tc, tn) for (tn, fq) in frames.items()]
+      heapq.heapify(heap)
       
-      clusters = deque()
-      cues = {}
       c = None
+      c_idx = -1
       c_max = -1
       c_min = 0
+      c_blockcount = 0
       
       tlen_c = self.TLEN_CLUSTER
       if (self.bc_old_mplayer or self.bc_vlc):
@@ -1588,15 +1982,15 @@ class MatroskaBuilder:
          tlen_c = min(tlen_c, int(5*10**9/self.tcs))
       
       def add_cluster(tc):
-         nonlocal c, c_max, c_min
+         nonlocal c, c_idx, c_max, c_min, c_blockcount
          c2 = MatroskaElementCluster.new(tc+self.TOFF_CLUSTER)
          if not (c is None):
             c2.set_sub(MatroskaElementPrevSize.new(c.get_size()))
          c = c2
-         clusters.append(c)
+         c_idx += 1
          c_min = c._tc - 2**15
          c_max = c_min + tlen_c - 1
-         c.__blockcount = 0
+         c_blockcount = 0
       
       if (self.bc_old_mplayer):
          # Older mplayer is a big baby about this, using the base timecode of the first cluster in a segment to set the
@@ -1606,20 +2000,18 @@ class MatroskaBuilder:
          # This code works around that bug by aligning the base TC of the first cluster with the TC of our earliest frame, at
          # the cost of leaving half of the possible timecodes in that cluster unusuable and therefore slightly increasing mkv
          # file size on average.
-         try:
-            frame_tc_min = min(min(f.tc for f in frame_list) for frame_list in self.frames.values())
-         except ValueError:
-            pass
-         else:
-            add_cluster(-self.TOFF_CLUSTER+frame_tc_min)
+         if (heap):
+            add_cluster(-self.TOFF_CLUSTER+heap[0][0])
       
-      while (frames):
-         (tn, tframes) = min(frames.items(), key=lambda x:x[1].get_frame().tc)
+      while (heap):
+         (tc, tn) = heap[0]
+         tframes = frames[tn]
          track = self.tracks.get_track(tn)
          frame0 = tframes.get_frame()
-         tc = frame0.tc
          
          if ((tc > c_max) or (tc < c_min)):
+            if not (c is None):
+               yield c
             add_cluster(tc)
          
          if (track._lacing):
@@ -1627,24 +2019,21 @@ class MatroskaBuilder:
          else:
             bt = tframes.make_blockthing(1, tn, c._tc)
          
-         if (not tframes):
+         if (tframes):
+            heapq.heapreplace(heap, (tframes.get_frame().tc, tn))
+         else:
+            heapq.heappop(heap)
             del(frames[tn])
          
          #c.sub.append(frame.build_blockthing(tn, c._tc))
          c.sub.append(bt)
-         c.__blockcount += 1
+         c_blockcount += 1
          
          if (frame0.is_keyframe() and track._make_cues):
-            # Make cue entry.
-            try:
-               cp = cues[tc]
-            except KeyError:
-               cp = cues[tc] = MatroskaElementCuePoint.new(tc)
-
-            ctp = MatroskaElementCueTrackPositions.new(tn, id(c), c.__blockcount-1)
-            cp.sub.append(ctp)
-         
-      return (clusters, cues)
+            cues.append((tc, tn, c_idx, c_blockcount))
+      
+      if not (c is None):
+         yield c
 
    @classmethod
    def tcs_from_secdiv(cls, sdiv:int, td_gcd:int, error_lim:float=None) -> ('tcs','elmult','error'):
@@ -1770,7 +2159,8 @@ class MatroskaBuilder:
       self.tracks.sub.append(te)
       return (track_num, te)
    
-   def _add_track_data(self, track_num, data):
+   @staticmethod
+   def _iter_track_frames(data):
       tv_prev = None
       for (tv, dur, data_r, is_keyframe) in data:
          if ((is_keyframe) or (tv_prev is None)):
@@ -1778,9 +2168,16 @@ class MatroskaBuilder:
          else:
             tc_dependencies = (tv_prev-tv,)
          
-         frame = self._add_frame(track_num, tv, 0, tc_dependencies, data_r, dur)
+         yield MatroskaFrame(tv, 0, tc_dependencies, data_r, dur)
          tv_prev = tv
    
+   def _add_track_data(self, track_num, data):
+      # Frame data isn't read until we write the file, so memory use doesn't scale with track length.
+      if (isinstance(data, FrameTable)):
+         self.frames[track_num] = data
+      else:
+         self.frames[track_num] = self._iter_track_frames(data)
+   
    def add_track_by_entry(self, data, te, make_cues):
       """Add track specified by existing MatroskaElementTrackEntry to MKV structure.
       
@@ -1813,22 +2210,40 @@ class MatroskaBuilder:
       self.frames = frames_new
    
    def write_to_file(self, f):
-      (clusters, cues) = self._build_clusters()
-      cue_tvs = sorted(cues.keys())
-      # Void elements have a minimum size of two. We insert one here because if we didn't, we might end up with exactly
-      # one byte of empty space after the cues size adjustment, and would be unable to fill it with a seperate void element
-      # otherwise.
-      cues = MatroskaElementCues.new([cues[tv] for tv in cue_tvs] + [MatroskaElementVoid.new_by_size(2)])
-      seg_sub = [self.mkv_info, self.tracks, cues]
-      seg_sub.extend(clusters)
-      seg = MatroskaElementSegment.new(seg_sub)
+      """Write MKV data to seekable filelike.
       
+      Clusters are written as soon as they're complete, and the cues follow them. A seekhead at the beginning of the
+      segment points at the cues and all other top-level elements except for the clusters; space for it is reserved up
+      front, and it's filled in together with the segment size once everything else has been written."""
       ctx = _OutputCtx(f)
       self.ebml_hdr.write_to_file(ctx)
-      clust_offs = {}
       
+      seg = MatroskaElementSegment.new([])
+      seg_size = MatroskaVInt(0)
+      seg_size.size = 8
+      off_seg = ctx.tell()
+      seg._write_header(ctx, seg_size)
+      ctx.seg_off = ctx.tell()
+      
+      els_head = [self.mkv_info, self.tracks] + self.elements_extra
+      # Positions are unknown at this point, so size the seekhead for the largest ones possible.
+      # Void elements have a minimum size of two. We insert one here because if we didn't, we might end up with exactly
+      # one byte of empty space after the seekhead size adjustment, and would be unable to fill it with a seperate void
+      # element otherwise.
+      sh = MatroskaElementSeekHead.new([(e.type, (1 << 64) - 1) for e in els_head] +
+         [(MatroskaElementCues.type, (1 << 64) - 1)])
+      sh.sub.append(MatroskaElementVoid.new_by_size(2))
+      sh_sz_base = sh.get_size()
+      MatroskaElementVoid.new_by_size(sh_sz_base).write_to_file(ctx)
+      
+      seeks = []
+      for e in els_head:
+         seeks.append((e.type, ctx.tell() - ctx.seg_off))
+         e.write_to_file(ctx)
+      
+      clust_offs = []
       def cc(clust, off):
-         clust_offs[id(clust)] = off
+         clust_offs.append(off)
       
       cue_off = None
       def ccues(off):
@@ -1838,24 +2253,163 @@ class MatroskaBuilder:
       ctx.callback_cluster = cc
       ctx.callback_cues = ccues
       
-      cues_sz_base = cues.get_size()
-      seg.write_to_file(ctx)
-      cues.remove_subvals_by_cls(MatroskaElementVoid)
+      cue_entries = []
+      for clust in self._build_clusters(cue_entries):
+         clust.write_to_file(ctx)
+      
+      cue_entries.sort(key=lambda e:e[0])
+      if (cue_entries):
+         cue_entries = [(tc, tn, clust_offs[c_idx], bn) for (tc, tn, c_idx, bn) in cue_entries]
+         cues = MatroskaElementCues.new(cue_entries)
+         cues.write_to_file(ctx)
+         seeks.append((MatroskaElementCues.type, cue_off - ctx.seg_off))
       
       ctx.callback_cluster = None
       ctx.callback_cues = None
       
-      cues.update_ccps(clust_offs)
+      off_end = ctx.tell()
+      seg_size = MatroskaVInt(off_end - ctx.seg_off)
+      seg_size.size = 8
+      ctx.seek(off_seg)
+      seg._write_header(ctx, seg_size)
+      
+      sh = MatroskaElementSeekHead.new(seeks)
+      sh_sz = sh.write_to_file(ctx)
+      if (sh_sz > sh_sz_base):
+         raise MatroskaError("Seekhead size guessing failed. :( This shouldn't happen, and indicates a bug in yavdlt.")
+      if (sh_sz < sh_sz_base):
+         MatroskaElementVoid.new_by_size(sh_sz_base - sh_sz).write_to_file(ctx)
+      ctx.seek(off_end)
+
+# ---------------------------------------------------------------- File reading
+class MatroskaReader:
+   """Random access to the frames of a matroska file, based on its Cues.
+   
+   Only the EBML header and the SeekHead, Info, Tracks and Cues elements of the segment are parsed up front; clusters
+   are read from disk when frames from them are requested."""
+   def __init__(self, f):
+      self.f = f
+      self.header = None
+      self.seg = None
+      f.seek(0)
+      for el in ebml_ns_mkv.build_seq_from_file(f):
+         if (isinstance(el, EBMLHeader)):
+            self.header = el
+         elif (isinstance(el, MatroskaElementSegment)):
+            self.seg = el
+            break
+      else:
+         raise MatroskaError('No segment in MKV file {0!a}.'.format(f))
+      
+      info = self.seg.get_sub_by_cls(MatroskaElementInfo)
+      if (info is None):
+         raise MatroskaError('No Info element in MKV segment.')
+      self.tcs = info.get_subval_by_cls(MatroskaElementTimecodeScale) or 1000000
+      dur = info.get_subval_by_cls(MatroskaElementDuration)
+      if not (dur is None):
+         dur = dur*self.tcs/10**9
+      self.dur = dur
       
-      f.seek(cue_off)
-      l = cues.write_to_file(ctx)
-      cues_sz = cues.get_size()
-      if (cues_sz > cues_sz_base):
-         raise MatroskaError("Cues size guessing failed. :( This shouldn't happen, and indicates a bug in yavdlt.")
-      if (cues_sz < cues_sz_base):
-         f.seek(cue_off+cues_sz)
-         void = MatroskaElementVoid.new_by_size(cues_sz_base - cues_sz)
-         void.write_to_file(ctx)
+      self.tracks = {}
+      self.default_durs = {}
+      track_c = self.seg.get_sub_by_cls(MatroskaElementTracks)
+      for te in (() if (track_c is None) else track_c.get_subl_by_cls(MatroskaElementTrackEntry)):
+         tn = te.get_subval_by_cls(MatroskaElementTrackNumber)
+         self.tracks[tn] = te
+         self.default_durs[tn] = MatroskaElementSegment._get_default_dur(te, self.tcs)
+      
+      # List of (timecode, track number, segment position of cluster, block number) tuples, sorted by timecode.
+      self.cues = []
+      cues = self.seg.get_sub_by_cls(MatroskaElementCues)
+      for cp in (() if (cues is None) else cues.get_subl_by_cls(MatroskaElementCuePoint)):
+         ct = cp.get_subval_by_cls(MatroskaElementCueTime)
+         for ctp in cp.get_subl_by_cls(MatroskaElementCueTrackPositions):
+            bn = ctp.get_subval_by_cls(MatroskaElementCueBlockNumber)
+            if (bn is None):
+               bn = 1
+            self.cues.append((ct, ctp.get_subval_by_cls(MatroskaElementCueTrack),
+               ctp.get_subval_by_cls(MatroskaElementCueClusterPosition), bn))
+      self.cues.sort(key=lambda c:c[0])
+      self._cue_poss = sorted(set(c[2] for c in self.cues))
+   
+   def _get_pos_before(self, pos):
+      """Return the segment position of the last cued cluster before the one at pos, or 0 if there isn't one."""
+      from bisect import bisect_left
+      i = bisect_left(self._cue_poss, pos)
+      if (i == 0):
+         return 0
+      return self._cue_poss[i-1]
+   
+   def _get_seek_point(self, tc, tracks):
+      """Determine where to start reading to get all frames of tracks from tc.
+      
+      Returns (segment position, number of blocks to skip in the cluster at that position, set of tracks to skip them
+      for, {tracknum: start timecode}). Tracks without a start timecode are returned in full from the seek point."""
+      starts = {}
+      cued = set()
+      pos_any = None
+      for (ct, tn, pos, bn) in self.cues:
+         if (ct <= tc):
+            # Cues are sorted by time, so this ends up as the position of the last cue point of any track at or before tc.
+            pos_any = pos
+         if not (tn in tracks):
+            continue
+         cued.add(tn)
+         if (ct <= tc):
+            starts[tn] = (pos, bn, ct)
+      
+      tc_starts = dict((tn, t_ct) for (tn, (t_pos, t_bn, t_ct)) in starts.items())
+      if (len(starts) < len(cued)):
+         # Some track we need is only cued after tc; we can't tell where its data for tc begins, so the best we can do
+         # is read from the start, and return all of its frames.
+         for tn in tracks:
+            if not (tn in cued):
+               tc_starts[tn] = tc
+         return (0, 0, (), tc_starts)
+      
+      # Frames of tracks we pick by timecode can be laced into blocks that start in the cluster before the seek point, so
+      # reading for those has to start there.
+      if not (starts):
+         # None of our tracks have cues; seek using those of the others.
+         if (pos_any is None):
+            pos = 0
+         else:
+            pos = self._get_pos_before(pos_any)
+         return (pos, 0, (), dict.fromkeys(tracks, tc))
+      
+      (pos, bn, ct) = min(starts.values())
+      # Tracks without any cues are started at the seek point.
+      for tn in tracks:
+         tc_starts.setdefault(tn, ct)
+      if (len(starts) < len(tracks)):
+         return (self._get_pos_before(pos), 0, (), tc_starts)
+      # Cue block numbers count the blocks of all tracks, so the blocks to skip can hold data of other tracks we need.
+      return (pos, max(bn-1, 0), set(starts), tc_starts)
+   
+   def frames_from(self, time, tracks=None):
+      """Iterate over frames of tracks (default: all of them) starting at time (in seconds).
+      
+      Reading starts at the last cue point for each track at or before time, so the first frame returned for cued
+      tracks is a keyframe. Other tracks start at their first keyframe at or after the earliest of those cue points,
+      or at time if none of the requested tracks have cues. Yields (tracknum, (timecode, duration, data_r,
+      is_keyframe)) tuples in file order; timecodes are in units of the segment timecode scale, and are None for laced
+      frames of unknown duration after the first of their block."""
+      if (tracks is None):
+         tracks = self.tracks.keys()
+      dds = dict((tn, self.default_durs.get(tn)) for tn in tracks)
+      tc = round(time*10**9/self.tcs)
+      (pos, block_skip, skip_tracks, tc_starts) = self._get_seek_point(tc, dds)
+      
+      for c in self.seg.iter_clusters(pos):
+         for (tn, frame) in MatroskaElementSegment._iter_cluster_frames(c, dds, block_skip, skip_tracks):
+            if (tn in tc_starts):
+               # For tracks with cues, only start at the keyframe the cue point refers to; frames decoded after it can
+               # have earlier timecodes. Laced frames without timecodes go the same way as the first of their block.
+               if ((frame[0] is None) or (frame[0] < tc_starts[tn]) or (not frame[3])):
+                  continue
+               del(tc_starts[tn])
+            yield (tn, frame)
+         block_skip = 0
 
 # ---------------------------------------------------------------- public module-level functions
 def make_mkvb_from_file(f):
@@ -1880,9 +2434,108 @@ def _dump_elements(seq, depth=0):
          )))):
             _dump_elements(element.sub, depth+1)
 
+def _bench_frames(count, tv_step, size, kf_interval, dur=None, tv_off=0):
+   for i in range(count):
+      yield (tv_off + i*tv_step, dur, DataRefBytes(bytes(size)), (i % kf_interval == 0))
+
+def _bench_builder(count):
+   """Build MatroskaBuilder with synthetic video and audio tracks of count frames each."""
+   mb = MatroskaBuilder(1000000, count*0.04)
+   mb.add_track(_bench_frames(count, 40, 2000, 50), TRACKTYPE_VIDEO, CODEC_ID_MPEG4_10, None, True, 640, 360)
+   mb.add_track(_bench_frames(count, 23, 200, 1), TRACKTYPE_AUDIO, CODEC_ID_AAC, None, False, 44100, 2)
+   return mb
+
+def _bench_sizes(count=20000):
+   """Compare element sizing work during serialization with and without cached master element sizes."""
+   import tempfile
+   gs = MatroskaElementBlock_r.get_size
+   wtf = MatroskaElementBlock_r.write_to_file
+   sizings = writes = 0
+   def get_size(self):
+      nonlocal sizings
+      sizings += 1
+      return gs(self)
+   def write_to_file(self, c):
+      nonlocal writes
+      writes += 1
+      return wtf(self, c)
+   
+   MatroskaElementBlock_r.get_size = get_size
+   MatroskaElementBlock_r.write_to_file = write_to_file
+   try:
+      for size_cache in (False, True):
+         MatroskaElementMaster.size_cache = size_cache
+         sizings = writes = 0
+         mb = _bench_builder(count)
+         t0 = time.time()
+         mb.write_to_file(tempfile.TemporaryFile())
+         print('size_cache={0}: {1:.2f}s; {2} block sizings for {3} blocks ({4:.2f} per block).'.format(size_cache,
+            time.time()-t0, sizings, writes, sizings/writes))
+   finally:
+      MatroskaElementBlock_r.get_size = gs
+      MatroskaElementBlock_r.write_to_file = wtf
+      MatroskaElementMaster.size_cache = True
+
+def _bench_interleave(count=20000, sub_tracks=32):
+   """Time cluster building for dense video and audio tracks together with many sparse subtitle tracks."""
+   mb = _bench_builder(count)
+   # One subtitle line every 4 seconds per track, staggered so the tracks don't all hit the same timecodes.
+   sub_count = count*40//4000
+   for i in range(sub_tracks):
+      mb.add_track(_bench_frames(sub_count, 4000, 40, 1, 2000, i*97), TRACKTYPE_SUB, CODEC_ID_ASS, b'', False)
+   
+   t0 = time.time()
+   blocks = 0
+   for c in mb._build_clusters([]):
+      blocks += len(c.sub)
+   print('interleave: {0} tracks, {1} blocks in {2:.2f}s.'.format(len(mb.frames), blocks, time.time()-t0))
+
+def _bench_frame_table(count=200000):
+   """Compare memory use of a FrameTable against a list of per-frame tuples, and muxing time from both."""
+   import tempfile
+   import tracemalloc
+   src = tempfile.TemporaryFile()
+   src.write(bytes(4096))
+   src.flush()
+   
+   def frames():
+      for i in range(count):
+         yield (i*23, None, DataRefFile(src, (i*97) % 3900, 150 + i % 50), True)
+   
+   tracemalloc.start()
+   try:
+      m0 = tracemalloc.get_traced_memory()[0]
+      fl = list(frames())
+      m1 = tracemalloc.get_traced_memory()[0]
+      ft = FrameTable(src)
+      for (tc, dur, data_r, is_kf) in fl:
+         ft.append(tc, dur, data_r.off, data_r.size, is_kf)
+      m2 = tracemalloc.get_traced_memory()[0]
+   finally:
+      tracemalloc.stop()
+   print('frame storage: {0:.1f} bytes/frame as tuples, {1:.1f} bytes/frame in FrameTable.'.format((m1-m0)/count,
+      (m2-m1)/count))
+   
+   for (name, data) in (('tuples', fl), ('FrameTable', ft)):
+      mb = MatroskaBuilder(1000000, count*0.023)
+      mb.add_track(data, TRACKTYPE_AUDIO, CODEC_ID_AAC, None, False, 44100, 2)
+      t0 = time.time()
+      mb.write_to_file(tempfile.TemporaryFile())
+      print('mux from {0}: {1:.2f}s.'.format(name, time.time()-t0))
+
+def _bench():
+   """Run module benchmarks."""
+   _bench_sizes()
+   _bench_interleave()
+   _bench_frame_table()
+
 def _main():
-   """Run module selftests."""
+   """Run module selftests, or benchmarks if called with '--bench'."""
    from sys import argv
+   if (argv[1:] == ['--bench']):
+      _bench()
+      return
+   
    for bval in (b'\x1A\x45\xDF\xA3', b'\x42\x86', b'_\xbf', b'\x1b\x53\x86\x67', b'\x80'):
       for VI in (MatroskaVInt, MatroskaSVInt):
          try:
@@ -1897,6 +2550,22 @@ def _main():
    f = open(fn, 'rb')
    els = ebml_ns_mkv.build_seq_from_file(f)
    _dump_elements(els)
+   f.seek(0)
+   reader = MatroskaReader(f)
+   for (tn, (tc, dur, data_r, is_kf)) in itertools.islice(reader.frames_from((reader.dur or 0)/2), 8):
+      print('{0} {1} {2} {3} {4}'.format(tn, tc, dur, data_r.get_size(), is_kf))
+   
+   # Laced frames without any known duration, as in files muxed from FLV data.
+   bio = io.BytesIO()
+   _bench_builder(500).write_to_file(bio)
+   reader = MatroskaReader(bio)
+   frames = [frame for (tn, frame) in reader.frames_from(reader.dur/2, (2,))]
+   if not (frames and (frames[0][0] >= 10000) and any((frame[0] is None) for frame in frames)):
+      raise Exception('Failed laced frame reading testcase; got {0} frames starting with {1}.'.format(len(frames),
+         frames[:1]))
+   bio.seek(0)
+   make_mkvb_from_file(bio).write_to_file(io.BytesIO())
+   
    f.seek(0)
    mb = make_mkvb_from_file(f)
    mb.set_writingapp('mcio_matroska self-test code, pre-versioning version')
@@ -30,6 +30,7 @@ import os.path
 from urllib.error import URLError
 import urllib.request
 import re
+import time
 import xml.dom.minidom
 
 # ---------------------------------------------------------------- General helper functions
@@ -62,6 +63,204 @@ def req2str(req, default_encoding='utf-8'):
    data = req.read()
    return data.decode(get_http_encoding(req, default_encoding))
 
+# From linux/fs.h
+FICLONE = 0x40049409
+
+def fsync_dir(path):
+   """Make a preceding rename, link or unlink in directory path durable. A no-op on platforms that can't open directories."""
+   try:
+      fd = os.open(path or '.', os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+   except OSError:
+      return
+   try:
+      os.fsync(fd)
+   except OSError:
+      pass
+   finally:
+      os.close(fd)
+
+
+class AtomicFile:
+   """Output file that only appears under its final name once it's complete.
+   
+   Data is written to an anonymous O_TMPFILE file in the target directory where supported, and to a hidden temporary
+   file there otherwise; commit() then makes it durable and links it to its final name (atomically replacing any file
+   there). Either way, nothing gets copied."""
+   # Cleared once linking an O_TMPFILE file fails; some sandboxes don't allow linking through /proc.
+   _tmpfile_usable = True
+   
+   def __init__(self, fn):
+      import threading
+      self.fn = fn
+      self.dir = os.path.dirname(fn) or '.'
+      self._fn_tmp = os.path.join(self.dir, '.{0}.{1:d}.{2:d}.tmp'.format(os.path.basename(fn), os.getpid(),
+         threading.get_ident()))
+      self._anonymous = False
+      fd = None
+      
+      O_TMPFILE = getattr(os, 'O_TMPFILE', None)
+      if not ((O_TMPFILE is None) or not (self._tmpfile_usable and os.path.isdir('/proc/self/fd'))):
+         try:
+            fd = os.open(self.dir, O_TMPFILE | os.O_RDWR, 0o666)
+         except OSError:
+            # Not supported by this kernel or filesystem.
+            pass
+         else:
+            self._anonymous = True
+      
+      if (fd is None):
+         fd = os.open(self._fn_tmp, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666)
+      self.f = os.fdopen(fd, 'w+b')
+   
+   def commit(self):
+      self.f.flush()
+      os.fsync(self.f.fileno())
+      if (self._anonymous):
+         fn_fd = '/proc/self/fd/{0:d}'.format(self.f.fileno())
+         try:
+            os.link(fn_fd, self.fn)
+         except FileExistsError:
+            # linkat() won't replace existing files; take a detour through a hidden name.
+            os.link(fn_fd, self._fn_tmp)
+            self._anonymous = False
+         except OSError:
+            AtomicFile._tmpfile_usable = False
+            # Salvage the data we have, the slow way.
+            f = os.fdopen(os.open(self._fn_tmp, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666), 'w+b')
+            try:
+               copy_file_data(self.f, f)
+               f.flush()
+               os.fsync(f.fileno())
+            finally:
+               self.f.close()
+               self.f = f
+            self._anonymous = False
+      
+      if not (self._anonymous):
+         os.replace(self._fn_tmp, self.fn)
+      self.f.close()
+      fsync_dir(self.dir)
+   
+   def abort(self):
+      self.f.close()
+      if not (self._anonymous):
+         try:
+            os.unlink(self._fn_tmp)
+         except OSError:
+            pass
+
+
+def copy_file_data(f_in, f_out):
+   """Copy entire content of file f_in to (empty) file f_out, avoiding data copies through userspace where possible.
+   
+   Tries reflinking first, then copy_file_range(); returns name of the method used."""
+   import errno
+   try:
+      from fcntl import ioctl
+   except ImportError:
+      pass
+   else:
+      try:
+         ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+      except OSError:
+         pass
+      else:
+         return 'reflink'
+   
+   copy_file_range = getattr(os, 'copy_file_range', None)
+   if not (copy_file_range is None):
+      size = os.fstat(f_in.fileno()).st_size
+      off = 0
+      try:
+         while (off < size):
+            count = copy_file_range(f_in.fileno(), f_out.fileno(), size - off, off, off)
+            if (count == 0):
+               break
+            off += count
+      except OSError as exc:
+         if (off or not (exc.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP))):
+            raise
+      else:
+         if (off == size):
+            return 'copy_file_range'
+   
+   import shutil
+   f_in.seek(0)
+   f_out.seek(0)
+   f_out.truncate()
+   shutil.copyfileobj(f_in, f_out, 1024*1024)
+   return 'copy'
+
+
+def move_file(src, dst):
+   """Move file src to dst, replacing any file there; data is durable at dst before src is removed.
+   
+   Where a rename isn't possible, data is copied with copy_file_data() to an AtomicFile."""
+   import errno
+   f_in = open(src, 'rb')
+   try:
+      os.fsync(f_in.fileno())
+      try:
+         os.replace(src, dst)
+      except OSError as exc:
+         if (exc.errno != errno.EXDEV):
+            raise
+      else:
+         fsync_dir(os.path.dirname(dst))
+         return 'rename'
+      
+      af = AtomicFile(dst)
+      try:
+         method = copy_file_data(f_in, af.f)
+         af.commit()
+      except BaseException:
+         af.abort()
+         raise
+   finally:
+      f_in.close()
+   
+   os.unlink(src)
+   fsync_dir(os.path.dirname(src))
+   return method
+
+def coalesce_spans(spans, gap_max, count_max=None):
+   """Merge sorted (offset, size) spans separated by no more than gap_max bytes.
+   
+   If count_max is given, the spans separated by the smallest gaps are merged further until no more than count_max of them
+   are left."""
+   rv = []
+   for (off, size) in spans:
+      if (rv and (off - (rv[-1][0] + rv[-1][1]) <= gap_max)):
+         (off_p, size_p) = rv[-1]
+         rv[-1] = (off_p, max(size_p, off + size - off_p))
+      else:
+         rv.append((off, size))
+   
+   if ((count_max is None) or (len(rv) <= count_max)):
+      return rv
+   
+   gaps = sorted(range(1, len(rv)), key=lambda i: rv[i][0] - (rv[i-1][0] + rv[i-1][1]))
+   merge = set(gaps[:len(rv) - count_max])
+   spans = rv
+   rv = []
+   for (i, (off, size)) in enumerate(spans):
+      if (i in merge):
+         (off_p, size_p) = rv[-1]
+         rv[-1] = (off_p, off + size - off_p)
+      else:
+         rv.append((off, size))
+   return rv
+
+def fmt_time_range(t_range):
+   """Format (t_start, t_end) time range in seconds for use in filenames; returns '' for None."""
+   if (t_range is None):
+      return ''
+   (t_start, t_end) = t_range
+   if (t_end is None):
+      return '{0:g}-'.format(t_start)
+   return '{0:g}-{1:g}'.format(t_start, t_end)
+
+
 # ---------------------------------------------------------------- ASS sub building code
 def make_ass_color(r,g,b,a):
    for val in (r,g,b,a):
@@ -492,6 +691,9 @@ class YTError(Exception):
 class YTLoginRequired(YTError):
    pass
 
+class YTTooSlow(YTError):
+   pass
+
 class YTDefaultFmt:
    def __str__(self):
       return 'default'
@@ -587,6 +789,389 @@ def _split_yt_dictstring(dstr):
    return dict(uqv(splitvalue(cfrag)) for cfrag in dstr.split('&'))
 
 
+class YTThroughputEstimator:
+   """Running estimate of per-transfer download throughput, shared between YTVideoRefs.
+   
+   This is an exponentially weighted moving average over measured transfer rates; since concurrent transfers share our
+   link, it naturally reflects the rate a single transfer can expect with our current degree of parallelism."""
+   logger = logging.getLogger('YTThroughputEstimator')
+   log = logger.log
+   
+   def __init__(self, weight=0.3, rate_initial=None):
+      import threading
+      self.weight = weight
+      self._rate = rate_initial
+      self._lock = threading.Lock()
+   
+   def add_sample(self, size, duration):
+      if (duration <= 0):
+         return
+      rate = size/duration
+      with self._lock:
+         if (self._rate is None):
+            self._rate = rate
+         else:
+            self._rate += self.weight * (rate - self._rate)
+         rv = self._rate
+      self.log(15, 'Measured {0:.0f} B/s; estimated throughput is now {1:.0f} B/s.'.format(rate, rv))
+   
+   def get_rate(self):
+      """Return estimated throughput in bytes per second, or None if we haven't measured any."""
+      with self._lock:
+         return self._rate
+
+
+class YTHostLimiter:
+   """Per-host limit on concurrently pending HTTP requests, shared between YTVideoRefs.
+   
+   Slots are held while a request is being sent and its response headers received; reading response bodies isn't
+   covered."""
+   def __init__(self, limit):
+      import threading
+      if (limit < 1):
+         raise ValueError('Invalid per-host request limit {0!a}.'.format(limit))
+      self.limit = limit
+      self._lock = threading.Lock()
+      self._sems = {}
+   
+   def get(self, host):
+      """Return semaphore for specified host."""
+      import threading
+      with self._lock:
+         try:
+            rv = self._sems[host]
+         except KeyError:
+            rv = self._sems[host] = threading.BoundedSemaphore(self.limit)
+      return rv
+
+
+class YTGateway:
+   """HTTP gateway usable for striped downloads, shared between YTVideoRefs.
+   
+   This wraps an url mangler, and keeps track of the gateway's measured throughput and consecutive failures; gateways
+   that fail max_failures times in a row aren't used again until retry_interval seconds after their last failure."""
+   max_failures = 3
+   retry_interval = 600
+   
+   def __init__(self, name, mangle):
+      self.name = name
+      self.mangle = mangle
+      self.throughput = YTThroughputEstimator()
+      self.failures = 0
+      self.ts_failure = None
+   
+   def is_usable(self):
+      return ((self.failures < self.max_failures) or (time.time() - self.ts_failure >= self.retry_interval))
+   
+   def add_success(self, size, duration):
+      self.failures = 0
+      self.throughput.add_sample(size, duration)
+   
+   def add_failure(self):
+      self.failures += 1
+      self.ts_failure = time.time()
+   
+   def __format__(self, fs):
+      return self.name
+
+
+class YTStripedDownload:
+   """Download of a single content url in Range segments striped across several YTGateways.
+   
+   Each gateway gets a worker thread, which keeps taking segments from the front of the missing data; segment sizes are
+   scaled to the gateway's measured throughput, so faster gateways end up retrieving proportionally more of the file. When
+   a transfer fails, the rest of its segment is put back for any gateway to pick up. Progress is recorded in a sidecar
+   file next to the output file, so interrupted downloads can be resumed; it's saved every save_interval_size bytes or
+   save_interval_time seconds, whichever comes first."""
+   logger = logging.getLogger('YTStripedDownload')
+   log = logger.log
+   
+   # Segments are sized to take about segment_time seconds at the gateway's estimated throughput.
+   segment_time = 5
+   segment_size_min = 256*1024
+   segment_size_max = 16*1024**2
+   segment_size_default = 1024**2
+   save_interval_size = 64*1024**2
+   save_interval_time = 10
+   
+   def __init__(self, ref, url, fn, length, gateways):
+      import threading
+      self.ref = ref
+      self.url = url
+      self.fn = fn
+      self.fn_parts = fn + '.parts'
+      self.length = length
+      self.gateways = gateways
+      self._cond = threading.Condition()
+      self._save_lock = threading.Lock()
+      self._pending = []
+      self._done = []
+      self._active = 0
+      self._unsaved = 0
+      self._ts_saved = None
+      self._fd = None
+      # Amount of data retrieved (as opposed to resumed) by run().
+      self.size_fetched = None
+   
+   def _load_parts(self):
+      """Determine which data we have already from a previous run, and return it as a list of (offset, size) spans."""
+      import json
+      try:
+         f = open(self.fn_parts, 'rb')
+      except IOError:
+         pass
+      else:
+         try:
+            parts = json.loads(f.read().decode('utf-8'))
+         finally:
+            f.close()
+         if (parts['length'] != self.length):
+            self.log(20, 'Stored progress for {0!a} is for a different file length; starting over.'.format(self.fn))
+            return []
+         return [tuple(span) for span in parts['done']]
+      
+      # Data written by sequential downloads is always a prefix of the file.
+      try:
+         size = os.path.getsize(self.fn)
+      except OSError:
+         return []
+      return [(0, min(size, self.length))]
+   
+   def _save_parts(self, wait=True):
+      """Record the data marked as retrieved so far in our sidecar file; call without self._cond held.
+      
+      If wait is false and another thread is saving already, return without doing anything."""
+      import json
+      if not (self._save_lock.acquire(wait)):
+         return
+      try:
+         with self._cond:
+            done = list(self._done)
+            self._unsaved = 0
+            self._ts_saved = time.time()
+         # The sidecar file mustn't claim any data that isn't on disk yet.
+         os.fsync(self._fd)
+         data = json.dumps({'length': self.length, 'done': done}).encode('utf-8')
+         af = AtomicFile(self.fn_parts)
+         try:
+            af.f.write(data)
+            af.commit()
+         except BaseException:
+            af.abort()
+            raise
+      finally:
+         self._save_lock.release()
+   
+   def _add_done(self, off, size):
+      """Mark data as retrieved; call with self._cond held. Returns True iff our progress is due to be saved."""
+      if (size <= 0):
+         return False
+      self._done.append((off, size))
+      self._done.sort()
+      self._done = coalesce_spans(self._done, 0)
+      self._unsaved += size
+      return ((self._unsaved >= self.save_interval_size) or
+         (time.time() - self._ts_saved >= self.save_interval_time))
+   
+   def _take(self, gateway):
+      """Return (offset, size) of next segment for gateway to retrieve, or None if there's nothing left to do for it."""
+      rate = gateway.throughput.get_rate()
+      if (rate is None):
+         seg_size = self.segment_size_default
+      else:
+         seg_size = min(max(round(rate*self.segment_time), self.segment_size_min), self.segment_size_max)
+      
+      with self._cond:
+         while (gateway.is_usable()):
+            if (self._pending):
+               (off, size) = self._pending[0]
+               if (size <= seg_size):
+                  del(self._pending[0])
+               else:
+                  self._pending[0] = (off + seg_size, size - seg_size)
+                  size = seg_size
+               self._active += 1
+               return (off, size)
+            if (self._active == 0):
+               break
+            # Another gateway might still fail and put back part of its segment.
+            self._cond.wait()
+      return None
+   
+   def _run_gateway(self, gateway):
+      import http.client
+      while (True):
+         seg = self._take(gateway)
+         if (seg is None):
+            break
+         (off, size) = seg
+         ts = time.time()
+         got = 0
+         try:
+            url = gateway.mangle(self.url)
+            res = self.ref.urlopen(url, headers={'Range': 'bytes={0}-{1}'.format(off, off + size - 1)}, mangle=False)
+            try:
+               if (res.code != 206):
+                  raise YTError('Gateway {0} returned HTTP response code {1} to range request.'.format(gateway, res.code))
+               while (got < size):
+                  data = res.read(min(1024*1024, size - got))
+                  if (len(data) == 0):
+                     raise YTError('Gateway {0} prematurely closed connection.'.format(gateway))
+                  os.pwrite(self._fd, data, off + got)
+                  got += len(data)
+            finally:
+               res.close()
+         except (URLError, YTError, OSError, http.client.HTTPException) as exc:
+            gateway.add_failure()
+            self.log(30, 'Segment {0}+{1} failed on gateway {2} ({3!a}); putting it back.'.format(off, size, gateway, exc))
+         else:
+            gateway.add_success(got, time.time() - ts)
+         finally:
+            with self._cond:
+               self._active -= 1
+               if (got < size):
+                  self._pending.append((off + got, size - got))
+                  self._pending.sort()
+               self._cond.notify_all()
+               save = self._add_done(off, got)
+            if (save):
+               # Don't hold up other gateways on disk syncs. If somebody else is saving already, our data will go out
+               # with the next save.
+               self._save_parts(wait=False)
+   
+   def run(self):
+      """Retrieve all missing data; returns file object of the finished file."""
+      import threading
+      gateways = [gw for gw in self.gateways if gw.is_usable()]
+      if not (gateways):
+         raise YTError('No usable gateways left for striped download.')
+      
+      self._done = self._load_parts()
+      off = 0
+      self._pending = []
+      for (d_off, d_size) in self._done:
+         if (d_off > off):
+            self._pending.append((off, d_off - off))
+         off = d_off + d_size
+      if (off < self.length):
+         self._pending.append((off, self.length - off))
+      
+      os.close(os.open(self.fn, os.O_RDWR | os.O_CREAT, 0o666))
+      f = open(self.fn, 'r+b')
+      self._fd = f.fileno()
+      size_total = sum(size for (off, size) in self._pending)
+      self.size_fetched = size_total
+      try:
+         if (self._pending):
+            # The sidecar file needs to exist before any out-of-order data does.
+            self._save_parts()
+            f.truncate(self.length)
+            self.log(20, 'Fetching {0} bytes in {1} span(s) through gateways {2}.'.format(size_total, len(self._pending),
+               ', '.join(gw.name for gw in gateways)))
+            threads = []
+            for gw in gateways:
+               t = threading.Thread(target=self._run_gateway, args=(gw,), name='stripe-{0}'.format(gw.name))
+               t.start()
+               threads.append(t)
+            for t in threads:
+               t.join()
+            self._save_parts()
+         
+         if (self._pending):
+            raise YTError('All gateways failed; {0} bytes of {1!a} left to retrieve.'.format(
+               sum(size for (off, size) in self._pending), self.fn))
+         os.fsync(self._fd)
+      except BaseException:
+         f.close()
+         raise
+      
+      if (os.path.exists(self.fn_parts)):
+         os.unlink(self.fn_parts)
+      f.seek(0)
+      return f
+
+
+class YTFormatStats:
+   """Persistent statistics on which fmts YT actually serves when asked.
+   
+   Counts are kept per context; contexts are strings like 'all', 'era:<upload year>', 'user:<user id>' or
+   'playlist:<playlist id>'. Estimates come from the most specific context with at least min_samples probes of the
+   fmt in question."""
+   logger = logging.getLogger('YTFormatStats')
+   log = logger.log
+   
+   min_samples = 5
+   
+   def __init__(self, fn=None):
+      import threading
+      import json
+      self.fn = fn
+      self._lock = threading.Lock()
+      self._data = {}
+      self._dirty = False
+      if ((fn is None) or not os.path.exists(fn)):
+         return
+      
+      f = open(fn, 'rb')
+      try:
+         self._data = json.loads(f.read().decode('utf-8'))
+      except ValueError:
+         self.log(30, 'Unable to parse fmt stats file {0!a}; starting over.'.format(fn), exc_info=True)
+      finally:
+         f.close()
+   
+   @staticmethod
+   def get_keys(vi):
+      """Return contexts for the video described by YTVideoInfo vi (which may be None), most specific first."""
+      rv = []
+      if not (vi is None):
+         if not (vi.source is None):
+            rv.append('{0}:{1}'.format(*vi.source))
+         if not (vi.upload_ts is None):
+            rv.append('era:{0:d}'.format(time.gmtime(vi.upload_ts).tm_year))
+      rv.append('all')
+      return tuple(rv)
+   
+   def add(self, fmt, keys, served):
+      with self._lock:
+         for key in keys:
+            counts = self._data.setdefault(key, {}).setdefault(str(fmt), [0, 0])
+            counts[0] += 1
+            counts[1] += int(served)
+         self._dirty = True
+   
+   def get_p(self, fmt, keys):
+      """Return estimated probability of fmt being served in the most specific of the specified contexts we know enough
+      about."""
+      with self._lock:
+         for key in keys:
+            try:
+               (tried, served) = self._data[key][str(fmt)]
+            except KeyError:
+               continue
+            if (tried >= self.min_samples):
+               return (served + 1)/(tried + 2)
+      return 0.5
+   
+   def save(self):
+      import json
+      if (self.fn is None):
+         return
+      with self._lock:
+         if not (self._dirty):
+            return
+         data = json.dumps(self._data, sort_keys=True).encode('utf-8')
+         self._dirty = False
+      
+      af = AtomicFile(self.fn)
+      try:
+         af.f.write(data)
+         af.commit()
+      except BaseException:
+         af.abort()
+         raise
+
+
 class YTVideoRef:
    re_title = re.compile(b'<meta name="title" content="(?P<text>[^"]*?)">')
    re_err = re.compile(b'<div[^>]* id="error-box"[^>]*>.*?<div[^>]* class="yt-alert-content"[^>]*>(?P<text>.*?)</div>', re.DOTALL)
@@ -616,12 +1201,47 @@ class YTVideoRef:
       'video/webm': 'mcio_matroska'
    }
    
+   # Assumed lifetime of direct content urls that don't specify an expiry time.
+   url_ttl_default = 3600
+   
+   # Adaptive fmt choice: if throughput is a YTThroughputEstimator and max_time (seconds per video) and/or deadline
+   # (unixtime) are set, fmts whose download isn't expected to finish in time are passed over in favor of later ones in
+   # the preference list. Transfers are re-checked once they've run for rate_probe_time seconds.
+   throughput = None
+   max_time = None
+   deadline = None
+   rate_probe_time = 10
+   # Optional callable; called without arguments whenever such a fallback changes our fmt during fetch_data_raw(), e.g.
+   # to adjust disk space reservations.
+   fmt_change_cb = None
+   
+   # Fmt availability probing: fmt_stats is an optional YTFormatStats instance, and fmt_stats_keys the contexts to
+   # consult it for in the case of this video.
+   fmt_stats = None
+   fmt_stats_keys = ('all',)
+   probe_concurrency = 1
+   probe_min_p = 0.05
+   # Optional YTHostLimiter for our HTTP requests.
+   host_limiter = None
+   # Partial downloads: data spans separated by less than this many bytes are fetched with a single request, and no more
+   # than range_requests_max requests are used for the AV data. When dropping tracks, the gaps are mostly other tracks'
+   # interleaved chunks; merging across those would fetch most of what we're trying to skip, so only tiny ones are
+   # merged (range_gap_max_tracks).
+   range_gap_max = 256*1024
+   range_gap_max_tracks = 4*1024
+   range_requests_max = 4096
+   # Mime types for which our parser modules can restrict partial downloads to specific tracks.
+   MT_TRACK_SELECTION = frozenset(('video/mp4', 'video/3gpp'))
+   # Optional sequence of YTGateways to stripe AV data downloads across.
+   gateways = None
+   
    _track_type_map = {
       'a': ('TRACKTYPE_AUDIO', 'audio'),
       'v': ('TRACKTYPE_VIDEO', 'video'),  
    }
    
-   def __init__(self, vid, format_pref_list, dl_path_tmp, dl_path_final, make_mkv, try_html5=False, drop_tt='', uhl=()):
+   def __init__(self, vid, format_pref_list, dl_path_tmp, dl_path_final, make_mkv, try_html5=False, drop_tt='', uhl=(),
+         catalog=None, blobs=None, t_range=None):
       self._tried_md_fetch = False
       self.vid = vid
       self._mime_type = None
@@ -632,6 +1252,7 @@ class YTVideoRef:
       self.dlp_tmp = dl_path_tmp
       self.dlp_final = dl_path_final
       self._content_direct_url = None
+      self._content_url_ts = None
       self._fmt = None
       self.make_mkv = make_mkv
       self._cookiejar = http.cookiejar.CookieJar()
@@ -646,6 +1267,14 @@ class YTVideoRef:
          if not (tt in self._track_type_map):
             raise ValueError('Unknown track type {!r}.'.format(tt))
       self.drop_tt = ''.join(sorted(set(drop_tt)))
+      self.catalog = catalog
+      self.blobs = blobs
+      self._blob = None
+      self._fmts_excluded = set()
+      self._ts_dl_start = None
+      if not ((t_range is None) or make_mkv):
+         raise ValueError('Partial downloads are only supported with MKV output.')
+      self.t_range = t_range
    
    @staticmethod
    def _make_html5_optin_cookie():
@@ -663,9 +1292,11 @@ class YTVideoRef:
          cj = http.cookiejar.CookieJar()
          cj.set_cookie(self._make_html5_optin_cookie())
          cj.add_cookie_header(req)
-         
-      rv = self._url_opener.open(req)
-      return rv
+      
+      if (self.host_limiter is None):
+         return self._url_opener.open(req)
+      with self.host_limiter.get(req.host):
+         return self._url_opener.open(req)
    
    def mangle_yt_url(self, url):
       """This function will be called to preprocess any and all YT urls.
@@ -700,6 +1331,48 @@ class YTVideoRef:
       if (need_watchpage):
          self._get_metadata_watch(html5=self._try_html5)
    
+   def prefetch(self):
+      """Resolve metadata and pick a video format, without retrieving any content data."""
+      if (self._use_blob()):
+         return
+      if (not self._tried_md_fetch):
+         self.get_metadata_blocking()
+      if (self._pick_video() is None):
+         raise YTError('Unable to pick video fmt; bailing out.')
+   
+   def get_url_expiry(self):
+      """Return expiry time (as unixtime) of our picked direct content url, or None if we don't have one.
+      
+      YT includes this time as the 'expire' query argument of its direct urls; if it's missing, we assume a lifetime of
+      url_ttl_default seconds from the time of the pick."""
+      from urllib.parse import urlsplit, parse_qs
+      if (self._content_direct_url is None):
+         return None
+      
+      for url in (self._content_direct_url, self.fmt_stream_map.get(self._fmt)):
+         if (url is None):
+            continue
+         try:
+            return int(parse_qs(urlsplit(url).query)['expire'][0])
+         except (KeyError, ValueError):
+            continue
+      return self._content_url_ts + self.url_ttl_default
+   
+   def refresh_urls_if_stale(self, margin):
+      """Re-fetch metadata and re-pick the video format if our direct content url expires within margin seconds.
+      
+      Returns True iff a refresh was performed."""
+      expiry = self.get_url_expiry()
+      if ((expiry is None) or (expiry - time.time() > margin)):
+         return False
+      
+      self.log(20, 'Direct url for fmt {0} expires in {1:.0f}s; refreshing metadata.'.format(self._fmt, expiry - time.time()))
+      self.fmt_stream_map = {}
+      self._content_direct_url = None
+      self._tried_md_fetch = False
+      self.prefetch()
+      return True
+   
    def _get_metadata_getvideoinfo(self):
       url = self.URL_FMT_GETVIDEOINFO.format(self.vid)
       content = self.urlopen(url).read().decode('ascii')
@@ -761,18 +1434,19 @@ class YTVideoRef:
    
    def _choose_final_fn(self, ext=None):
       if ((ext is None) and self.make_mkv):
+         ext = 'mkv'
+         if not (self.t_range is None):
+            ext = '[{0}].{1}'.format(fmt_time_range(self.t_range), ext)
          if (self.drop_tt):
-            ext = '[-{}].mkv'.format(self.drop_tt)
-         else:
-            ext = 'mkv'
+            ext = '[-{0}].{1}'.format(self.drop_tt, ext)
       
       return os.path.join(self.dlp_final, self._choose_fn(ext))
    
    def _move_video(self, fn_tmp):
-      import shutil
       fn_final = self._choose_final_fn()
       self.log(20, 'Moving finished movie file to {0!a}.'.format(fn_final))
-      shutil.move(fn_tmp, fn_final)
+      method = move_file(fn_tmp, fn_final)
+      self.log(15, 'Moved {0!a} by {1}.'.format(fn_final, method))
       return fn_final
    
    def _choose_fn(self, ext=None):
@@ -792,48 +1466,88 @@ class YTVideoRef:
       
       return 'yt_{0}.[{1}][{2}].{3}'.format(mtitle, self.vid, self._fmt, ext)
    
+   def get_variant(self):
+      """Return catalog variant of our output."""
+      return YTCatalog.get_variant(self.make_mkv, self.drop_tt, fmt_time_range(self.t_range))
+   
+   def find_cataloged(self, dtm):
+      """Return catalog entry showing this video as done for data types dtm, or None if there isn't one."""
+      if (self.catalog is None):
+         return None
+      entry = self.catalog.find_done(self.vid, self.get_variant(), self.fpl, dtm)
+      if not (entry is None):
+         self.log(20, 'Catalog lists {0!a} for video {1!a}; skipping it.'.format(entry.path, self.vid))
+      return entry
+   
    def fetch_data(self, dtm):
-      # Need to determine preferred format first.
-      if (not self._tried_md_fetch):
-         self.get_metadata_blocking()
+      """Retrieve and process all data of the types specified in dtm for this video."""
+      job = self.fetch_data_raw(dtm)
+      if (job is None):
+         return
+      job.demux()
+      job.mux()
+      if not (self.catalog is None):
+         self.catalog.record_mux_job(job)
+   
+   def fetch_data_raw(self, dtm):
+      """Retrieve all network data for this video.
       
-      if (self._pick_video() is None):
-         # No working formats, forget all this then.
-         raise YTError('Unable to pick video fmt; bailing out.')
+      Output that doesn't need MKV muxing is finished here. If MKV output is requested, return a YTMuxJob for the
+      remaining (purely local) work; otherwise, return None."""
+      if not (self.find_cataloged(dtm) is None):
+         return None
+      
+      # Need to determine preferred format first.
+      if not (self._use_blob()):
+         if (not self._tried_md_fetch):
+            self.get_metadata_blocking()
+         
+         if (self._pick_video() is None):
+            # No working formats, forget all this then.
+            raise YTError('Unable to pick video fmt; bailing out.')
       
       if (self.make_mkv and os.path.exists(self._choose_final_fn())):
          # MKV files are only written once we have retrieved all the data for this video; so if one for this video exists
          # already, we can safely skip it.
          # TODO: What about updated remote A/V/S data? Are changes to AV data even allowed by YT?
          self.log(20, 'Local final file {0!r} exists already; skipping this download.'.format(self._choose_final_fn()))
-         return
+         if not (self.catalog is None):
+            self.catalog.record(self.vid, self.get_variant(), self._choose_final_fn(), self._fmt, dtm)
+         return None
+      
+      # With sharded output layouts, our final directory might not exist yet.
+      os.makedirs(self.dlp_final, exist_ok=True)
       
+      fn_raw = None
       if (dtm & DATATYPE_VIDEO):
          if (os.path.exists(self._choose_final_fn())):
             # We might still need new subs, however, so only cancel AV data download here.
             self.log(20, 'Local final file {0!r} exists already; skipping this download.'.format(self._choose_final_fn()))
          else:
-            vf = self.fetch_video()
-            if (self.make_mkv):
-               vf.seek(0)
-               modname = self.MT_PARSERMODULE_MAP[self._mime_type]
-               pmod = __import__(modname)
-               mkvb = pmod.make_mkvb_from_file(vf)
-               mkvb.sort_tracks()
+            # This can end up falling back to a different fmt, so final filenames aren't settled before it's done.
+            fn_raw = self._get_raw_av()
+            if (fn_raw is None):
+               # Fell back to a fmt we have a final file for already.
+               if (self.make_mkv):
+                  if not (self.catalog is None):
+                     self.catalog.record(self.vid, self.get_variant(), self._choose_final_fn(), self._fmt, dtm)
+                  return None
+            elif (self.make_mkv):
+               # Muxed into the MKV file later on.
+               pass
+            elif (self._blob is None):
+               self._move_video(fn_raw)
             else:
-               self._move_video(vf.name)
-      
-      elif (self.make_mkv):
-         # Sub only MKV files; kinda a weird case, but let's support it anyway.
-         from mcio_matroska import MatroskaBuilder
-         mkvb = MatroskaBuilder(1000000, None)
+               self.blobs.link_out(fn_raw, self._choose_final_fn())
       
       if (self.make_mkv):
-         mkvb.set_writingapp('Yet Another Video DownLoad Tool (unversioned)')
          file_title = 'Youtube video {0!a}({1:d}): {2}'.format(self.vid, self._fmt, self.title)
-         mkvb.set_segment_title(file_title)
-         if (dtm & DATATYPE_VIDEO):
-            mkvb.set_track_name(0, file_title)
+         job = YTMuxJob(self.vid, fn_raw, self._mime_type, self._choose_final_fn(), file_title, self.drop_tt, self._fmt,
+            dtm, self.t_range)
+         # Stored data is shared with other outputs; we're not allowed to clean it up.
+         job.keep_raw = not (self._blob is None)
+      else:
+         subtitles = []
       
       if (dtm & DATATYPE_ANNOTATIONS):
          (annotations, sts_raw, sts_nospam) = self.fetch_annotations()
@@ -843,54 +1557,149 @@ class YTVideoRef:
             self.log(20, 'Received {0:d} annotations, but none appear sublike. :('.format(len(annotations)))
          else:
             if (self.make_mkv):
-               self.log(20, 'Received {0:d}(/{1:d}) ({2:d} nospam) sublike annotations; muxing into MKV.'.format(len(sts_raw.subs), len(annotations), len(sts_nospam.subs)))
-               sts_raw.mkv_add_track(mkvb)
-               sts_nospam.mkv_add_track(mkvb)
+               self.log(20, 'Received {0:d}(/{1:d}) ({2:d} nospam) sublike annotations; will mux into MKV.'.format(len(sts_raw.subs), len(annotations), len(sts_nospam.subs)))
+               job.sub_sets.append(sts_raw)
+               job.sub_sets.append(sts_nospam)
             else:
                fn_out = self._choose_final_fn('ass')
                self.log(20, 'Received {0:d}(/{1:d}) sublike annotations; writing to {2!a}.'.format(len(sts_raw.subs), len(annotations), fn_out))
                f = open(fn_out, 'wb')
                sts_raw.write_to_file(f)
                f.close()
+               subtitles.append((sts_raw.name, sts_raw.lc))
                if (sts_nospam.subs):
                   fn_out = self._choose_final_fn('nospam.ass')
                   self.log(20, 'Received {0:d}(/{1:d}) nospam sublike annotations; writing to {2!a}.'.format(len(sts_nospam.subs), len(annotations), fn_out))
                   f = open(fn_out, 'wb')
                   sts_nospam.write_to_file(f)
                   f.close()
+                  subtitles.append((sts_nospam.name, sts_nospam.lc))
 
 
       if (dtm & DATATYPE_TIMEDTEXT):
          ttd = self.fetch_tt()
          if (ttd):
             if (self.make_mkv):
-               self.log(20, 'Muxing TimedText data into MKV.')
-               for sts in ttd:
-                  sts.mkv_add_track(mkvb)
-               
+               self.log(20, 'Will mux TimedText data into MKV.')
+               job.sub_sets.extend(ttd)
             else:
                self._dump_ttd(ttd)
+               subtitles.extend((sts.name, sts.lc) for sts in ttd)
       
       if (self.make_mkv):
-         if (self.drop_tt):
-            import mcio_matroska
-            for tt in self.drop_tt:
-               (tt_attr, tt_name_hr) = self._track_type_map[tt]
-               tt_mkv = getattr(mcio_matroska, tt_attr)
-               tracks = mkvb.get_tracks_by_type(tt_mkv)
-               self.log(20, 'Dropping {:d} {} track(s) from file as requested.'.format(len(tracks), tt_name_hr))
-               for track in tracks:
-                  mkvb.drop_track(track.get_track_id())
-            mkvb.sort_tracks()
-         
-         fn_out = self._choose_tmp_fn('mkv')
-         self.log(20, 'Writing MKV data to file.')
-         f_out = open(fn_out, 'w+b')
-         mkvb.write_to_file(f_out)
-         f_out.close()
-         self._move_video(fn_out)
-         # MKV write cycle is finished; remove the raw video file.
-         os.unlink(vf.name)
+         return job
+      
+      if not (self.catalog is None):
+         if (dtm & DATATYPE_VIDEO):
+            fn_av = self._choose_final_fn()
+         else:
+            fn_av = None
+         self.catalog.record(self.vid, 'raw', fn_av, self._fmt, dtm, subtitles=subtitles, merge=True)
+      return None
+   
+   def _use_blob(self):
+      """Check our blob store for AV data in an acceptable fmt; if we have some, use it instead of fetching metadata.
+      
+      Annotations and timedtext data don't depend on YT metadata, and are fetched as usual either way."""
+      if not (self._blob is None):
+         return True
+      if (self.blobs is None):
+         return False
+      
+      bi = self.blobs.find(self.vid, self.fpl)
+      if (bi is None):
+         return False
+      
+      self.log(20, 'Using stored data for fmt {0}.'.format(bi.fmt))
+      self._blob = bi.path
+      self._fmt = bi.fmt
+      self._mime_type = bi.mime_type
+      self._content_length = bi.length
+      self.title = bi.title
+      return True
+   
+   def _get_raw_av(self):
+      """Return filename of raw AV data, downloading it if we don't have it yet.
+      
+      Returns None if we fall back to a different fmt, and find its final file exists already."""
+      if not (self._blob is None):
+         return self._blob
+      if not ((self.t_range is None) and (self._get_partial_tracks() is None)):
+         # Partial data isn't any use to other outputs, so it's kept out of the blob store.
+         return self.fetch_range()
+      while (True):
+         try:
+            if (self.gateways):
+               vf = self.fetch_video_striped()
+            else:
+               vf = self.fetch_video()
+         except YTTooSlow:
+            self._fmts_excluded.add(self._fmt)
+            if (self._pick_video(cache_ok=False) is None):
+               raise
+            # Final filenames and space needs depend on the fmt; redo the checks fetch_data_raw() did for the old one.
+            if (os.path.exists(self._choose_final_fn())):
+               self.log(20, 'Local final file {0!r} exists already; skipping this download.'.format(self._choose_final_fn()))
+               return None
+            if not (self.fmt_change_cb is None):
+               self.fmt_change_cb()
+            continue
+         break
+      vf.close()
+      if (self.blobs is None):
+         return vf.name
+      
+      bi = self.blobs.add(self.vid, self._fmt, self._content_length, self._mime_type, self.title, vf.name)
+      self._blob = bi.path
+      return bi.path
+   
+   def get_space_needs(self, dtm, raw_done=False):
+      """Return list of YTSpaceReserver needs estimating the disk space fetch_data_raw(dtm) and any resulting YTMuxJob will
+      take up with our picked fmt; if raw_done, only count what's left to write once fetch_data_raw() has returned."""
+      if not (dtm & DATATYPE_VIDEO):
+         # Subs are small enough not to bother.
+         return []
+      
+      get_dev = YTSpaceReserver._get_dev
+      cl = self._content_length
+      rv = []
+      if (self._blob is None):
+         path_raw = self.dlp_tmp
+         if not (raw_done):
+            # Partial data from earlier runs takes up its space already; so does the rest, as it comes in.
+            rv.append((self.dlp_tmp, cl, self._choose_tmp_fn()))
+         if not (self.blobs is None):
+            path_raw = self.blobs.path
+            if not (raw_done):
+               rv.append((self.blobs.path, cl))
+      else:
+         path_raw = self._blob
+      
+      if (self.make_mkv):
+         # MKV files come out about as large as the raw data, which stays around until they're done.
+         rv.append((self.dlp_final, cl))
+      elif (get_dev(path_raw)[0] != get_dev(self.dlp_final)[0]):
+         rv.append((self.dlp_final, cl))
+      return rv
+   
+   def fetch_video_striped(self):
+      """Retrieve AV data in our picked fmt through self.gateways; returns file object of the finished file."""
+      if (not self._tried_md_fetch):
+         self.get_metadata_blocking()
+      
+      if (self._pick_video() is None):
+         raise YTError('Unable to pick video fmt; bailing out.')
+      
+      if (self._ts_dl_start is None):
+         self._ts_dl_start = time.time()
+      ts_start = time.time()
+      # Gateways are applied to the original url; our picked one might have been mangled already.
+      dl = YTStripedDownload(self, self.fmt_stream_map[self._fmt], self._choose_tmp_fn(), self._content_length,
+         self.gateways)
+      rv = dl.run()
+      if not (self.throughput is None):
+         self.throughput.add_sample(dl.size_fetched, time.time() - ts_start)
+      return rv
    
    def fetch_video(self):
       from fcntl import fcntl, F_SETFL
@@ -904,12 +1713,20 @@ class YTVideoRef:
       if (url is None):
          raise YTError('Unable to pick video fmt; bailing out.')
       
+      if (self._ts_dl_start is None):
+         self._ts_dl_start = time.time()
       fn_out = self._choose_tmp_fn()
       try:
          f = open(fn_out, 'r+b')
       except IOError:
          f = open(fn_out, 'w+b')
       
+      if (os.path.exists(fn_out + '.parts')):
+         # Left behind by a striped download; we can't tell which parts of the file are valid.
+         self.log(20, 'Discarding partial striped download in {0!a}.'.format(fn_out))
+         f.truncate(0)
+         os.unlink(fn_out + '.parts')
+      
       f.seek(0,2)
       flen = f.tell()
       if (flen > self._content_length):
@@ -970,6 +1787,9 @@ class YTVideoRef:
          cl_g += len(prefix_data)
          self.log(15, 'End of local file matches remote data; resuming download.')
       
+      ts_start = time.time()
+      cl_start = cl_g
+      probe_pending = True
       while (True):
          data_read = res.read(1024*1024)
          if (len(data_read) == 0):
@@ -977,6 +1797,17 @@ class YTVideoRef:
          cl_g += len(data_read)
          self.log(15, 'Progress: {0} ({1:.2%})'.format(cl_g, float(cl_g)/cl))
          f.write(data_read)
+         
+         if (probe_pending and (time.time() - ts_start >= self.rate_probe_time)):
+            probe_pending = False
+            if (self._is_too_slow(cl_g - cl_start, time.time() - ts_start, cl - cl_g)):
+               res.close()
+               f.close()
+               os.unlink(fn_out)
+               raise YTTooSlow('Download of fmt {0} is too slow to finish in time.'.format(self._fmt))
+      
+      if (probe_pending and not (self.throughput is None)):
+         self.throughput.add_sample(cl_g - cl_start, time.time() - ts_start)
       
       if (cl_g != self._content_length):
          raise YTError("Prematurely lost DL connection; expected {0} bytes, got {1}.".format(self._content_length, cl_g))
@@ -984,25 +1815,142 @@ class YTVideoRef:
       f.truncate()
       return f
    
-   def fetch_annotations(self):
-      from io import StringIO
+   def _get_partial_tracks(self):
+      """Return set of mcio_matroska track types to restrict AV data retrieval to, or None if we need all of it.
       
-      url = self.url_get_annots()
+      Data for tracks that will be dropped from our MKV output can be skipped, as long as the container lets us tell which
+      parts of the file it's in."""
+      if not (self.make_mkv and self.drop_tt and (self._mime_type in self.MT_TRACK_SELECTION)):
+         return None
+      import mcio_matroska
+      return frozenset(getattr(mcio_matroska, self._track_type_map[tt][0]) for tt in self._track_type_map
+         if not (tt in self.drop_tt))
+   
+   def _open_span(self, url, off, size):
+      """Open HTTP request for size bytes of content data starting at offset off; returns response object."""
+      res = self.urlopen(url, headers={'Range': 'bytes={0}-{1}'.format(off, off + size - 1)}, mangle=False)
+      if (res.code != 206):
+         res.close()
+         raise YTError('Range request failed; got unexpected HTTP response code {0}.'.format(res.code))
+      return res
+   
+   def _fetch_span(self, url, off, size):
+      """Return size bytes of content data starting at offset off."""
+      res = self._open_span(url, off, size)
+      try:
+         data = res.read(size)
+      finally:
+         res.close()
+      if (len(data) != size):
+         raise YTError('Range request returned {0} bytes; expected {1}.'.format(len(data), size))
+      return data
+   
+   def fetch_range(self):
+      """Fetch the AV data needed for our time range and kept tracks into a sparse local file, and return its filename.
+      
+      This retrieves the container index of the remote file first, and uses it to determine which parts of the file hold
+      the frames starting at the keyframe preceding the start of the range; only those parts are retrieved afterwards.
+      YTMuxJob.demux() applies the same selection when parsing the result, and drops the tracks we didn't get data for."""
+      from mcio_base import ContainerError
+      if (not self._tried_md_fetch):
+         self.get_metadata_blocking()
+      
+      url = self._pick_video()
       if (url is None):
-         self.log(10, 'Skipping annotation retrieval (no URL).')
-         return (None, None, None)
-      self.log(20, 'Fetching annotations from {0!a}.'.format(url))
-      req = self.urlopen(url)
+         raise YTError('Unable to pick video fmt; bailing out.')
       
-      content = req2str(req)
-      self.log(20, 'Parsing annotation data.')
+      pmod = __import__(self.MT_PARSERMODULE_MAP.get(self._mime_type, 'mcio_base'))
+      if not (hasattr(pmod, 'get_range_spans')):
+         raise YTError('Partial downloads of {0!a} data (fmt {1}) are unsupported.'.format(self._mime_type, self._fmt))
       
-      annotations = parse_ytanno(StringIO(content))
-      if (len(annotations) < 1):
-         self.log(20, 'There are no annotations for this video.')
-         return (None, None, None)
+      if (self._ts_dl_start is None):
+         self._ts_dl_start = time.time()
+      cl = self._content_length
+      tracks = self._get_partial_tracks()
+      if (self.t_range is None):
+         t_range = (0, None)
+         desc = 'all times'
+      else:
+         t_range = self.t_range
+         desc = 'time range {0}'.format(fmt_time_range(t_range))
+      if (tracks is None):
+         kwargs = {}
+         tag = ''
+      else:
+         kwargs = {'track_types': tracks}
+         tag = '[-{0}].'.format(self.drop_tt)
+         desc += ' without {0} data'.format('/'.join(self._track_type_map[tt][1] for tt in self.drop_tt))
+      if not (self.t_range is None):
+         tag += '[{0}].'.format(fmt_time_range(t_range))
       
-      annotations.sort()
+      fn_out = self._choose_tmp_fn(tag + self.MT_EXT_MAP.get(self._mime_type, 'bin'))
+      f = open(fn_out, 'w+b')
+      try:
+         self.log(20, 'Fetching container index from {0!r}.'.format(url))
+         try:
+            pmod.fetch_index(f, lambda off, size: self._fetch_span(url, off, size), cl)
+            spans = pmod.get_range_spans(f, t_range, cl, **kwargs)
+         except (ContainerError, ValueError) as exc:
+            raise YTError('Unable to map {0} to data in fmt {1}.'.format(desc, self._fmt)) from exc
+         
+         size_needed = sum(size for (off, size) in spans)
+         if (tracks is None):
+            gap_max = self.range_gap_max
+         else:
+            gap_max = self.range_gap_max_tracks
+         spans = coalesce_spans(spans, gap_max, self.range_requests_max)
+         size_total = sum(size for (off, size) in spans)
+         self.log(20, 'Fetching {0} bytes ({1:.2%} of {2}; {3} bytes needed) in {4} span(s) for {5}.'.format(size_total,
+            size_total/cl, cl, size_needed, len(spans), desc))
+         
+         ts_start = time.time()
+         cl_g = 0
+         for (off, size) in spans:
+            res = self._open_span(url, off, size)
+            try:
+               f.seek(off)
+               off_lim = off + size
+               while (off < off_lim):
+                  data_read = res.read(min(1024*1024, off_lim - off))
+                  if (len(data_read) == 0):
+                     raise YTError("Prematurely lost DL connection at offset {0}; expected data up to {1}.".format(off,
+                        off_lim))
+                  f.write(data_read)
+                  off += len(data_read)
+                  cl_g += len(data_read)
+                  self.log(15, 'Progress: {0} ({1:.2%})'.format(cl_g, float(cl_g)/size_total))
+            finally:
+               res.close()
+         
+         if not (self.throughput is None):
+            self.throughput.add_sample(cl_g, time.time() - ts_start)
+      except BaseException:
+         f.close()
+         os.unlink(fn_out)
+         raise
+      
+      f.close()
+      return fn_out
+   
+   def fetch_annotations(self):
+      from io import StringIO
+      
+      url = self.url_get_annots()
+      if (url is None):
+         self.log(10, 'Skipping annotation retrieval (no URL).')
+         return (None, None, None)
+      self.log(20, 'Fetching annotations from {0!a}.'.format(url))
+      req = self.urlopen(url)
+      
+      content = req2str(req)
+      self.log(20, 'Parsing annotation data.')
+      
+      annotations = parse_ytanno(StringIO(content))
+      if (len(annotations) < 1):
+         self.log(20, 'There are no annotations for this video.')
+         return (None, None, None)
+      
+      annotations.sort()
       sts_raw = ASSSubSet('annotations (unfiltered)')
       sts_raw.add_subs_from_yt_annotations(annotations)
       sts_nospam = ASSSubSet('annotations (spam filtered)')
@@ -1128,52 +2076,304 @@ class YTVideoRef:
       return rv
    
    def _pick_video(self, cache_ok=True):
-      from urllib.parse import splittype, splithost
-      from urllib.error import HTTPError
-      
       if (cache_ok and self._content_direct_url):
          return self._content_direct_url
       
       if (not self._tried_md_fetch):
          self.get_metadata_blocking()
       
+      budget = self._get_time_budget()
+      if ((budget is None) or (self.throughput is None)):
+         rate = None
+      else:
+         rate = self.throughput.get_rate()
+      too_slow = []
+      
+      candidates = []
       for fmt in self.fpl:
          if (fmt == FMT_DEFAULT):
             continue
-         try:
-            url_r = self.fmt_stream_map[fmt]
-         except KeyError:
+         if (fmt in self._fmts_excluded):
+            self.log(20, 'Skipping fmt {0}, which turned out too slow to download.'.format(fmt))
+            continue
+         if not (fmt in self.fmt_stream_map):
             self.log(20, 'No url for fmt {0} available.'.format(fmt))
             continue
+         candidates.append(fmt)
+      
+      # Probes can run in parallel and in any order, but we always pick the first working fmt in preference order; so
+      # results are evaluated in that order, and more probes started whenever we run into a fmt we haven't probed yet.
+      results = {}
+      for fmt in candidates:
+         if not (fmt in results):
+            results.update(self._probe_fmts([f for f in candidates if not (f in results)]))
          
-         url = self.mangle_yt_url(url_r)
-         
-         try:
-            response = self.urlopen(url)
-         except URLError as exc:
-            self.log(20, 'Tried to get video in fmt {0} and failed (urlopen exc {1!a}.)'.format(fmt, exc))
+         probe_res = results[fmt]
+         if (probe_res is None):
             continue
-         
+         (url, mime_type, content_length) = probe_res
+         if not ((rate is None) or (content_length/rate <= budget)):
+            self.log(20, 'Fmt {0} would take an estimated {1:.0f}s to download, but we only have {2:.0f}s left; '
+               'trying other fmts.'.format(fmt, content_length/rate, budget))
+            too_slow.append((content_length, fmt, mime_type, url))
+            continue
+         self.log(20, 'Fmt {0} is good ... using that.'.format(fmt))
+         self._use_fmt(fmt, mime_type, content_length, url)
+         return url
+      
+      if (too_slow):
+         (content_length, fmt, mime_type, url) = min(too_slow)
+         self.log(30, 'No fmt is expected to download in time; using the smallest one (fmt {0}).'.format(fmt))
+         self._use_fmt(fmt, mime_type, content_length, url)
+         return url
+      self.log(38, 'None of the attempted formats worked out.')
+      return None
+   
+   def _probe_fmts(self, fmts):
+      """Probe some of the specified fmts (given in preference order), and return dict mapping each probed fmt to the
+      _probe_url() result for it.
+      
+      The first fmt is always probed. Up to probe_concurrency fmts are probed in parallel; if there's room for more than
+      the first one, we add the ones most likely to end up as our choice according to our fmt stats, skipping any whose
+      chance of that is below probe_min_p."""
+      count = min(self.probe_concurrency, len(fmts))
+      if (count <= 1):
+         batch = fmts[:1]
+      else:
+         # Probability of each fmt being the first one that works.
+         p_win = []
+         p_none = 1.0
+         for (i, fmt) in enumerate(fmts):
+            if (self.fmt_stats is None):
+               p = 0.5
+            else:
+               p = self.fmt_stats.get_p(fmt, self.fmt_stats_keys)
+            p_win.append((p_none*p, -i, fmt))
+            p_none *= (1-p)
+         batch = [fmts[0]] + [fmt for (p, i, fmt) in sorted(p_win[1:], reverse=True)[:count-1] if (p >= self.probe_min_p)]
+      
+      if (len(batch) == 1):
+         rv = {batch[0]: self._probe_url(batch[0])}
+      else:
+         from concurrent.futures import ThreadPoolExecutor
+         self.log(15, 'Probing fmts {0} in parallel.'.format(batch))
+         with ThreadPoolExecutor(len(batch)) as executor:
+            rv = dict(zip(batch, executor.map(self._probe_url, batch)))
+      
+      if not (self.fmt_stats is None):
+         for (fmt, probe_res) in rv.items():
+            self.fmt_stats.add(fmt, self.fmt_stats_keys, not (probe_res is None))
+      return rv
+   
+   def _probe_url(self, fmt):
+      """Check whether YT serves the direct url for specified fmt; returns (url, mime type, content length) if it does,
+      and None otherwise."""
+      url = self.mangle_yt_url(self.fmt_stream_map[fmt])
+      
+      try:
+         response = self.urlopen(url, headers={'Range': 'bytes=0-0'})
+      except URLError as exc:
+         self.log(20, 'Tried to get video in fmt {0} and failed (urlopen exc {1!a}.)'.format(fmt, exc))
+         return None
+      
+      try:
          rc = response.getcode()
          url = response.geturl()
-         
-         if (rc == 200):
-            mime_type = response.getheader('content-type', None)
+         mime_type = response.getheader('content-type', None)
+         content_length = None
+         if (rc == 206):
+            content_range = response.getheader('content-range', '')
+            if ('/' in content_range):
+               content_length = content_range.rsplit('/', 1)[1].strip()
+         elif (rc == 200):
+            # No range support on the other side; we don't care about the body, though.
             content_length = response.getheader('content-length', None)
-            if not (content_length is None):
-               content_length = int(content_length)
-               self.log(20, 'Fmt {0} is good ... using that.'.format(fmt))
-               self._mime_type = mime_type
-               self._fmt = fmt
-               self._content_length = content_length
-               self._content_direct_url = url
-               return url
-         
-         self.log(20, 'Tried to get video in fmt {0} and failed (http response {1!a}).'.format(fmt, rc))
-         
+      finally:
+         response.close()
+      
+      if not (content_length is None):
+         try:
+            return (url, mime_type, int(content_length))
+         except ValueError:
+            pass
+      
+      self.log(20, 'Tried to get video in fmt {0} and failed (http response {1!a}).'.format(fmt, rc))
+      return None
+   
+   def _use_fmt(self, fmt, mime_type, content_length, url):
+      self._mime_type = mime_type
+      self._fmt = fmt
+      self._content_length = content_length
+      self._content_direct_url = url
+      self._content_url_ts = time.time()
+   
+   def _get_time_budget(self):
+      """Return number of seconds we have left for downloading this video, or None if there's no limit."""
+      now = time.time()
+      rv = None
+      if not (self.max_time is None):
+         if (self._ts_dl_start is None):
+            rv = self.max_time
+         else:
+            rv = self.max_time - (now - self._ts_dl_start)
+      if not (self.deadline is None):
+         if ((rv is None) or (self.deadline - now < rv)):
+            rv = self.deadline - now
+      return rv
+   
+   def _have_fallback_fmt(self):
+      """Return whether our preference list has a usable fmt after the currently picked one."""
+      try:
+         idx = list(self.fpl).index(self._fmt)
+      except ValueError:
+         return False
+      for fmt in self.fpl[idx+1:]:
+         if ((fmt == FMT_DEFAULT) or (fmt in self._fmts_excluded)):
+            continue
+         if (fmt in self.fmt_stream_map):
+            return True
+      return False
+   
+   def _is_too_slow(self, size, duration, remaining):
+      """Check transfer rate measured over the first part of a download against our time budget."""
+      if not (self.throughput is None):
+         self.throughput.add_sample(size, duration)
+      budget = self._get_time_budget()
+      if (budget is None):
+         return False
+      if (size > 0):
+         eta = remaining*duration/size
       else:
-         self.log(38, 'None of the attempted formats worked out.')
-         return None
+         eta = float('inf')
+      if (eta <= budget):
+         return False
+      
+      if not (self._have_fallback_fmt()):
+         self.log(30, 'Download of fmt {0} is expected to take another {1:.0f}s, but we only have {2:.0f}s left; no '
+            'fallback fmts available, so continuing anyway.'.format(self._fmt, eta, budget))
+         return False
+      self.log(20, 'Download of fmt {0} is expected to take another {1:.0f}s, but we only have {2:.0f}s left; falling '
+         'back to a later fmt.'.format(self._fmt, eta, budget))
+      return True
+
+
+class YTMuxJob:
+   """Local part of building a MKV file for a single video.
+   
+   Instances are built by YTVideoRef.fetch_data_raw(), and carry everything needed to demux the raw AV file and mux it
+   together with any downloaded sub data; they don't reference the YTVideoRef they were built from."""
+   logger = logging.getLogger('YTMuxJob')
+   log = logger.log
+   
+   def __init__(self, vid, fn_raw, mime_type, fn_final, file_title, drop_tt='', fmt=None, dtm=0, t_range=None):
+      self.vid = vid
+      self.fn_raw = fn_raw
+      self.mime_type = mime_type
+      self.fn_final = fn_final
+      self.file_title = file_title
+      self.drop_tt = drop_tt
+      self.fmt = fmt
+      self.dtm = dtm
+      # Time range (in seconds) to restrict AV data to, or None.
+      self.t_range = t_range
+      self.sub_sets = []
+      self.track_types = None
+      self.keep_raw = False
+      # Id of YTSpaceReserver reservation covering this job, if any.
+      self.space_reservation = None
+      self.mkvb = None
+      self._f_raw = None
+   
+   def demux(self):
+      """Parse raw AV data (if any), and build MatroskaBuilder including all tracks to write."""
+      import mcio_matroska
+      if (self.fn_raw is None):
+         # Sub only MKV files; kinda a weird case, but let's support it anyway.
+         mkvb = mcio_matroska.MatroskaBuilder(1000000, None)
+      else:
+         self.log(20, 'Demuxing raw AV data from {0!a}.'.format(self.fn_raw))
+         modname = YTVideoRef.MT_PARSERMODULE_MAP[self.mime_type]
+         pmod = __import__(modname)
+         self._f_raw = open(self.fn_raw, 'rb')
+         if (self.t_range is None):
+            mkvb = pmod.make_mkvb_from_file(self._f_raw)
+         elif (hasattr(pmod, 'get_range_spans')):
+            mkvb = pmod.make_mkvb_from_file(self._f_raw, t_range=self.t_range)
+         else:
+            raise YTError('Time range extraction from {0!a} data is unsupported.'.format(self.mime_type))
+         mkvb.sort_tracks()
+      
+      mkvb.set_writingapp('Yet Another Video DownLoad Tool (unversioned)')
+      mkvb.set_segment_title(self.file_title)
+      if not (self.fn_raw is None):
+         mkvb.set_track_name(0, self.file_title)
+      
+      for sts in self.sub_sets:
+         sts.mkv_add_track(mkvb)
+      
+      if (self.drop_tt):
+         for tt in self.drop_tt:
+            (tt_attr, tt_name_hr) = YTVideoRef._track_type_map[tt]
+            tt_mkv = getattr(mcio_matroska, tt_attr)
+            tracks = mkvb.get_tracks_by_type(tt_mkv)
+            self.log(20, 'Dropping {:d} {} track(s) from file as requested.'.format(len(tracks), tt_name_hr))
+            for track in tracks:
+               mkvb.drop_track(track.get_track_id())
+         mkvb.sort_tracks()
+      
+      tt_map = {mcio_matroska.TRACKTYPE_VIDEO: 'v', mcio_matroska.TRACKTYPE_AUDIO: 'a', mcio_matroska.TRACKTYPE_SUB: 's'}
+      self.track_types = ''.join(sorted(set(tt_map.get(t.get_track_type(), '?') for t in mkvb.tracks.sub)))
+      self.mkvb = mkvb
+   
+   def mux(self):
+      """Write MKV data to final file, and clean up the raw AV file. Returns filename of final file."""
+      if (self.mkvb is None):
+         self.demux()
+      
+      # The file is written in the final directory, but only linked to its final name once complete.
+      self.log(20, 'Writing MKV data to {0!a}.'.format(self.fn_final))
+      try:
+         af = AtomicFile(self.fn_final)
+         try:
+            self.mkvb.write_to_file(af.f)
+            af.commit()
+         except BaseException:
+            af.abort()
+            raise
+      finally:
+         self.close()
+      
+      if not ((self.fn_raw is None) or self.keep_raw):
+         # MKV write cycle is finished, and the MKV file is safely on disk; remove the raw video file.
+         os.unlink(self.fn_raw)
+         fsync_dir(os.path.dirname(self.fn_raw))
+      return self.fn_final
+   
+   def close(self):
+      """Discard any demuxed data and release raw AV file."""
+      self.mkvb = None
+      if not (self._f_raw is None):
+         self._f_raw.close()
+         self._f_raw = None
+   
+   def discard(self):
+      """Clean up after a failed job: close, and remove partial MKV output.
+      
+      The raw AV file is kept, so a later run can mux it without downloading it again."""
+      self.close()
+      # AtomicFile cleans up after itself, unless the process writing it died; e.g. in a mux pool.
+      dn = os.path.dirname(self.fn_final) or '.'
+      prefix = '.{0}.'.format(os.path.basename(self.fn_final))
+      try:
+         names = os.listdir(dn)
+      except OSError:
+         names = ()
+      for name in names:
+         if (name.startswith(prefix) and name.endswith('.tmp')):
+            try:
+               os.unlink(os.path.join(dn, name))
+            except OSError:
+               pass
 
 
 class YTPlayListRef:
@@ -1229,9 +2429,11 @@ class YTPlayListRef:
    
 
 class YTVideoInfo:
-  def __init__(self, vid, upload_ts):
+  def __init__(self, vid, upload_ts, source=None):
     self.vid = vid
     self.upload_ts = upload_ts
+    # (kind, id) tuple describing where we got this vid from; e.g. ('user', <user id>) or ('playlist', <playlist id>)
+    self.source = source
 
   def __eq__(self, other):
     return (self.vid == other.vid)
@@ -1299,7 +2501,7 @@ class YTUserRef:
         node_vids = spec2vidset(watch_url, fallback=False)
 
         for vid in node_vids:
-           vi = YTVideoInfo(vid, pts)
+           vi = YTVideoInfo(vid, pts, ('user', self.user_id))
            if (vi in vis_set):
               continue
            vis_set.add(vi)
@@ -1320,6 +2522,1198 @@ class YTUserRef:
       #raise
 
 
+# ---------------------------------------------------------------- Local video catalog
+YTCatalogEntry = collections.namedtuple('YTCatalogEntry', ('vid', 'variant', 'path', 'fmt', 'size', 'digest', 'dtm',
+   'track_types', 'subtitles', 'ts'))
+
+class YTCatalog:
+   """SQLite-backed index of finished downloads, keyed by (video id, output variant).
+   
+   The variant distinguishes the different kinds of output we can produce for a single video: 'raw' for unmuxed AV
+   files (plus separate sub files), 'mkv' for MKV files, and e.g. 'mkv[-v]' for MKV files with dropped track types. This
+   allows deciding whether a video needs processing without fetching any metadata."""
+   logger = logging.getLogger('YTCatalog')
+   log = logger.log
+   
+   re_fn = re.compile(r'^yt_.*\.\[(?P<vid>[A-Za-z0-9_-]{11})\]\[(?P<fmt>[0-9]+)\]\.(?P<ext>.*)$')
+   re_ext_mkv = re.compile(r'^(?:\[-(?P<drop_tt>[a-z]+)\]\.)?(?:\[(?P<t_range>[0-9.]+-[0-9.]*)\]\.)?mkv$')
+   
+   def __init__(self, fn):
+      import sqlite3
+      import threading
+      self.fn = fn
+      self._lock = threading.Lock()
+      # We're shared among pipeline worker threads; all access is serialized through self._lock.
+      self._db = sqlite3.connect(fn, check_same_thread=False)
+      self._db.execute('CREATE TABLE IF NOT EXISTS files (vid TEXT NOT NULL, variant TEXT NOT NULL, path TEXT, '
+         'fmt INTEGER, size INTEGER, digest TEXT, dtm INTEGER NOT NULL, track_types TEXT, subtitles TEXT, ts REAL, '
+         'PRIMARY KEY (vid, variant))')
+      self._db.commit()
+   
+   @staticmethod
+   def get_variant(make_mkv, drop_tt='', t_range=''):
+      if not (make_mkv):
+         return 'raw'
+      rv = 'mkv'
+      if (drop_tt):
+         rv += '[-{0}]'.format(drop_tt)
+      if (t_range):
+         rv += '[{0}]'.format(t_range)
+      return rv
+   
+   @staticmethod
+   def _file_digest(fn):
+      from hashlib import sha256
+      h = sha256()
+      f = open(fn, 'rb')
+      try:
+         while (True):
+            data = f.read(1024*1024)
+            if not (data):
+               break
+            h.update(data)
+      finally:
+         f.close()
+      return h.hexdigest()
+   
+   @staticmethod
+   def _row2entry(row):
+      import json
+      row = list(row)
+      if not (row[8] is None):
+         row[8] = [tuple(s) for s in json.loads(row[8])]
+      return YTCatalogEntry(*row)
+   
+   def lookup(self, vid, variant):
+      """Return YTCatalogEntry for specified video and variant, or None if there isn't one."""
+      with self._lock:
+         row = self._db.execute('SELECT * FROM files WHERE vid=? AND variant=?', (vid, variant)).fetchone()
+      if (row is None):
+         return None
+      return self._row2entry(row)
+   
+   def find_done(self, vid, variant, fpl, dtm):
+      """Return catalog entry if it shows this video as done in a format from fpl for all data types in dtm, else None."""
+      entry = self.lookup(vid, variant)
+      if (entry is None):
+         return None
+      if not (entry.fmt in fpl):
+         return None
+      if ((entry.dtm & dtm) != dtm):
+         return None
+      if not ((entry.path is None) or os.path.exists(entry.path)):
+         self.log(30, 'Cataloged file {0!a} for video {1!a} has disappeared; ignoring entry.'.format(entry.path, vid))
+         return None
+      return entry
+   
+   def record(self, vid, variant, path, fmt, dtm, track_types=None, subtitles=None, merge=False, digest=None):
+      """Add or replace entry for a finished file.
+      
+      If merge is true and an entry for the same format exists already, the data types and subtitles of the old entry
+      are added to the new one; this is used for raw files, where AV data and subs can be retrieved in separate runs.
+      The digest of an existing entry for the same file is kept if the file hasn't changed size or been modified since;
+      otherwise, it's computed from the file unless passed in."""
+      import json
+      old = self.lookup(vid, variant)
+      if (path is None):
+         size = None
+      else:
+         path = os.path.abspath(path)
+         st = os.stat(path)
+         size = st.st_size
+         if ((digest is None) and not (old is None) and (old.path == path) and (old.size == size) and
+               (st.st_mtime < old.ts)):
+            # Cataloged before, and unchanged since; don't read it all again.
+            digest = old.digest
+         if (digest is None):
+            digest = self._file_digest(path)
+      
+      if (subtitles is not None):
+         subtitles = [tuple(s) for s in subtitles]
+      
+      if (merge):
+         if not ((old is None) or (old.fmt != fmt)):
+            dtm |= old.dtm
+            if (path is None):
+               (path, size, digest) = (old.path, old.size, old.digest)
+            if (track_types is None):
+               track_types = old.track_types
+            if not (old.subtitles is None):
+               subtitles = list(old.subtitles) + [s for s in (subtitles or ()) if not (s in old.subtitles)]
+      
+      if not (subtitles is None):
+         subtitles = json.dumps(subtitles)
+      with self._lock:
+         self._db.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?,?,?)', (vid, variant, path, fmt, size,
+            digest, dtm, track_types, subtitles, time.time()))
+         self._db.commit()
+      self.log(20, 'Cataloged {0} output for video {1!a} ({2!a}).'.format(variant, vid, path))
+   
+   def record_mux_job(self, job):
+      """Add entry for the final file of a finished YTMuxJob."""
+      self.record(job.vid, self.get_variant(True, job.drop_tt, fmt_time_range(job.t_range)), job.fn_final, job.fmt, job.dtm, job.track_types,
+         [(sts.name, sts.lc) for sts in job.sub_sets])
+   
+   def rebuild(self, path):
+      """Replace all entries for files below path with entries built from the files currently there.
+      
+      This only has the information encoded in the filenames to work with: MKV files are assumed to include all data types
+      (as they're only written once all data for a video has been retrieved), while raw AV files are combined with
+      any sub files written alongside them. Digests of files whose path and size match the old entry are kept.
+      Returns the number of entries written."""
+      path = os.path.abspath(path)
+      prefix = os.path.join(path, '')
+      dtm_all = DATATYPE_VIDEO | DATATYPE_ANNOTATIONS | DATATYPE_TIMEDTEXT
+      exts_av = set(YTVideoRef.MT_EXT_MAP.values())
+      exts_av.add('bin')
+      
+      with self._lock:
+         old = {}
+         for row in self._db.execute('SELECT path, size, digest FROM files WHERE path IS NOT NULL'):
+            old[row[0]] = row[1:]
+      
+      # (vid, variant) -> [fmt, path, mtime, dtm, subtitles]
+      found = {}
+      def add(vid, variant, fmt, fn, dtm, subtitles=()):
+         key = (vid, variant)
+         mtime = os.path.getmtime(fn)
+         try:
+            e = found[key]
+         except KeyError:
+            e = found[key] = [fmt, None, None, 0, set()]
+         
+         if (e[0] != fmt):
+            if (mtime < e[2]):
+               self.log(20, 'Ignoring {0!a}; have a more recent {1} file for video {2!a}.'.format(fn, variant, vid))
+               return
+            self.log(20, 'Preferring more recent {0!a} for video {1!a}.'.format(fn, vid))
+            found[key] = e = [fmt, None, None, 0, set()]
+         
+         if (dtm & DATATYPE_VIDEO):
+            e[1] = fn
+         if ((e[2] is None) or (mtime > e[2])):
+            e[2] = mtime
+         e[3] |= dtm
+         e[4].update(subtitles)
+      
+      for (dirpath, dirnames, filenames) in os.walk(path):
+         dirnames.sort()
+         for fn in sorted(filenames):
+            m = self.re_fn.match(fn)
+            if (m is None):
+               continue
+            fn = os.path.join(dirpath, fn)
+            vid = m.group('vid')
+            fmt = int(m.group('fmt'))
+            ext = m.group('ext')
+            
+            m_mkv = self.re_ext_mkv.match(ext)
+            if not (m_mkv is None):
+               drop_tt = m_mkv.group('drop_tt') or ''
+               add(vid, self.get_variant(True, drop_tt, m_mkv.group('t_range') or ''), fmt, fn, dtm_all)
+            elif (ext in exts_av):
+               add(vid, 'raw', fmt, fn, DATATYPE_VIDEO)
+            elif (ext in ('ass', 'nospam.ass')):
+               if (ext == 'ass'):
+                  name = 'annotations (unfiltered)'
+               else:
+                  name = 'annotations (spam filtered)'
+               add(vid, 'raw', fmt, fn, DATATYPE_ANNOTATIONS, ((name, None),))
+            elif (ext.endswith('.ass')):
+               (lc, name) = (ext[:-4].split('_', 1) + [''])[:2]
+               add(vid, 'raw', fmt, fn, DATATYPE_TIMEDTEXT, ((name, lc or None),))
+      
+      with self._lock:
+         self._db.execute("DELETE FROM files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
+         self._db.commit()
+      
+      for ((vid, variant), (fmt, fn, mtime, dtm, subtitles)) in sorted(found.items()):
+         digest = None
+         if not (fn is None):
+            try:
+               (size, digest) = old[fn]
+            except KeyError:
+               pass
+            else:
+               if (size != os.path.getsize(fn)):
+                  digest = None
+         
+         if (variant == 'raw'):
+            subtitles = sorted(subtitles, key=str)
+         else:
+            # Can't tell which subs an existing MKV file contains without parsing it.
+            subtitles = None
+         self.record(vid, variant, fn, fmt, dtm, subtitles=subtitles, digest=digest)
+      
+      self.log(20, 'Rebuilt catalog for {0!a}: {1:d} entries.'.format(path, len(found)))
+      return len(found)
+   
+   def move(self, path_old, path_new):
+      """Update entries to reflect file rename from path_old to path_new."""
+      with self._lock:
+         self._db.execute('UPDATE files SET path=? WHERE path=?', (os.path.abspath(path_new), os.path.abspath(path_old)))
+         self._db.commit()
+   
+   def close(self):
+      with self._lock:
+         self._db.close()
+
+
+# ---------------------------------------------------------------- Raw AV data store
+YTBlobInfo = collections.namedtuple('YTBlobInfo', ('vid', 'fmt', 'length', 'digest', 'mime_type', 'title', 'path'))
+
+class YTBlobStore:
+   """Content-addressed store for raw AV downloads.
+   
+   Raw AV files are stored as objects/<xx>/<sha256 digest>, and indexed by the (video id, fmt, content length) they were
+   downloaded as in index/<vid>/<fmt>.<length> files; index entries also record the mime type and video title, so output
+   files can be built from stored data without fetching any YT metadata.
+   Output files are made from objects by hardlinking where possible, falling back to reflinking and finally copying."""
+   logger = logging.getLogger('YTBlobStore')
+   log = logger.log
+   
+   def __init__(self, path, verify=True):
+      self.path = path
+      self.verify = verify
+      self.path_objects = os.path.join(path, 'objects')
+      self.path_index = os.path.join(path, 'index')
+      os.makedirs(self.path_objects, exist_ok=True)
+      os.makedirs(self.path_index, exist_ok=True)
+   
+   def _get_obj_fn(self, digest):
+      return os.path.join(self.path_objects, digest[:2], digest)
+   
+   def _get_index_fn(self, vid, fmt, length):
+      return os.path.join(self.path_index, vid, '{0}.{1:d}'.format(fmt, length))
+   
+   def _read_entry(self, fn):
+      import json
+      f = open(fn, 'rb')
+      try:
+         d = json.loads(f.read().decode('utf-8'))
+      finally:
+         f.close()
+      return YTBlobInfo(d['vid'], d['fmt'], d['length'], d['digest'], d['mime_type'], d['title'],
+         self._get_obj_fn(d['digest']))
+   
+   def _check(self, bi, fn_index):
+      try:
+         size = os.path.getsize(bi.path)
+      except OSError:
+         size = None
+      
+      if (size != bi.length):
+         err = 'size mismatch (expected {0}, got {1})'.format(bi.length, size)
+      elif (self.verify and (YTCatalog._file_digest(bi.path) != bi.digest)):
+         err = 'digest mismatch'
+      else:
+         return True
+      
+      self.log(30, 'Stored data for video {0!a} fmt {1} failed verification: {2}; discarding it.'.format(bi.vid, bi.fmt,
+         err))
+      os.unlink(fn_index)
+      # Objects are named by digest; leaving a corrupt one in place would have add() reuse it for the next download of
+      # the same data. Any other index entries for it will fail their checks and be discarded in turn.
+      try:
+         os.unlink(bi.path)
+      except FileNotFoundError:
+         pass
+      return False
+   
+   def find(self, vid, fpl):
+      """Return YTBlobInfo for the most preferred fmt in fpl we have verified data for, or None if there isn't one."""
+      try:
+         names = os.listdir(os.path.join(self.path_index, vid))
+      except OSError:
+         return None
+      
+      candidates = {}
+      for name in names:
+         try:
+            (fmt, length) = name.split('.')
+            fmt = int(fmt)
+            int(length)
+         except ValueError:
+            continue
+         fn = os.path.join(self.path_index, vid, name)
+         candidates.setdefault(fmt, []).append((os.path.getmtime(fn), fn))
+      
+      for fmt in fpl:
+         # If there's more than one content length for this fmt, prefer the most recently stored one.
+         for (mtime, fn) in sorted(candidates.get(fmt, ()), reverse=True):
+            try:
+               bi = self._read_entry(fn)
+            except (IOError, ValueError, KeyError):
+               self.log(30, 'Unable to read blob index entry {0!a}; ignoring it.'.format(fn), exc_info=True)
+               continue
+            if (self._check(bi, fn)):
+               return bi
+      return None
+   
+   def add(self, vid, fmt, length, mime_type, title, fn):
+      """Move file fn into the store, and return YTBlobInfo for it."""
+      import json
+      digest = YTCatalog._file_digest(fn)
+      fn_obj = self._get_obj_fn(digest)
+      os.makedirs(os.path.dirname(fn_obj), exist_ok=True)
+      if (os.path.exists(fn_obj)):
+         self.log(20, 'Have data for video {0!a} fmt {1} stored already.'.format(vid, fmt))
+         os.unlink(fn)
+      else:
+         self.log(20, 'Storing data for video {0!a} fmt {1} as {2!a}.'.format(vid, fmt, fn_obj))
+         move_file(fn, fn_obj)
+      
+      if isinstance(title, bytes):
+         title = title.decode('utf-8')
+      fn_index = self._get_index_fn(vid, fmt, length)
+      os.makedirs(os.path.dirname(fn_index), exist_ok=True)
+      fn_index_tmp = '{0}.{1:d}.tmp'.format(fn_index, os.getpid())
+      f = open(fn_index_tmp, 'wb')
+      f.write(json.dumps(dict(vid=vid, fmt=fmt, length=length, digest=digest, mime_type=mime_type, title=title)).encode(
+         'utf-8'))
+      f.flush()
+      os.fsync(f.fileno())
+      f.close()
+      os.replace(fn_index_tmp, fn_index)
+      fsync_dir(os.path.dirname(fn_index))
+      return YTBlobInfo(vid, fmt, length, digest, mime_type, title, fn_obj)
+   
+   def link_out(self, fn_obj, fn_out):
+      """Make file fn_out with the content of object fn_obj, sharing storage with it if we can."""
+      try:
+         os.link(fn_obj, fn_out)
+      except OSError:
+         pass
+      else:
+         fsync_dir(os.path.dirname(fn_out))
+         self.log(20, 'Hardlinked {0!a} to stored data.'.format(fn_out))
+         return
+      
+      f_in = open(fn_obj, 'rb')
+      try:
+         af = AtomicFile(fn_out)
+         try:
+            method = copy_file_data(f_in, af.f)
+            af.commit()
+         except BaseException:
+            af.abort()
+            raise
+      finally:
+         f_in.close()
+      self.log(20, 'Made {0!a} from stored data by {1}.'.format(fn_out, method))
+
+
+# ---------------------------------------------------------------- Output directory layouts
+class YTOutputLayout:
+   """Mapping of videos to output directories below the final download path.
+   
+   Available layouts:
+     flat: all files go directly into the final download path
+     vid: shard by the first shard_len characters of the video id
+     source: sort into user/<user id>/ and playlist/<playlist id>/ subdirectories, based on where we got the video id;
+       videos specified directly go into other/
+     date: sort into <year>/<month>/ subdirectories by upload time (UTC); videos with unknown upload time go into
+       undated/
+   Source and upload time information is taken from a mapping of video ids to YTVideoInfo instances, as collected by
+   Config._get_vids()."""
+   logger = logging.getLogger('YTOutputLayout')
+   log = logger.log
+   
+   LAYOUTS = ('flat', 'vid', 'source', 'date')
+   
+   def __init__(self, name, vid_infos=None, shard_len=2):
+      if not (name in self.LAYOUTS):
+         raise ValueError('Unknown output layout {0!a}; available layouts are {1}.'.format(name, self.LAYOUTS))
+      if (shard_len < 1):
+         raise ValueError('Invalid shard length {0!a}.'.format(shard_len))
+      self.name = name
+      if (vid_infos is None):
+         vid_infos = {}
+      self.vid_infos = vid_infos
+      self.shard_len = shard_len
+   
+   @staticmethod
+   def _sanitize(s):
+      s = s.replace('/', '').replace('\x00', '')
+      if (s in ('', '.', '..')):
+         s = '_'
+      return s
+   
+   def get_subdir(self, vid):
+      """Return path of output directory for specified video, relative to the final download path."""
+      if (self.name == 'flat'):
+         return ''
+      if (self.name == 'vid'):
+         return vid[:self.shard_len]
+      
+      vi = self.vid_infos.get(vid)
+      if (self.name == 'source'):
+         if ((vi is None) or (vi.source is None)):
+            return 'other'
+         (kind, sid) = vi.source
+         return os.path.join(kind, self._sanitize(sid))
+      
+      if ((vi is None) or (vi.upload_ts is None)):
+         return 'undated'
+      return time.strftime('%Y{0}%m'.format(os.sep), time.gmtime(vi.upload_ts))
+   
+   def get_dir(self, base_path, vid):
+      return os.path.join(base_path, self.get_subdir(vid))
+   
+   def migrate(self, path, catalog=None):
+      """Move all output files below path to where this layout puts them, and update catalog entries to match.
+      
+      Temporary files are left alone, as are files whose target exists already. Directories emptied by the move are
+      removed. Returns the number of files moved."""
+      count = 0
+      dirs_src = set()
+      moves = []
+      for (dirpath, dirnames, filenames) in os.walk(path):
+         for fn in filenames:
+            m = YTCatalog.re_fn.match(fn)
+            if ((m is None) or fn.endswith('.tmp')):
+               continue
+            fn_src = os.path.join(dirpath, fn)
+            dir_dst = self.get_dir(path, m.group('vid'))
+            if (os.path.abspath(dirpath) == os.path.abspath(dir_dst)):
+               continue
+            moves.append((fn_src, dir_dst, fn))
+      
+      # Don't move anything before we're done scanning; renames into subdirectories of path would mess up os.walk().
+      self.log(20, 'Moving {0:d} files below {1!a} into {2} layout.'.format(len(moves), path, self.name))
+      for (fn_src, dir_dst, fn) in sorted(moves):
+         fn_dst = os.path.join(dir_dst, fn)
+         if (os.path.exists(fn_dst)):
+            self.log(30, 'Not moving {0!a}: target {1!a} exists already.'.format(fn_src, fn_dst))
+            continue
+         os.makedirs(dir_dst, exist_ok=True)
+         os.rename(fn_src, fn_dst)
+         if not (catalog is None):
+            catalog.move(fn_src, fn_dst)
+         dirs_src.add(os.path.dirname(fn_src))
+         count += 1
+      
+      path_abs = os.path.abspath(path)
+      for dirpath in sorted(dirs_src, key=len, reverse=True):
+         dirpath = os.path.abspath(dirpath)
+         while (dirpath.startswith(os.path.join(path_abs, ''))):
+            try:
+               os.rmdir(dirpath)
+            except OSError:
+               # Not empty; this also covers its parents.
+               break
+            dirpath = os.path.dirname(dirpath)
+      
+      self.log(20, 'Moved {0:d} files.'.format(count))
+      return count
+
+
+# ---------------------------------------------------------------- Batch processing pipeline
+_mux_worker_starts = None
+
+def _mux_worker_init(mem_limit, loglevel, starts):
+   """Initializer for YTMuxPool worker processes."""
+   global _mux_worker_starts
+   _mux_worker_starts = starts
+   if not (logging.getLogger().handlers):
+      # Spawned (as opposed to forked) workers don't inherit our logging setup.
+      logging.basicConfig(format='%(asctime)s %(levelname)s [mux-process %(process)d] %(message)s', stream=sys.stderr,
+         level=loglevel)
+   
+   if (mem_limit is None):
+      return
+   try:
+      import resource
+   except ImportError:
+      logging.getLogger('YTMuxPool').log(30, 'Unable to limit mux worker memory use on this platform; ignoring limit.')
+      return
+   resource.setrlimit(resource.RLIMIT_AS, (mem_limit, mem_limit))
+
+def _mux_worker_run(job, token):
+   """Run a YTMuxJob in a YTMuxPool worker process; returns the finished job."""
+   # Tell the parent this job is running, so it knows whom to suspect if we die.
+   _mux_worker_starts.put(token)
+   job.mux()
+   return job
+
+
+class YTMuxPool:
+   """Pool of worker processes for running YTMuxJobs.
+   
+   Demuxing and MKV writing are pure-python and CPU-bound, so threads can't spread them over more than one core. This
+   class dispatches entire mux jobs to a concurrent.futures.ProcessPoolExecutor instead; jobs travel there by pickling,
+   and come back the same way once they're done (minus any demuxed data).
+   A worker process dying breaks the entire executor, failing every job in it; in that case, we set up a new one and
+   resubmit those jobs. Jobs that were still queued are resubmitted up to breaks_max times. We can't tell which of the
+   jobs that were running killed their process, so each of those is retried once in an executor of its own, where
+   another breakage can only be its own fault; we give up on it then. Workers running out of memory below their limit
+   fail their job without dying, and we give up on that job right away."""
+   logger = logging.getLogger('YTMuxPool')
+   log = logger.log
+   breaks_max = 8
+   
+   def __init__(self, processes, mem_limit=None, max_jobs=None):
+      import itertools
+      import threading
+      self.processes = processes
+      self.mem_limit = mem_limit
+      self.max_jobs = max_jobs
+      self._lock = threading.Lock()
+      self._executor = None
+      self._executor_gen = 0
+      self._tokens = itertools.count()
+      # Tokens of the jobs running in the current executor, and the queue their workers report job starts on.
+      self._starts_q = None
+      self._starts = set()
+      # Tokens of the jobs that were running in each discarded executor; {gen: set(token)}
+      self._running_broken = {}
+   
+   def _make_executor(self, processes=None):
+      """Return a new (executor, job start queue) pair."""
+      import multiprocessing
+      from concurrent.futures import ProcessPoolExecutor
+      
+      def make(ctx, **kwargs):
+         # Use a fresh queue for every executor: a worker killed halfway through a put() would leave the old one
+         # locked. It also has to come from the same context as the worker processes.
+         starts_q = ctx.SimpleQueue()
+         return (ProcessPoolExecutor(max_workers=(processes or self.processes), mp_context=ctx, initializer=_mux_worker_init,
+            initargs=(self.mem_limit, logging.getLogger().getEffectiveLevel(), starts_q), **kwargs), starts_q)
+      
+      if (self.max_jobs):
+         try:
+            # Worker recycling doesn't support forking.
+            return make(multiprocessing.get_context('spawn'), max_tasks_per_child=self.max_jobs)
+         except TypeError:
+            self.log(30, 'Worker recycling is unsupported by this python version; ignoring mux job limit per process.')
+      return make(multiprocessing.get_context())
+   
+   def _get_executor(self):
+      with self._lock:
+         if (self._executor is None):
+            (self._executor, self._starts_q) = self._make_executor()
+            self._starts = set()
+            self._executor_gen += 1
+         return (self._executor, self._executor_gen, next(self._tokens))
+   
+   def _read_starts(self):
+      # Caller must hold self._lock. Reading these regularly also keeps workers from blocking on a full pipe.
+      while not (self._starts_q.empty()):
+         self._starts.add(self._starts_q.get())
+   
+   def _job_done(self, gen, token):
+      with self._lock:
+         if (self._executor_gen != gen):
+            return
+         self._read_starts()
+         self._starts.discard(token)
+   
+   def _discard_executor(self, gen):
+      """Discard broken executor of generation gen; returns the set of tokens of the jobs that were running in it."""
+      with self._lock:
+         if (gen in self._running_broken):
+            # Somebody else got here first.
+            return self._running_broken[gen]
+         executor = self._executor
+         self._executor = None
+         self._read_starts()
+         running = self._running_broken[gen] = self._starts
+      executor.shutdown(wait=False, cancel_futures=True)
+      return running
+   
+   @staticmethod
+   def _get_result(future, job):
+      try:
+         return future.result()
+      except MemoryError as exc:
+         raise YTError('Mux worker process ran out of memory while handling video {0!a}; giving up on it.'.format(job.vid)) from exc
+   
+   def _run_isolated(self, job):
+      """Run job in an executor of its own, so a breakage is known to be its fault."""
+      from concurrent.futures.process import BrokenProcessPool
+      (executor, starts_q) = self._make_executor(1)
+      try:
+         return self._get_result(executor.submit(_mux_worker_run, job, None), job)
+      except BrokenProcessPool as exc:
+         raise YTError('Mux worker process for video {0!a} died twice; giving up on it.'.format(job.vid)) from exc
+      finally:
+         executor.shutdown(wait=False, cancel_futures=True)
+   
+   def run(self, job):
+      """Run job in a worker process, blocking until it's done; returns the finished job."""
+      from concurrent.futures.process import BrokenProcessPool
+      
+      for attempt in range(self.breaks_max):
+         (executor, gen, token) = self._get_executor()
+         try:
+            return self._get_result(executor.submit(_mux_worker_run, job, token), job)
+         except BrokenProcessPool:
+            if (token in self._discard_executor(gen)):
+               self.log(30, 'A mux worker process died while video {0!a} was running in the pool; retrying it on its own.'.format(job.vid))
+               return self._run_isolated(job)
+            self.log(20, 'Mux worker pool broke down while video {0!a} was queued in it; resubmitting.'.format(job.vid))
+         finally:
+            self._job_done(gen, token)
+      raise YTError('Mux worker pool broke down {0} times while video {1!a} was in it; giving up on it.'.format(self.breaks_max, job.vid))
+   
+   def shutdown(self):
+      with self._lock:
+         executor = self._executor
+         self._executor = None
+      if not (executor is None):
+         executor.shutdown()
+
+
+class YTSpaceReserver:
+   """Disk space admission control for downloads.
+   
+   Before a download starts, its estimated space requirements are reserved against the free space (as reported by
+   statvfs) of the affected filesystems, minus a safety margin and whatever other jobs have reserved already. Jobs that
+   don't fit wait until enough space is released, for up to wait_max seconds; jobs that couldn't fit even on an empty
+   filesystem fail right away.
+   Space taken up by files being downloaded is missing from the free space already, so needs naming the file they're
+   for only count with whatever that file doesn't take up yet. Other needs count in full, until their job updates or
+   releases its reservation."""
+   logger = logging.getLogger('YTSpaceReserver')
+   log = logger.log
+   
+   # Free space can also increase without us being told; re-check this often (in seconds) while waiting.
+   poll_interval = 30
+   
+   def __init__(self, margin=0, wait_max=None):
+      import threading
+      self.margin = margin
+      self.wait_max = wait_max
+      self._cond = threading.Condition()
+      self._reservations = {}
+      self._next_id = 0
+   
+   @staticmethod
+   def _get_dev(path):
+      """Return (device, statvfs result) for the filesystem path is (or would be) on."""
+      path = os.path.abspath(path)
+      while not (os.path.exists(path)):
+         path = os.path.dirname(path)
+      return (os.stat(path).st_dev, os.statvfs(path))
+   
+   @staticmethod
+   def _get_used(fn):
+      """Return number of bytes fn takes up on disk; this is less than its size for sparse files."""
+      try:
+         return os.stat(fn).st_blocks * 512
+      except OSError:
+         return 0
+   
+   def _summarize(self, needs, outstanding=True):
+      """Return {dev: [bytes, path]} dict totalling needs per filesystem; if outstanding, leave out space their files take
+      up already."""
+      rv = {}
+      for need in needs:
+         (path, size) = need[:2]
+         if (outstanding and (len(need) > 2)):
+            size -= self._get_used(need[2])
+         if (size <= 0):
+            continue
+         (dev, st) = self._get_dev(path)
+         if (dev in rv):
+            rv[dev][0] += size
+         else:
+            rv[dev] = [size, path]
+      return rv
+   
+   def reserve(self, needs, desc=''):
+      """Block until the specified amount of space is available, and reserve it.
+      
+      needs is a sequence of (path, bytes) tuples, or (path, bytes, filename) tuples for data to be written to filename;
+      returns an id to pass to update() and release(). Raises YTError if the space doesn't become available within
+      wait_max seconds."""
+      import itertools
+      needs = list(needs)
+      for (dev, (size, path)) in self._summarize(needs, False).items():
+         st = self._get_dev(path)[1]
+         capacity = st.f_blocks * st.f_frsize
+         if (size + self.margin > capacity):
+            raise YTError('{0} needs {1:d} bytes on the filesystem of {2!a}, which only holds {3:d} (with a margin of '
+               '{4:d}).'.format(desc, size, path, capacity, self.margin))
+      
+      with self._cond:
+         logged = False
+         ts_start = time.time()
+         while (True):
+            reserved = self._summarize(itertools.chain.from_iterable(self._reservations.values()))
+            missing = []
+            for (dev, (size, path)) in self._summarize(needs).items():
+               st = self._get_dev(path)[1]
+               avail = st.f_bavail * st.f_frsize - reserved.get(dev, (0,))[0] - self.margin
+               if (avail < size):
+                  missing.append('{0:d} bytes on the filesystem of {1!a}'.format(size - max(avail, 0), path))
+            if not (missing):
+               break
+            
+            timeout = self.poll_interval
+            if not (self.wait_max is None):
+               waited = time.time() - ts_start
+               if (waited >= self.wait_max):
+                  self.log(30, 'Giving up on {0} after waiting {1:.0f} seconds for disk space: missing {2}.'.format(desc,
+                     waited, ', '.join(missing)))
+                  raise YTError('Timed out waiting for disk space for {0}.'.format(desc))
+               timeout = min(timeout, self.wait_max - waited)
+            if not (logged):
+               self.log(20, 'Waiting for disk space before starting {0}: missing {1}.'.format(desc, ', '.join(missing)))
+               logged = True
+            self._cond.wait(timeout)
+         
+         rid = self._next_id
+         self._next_id += 1
+         self._reservations[rid] = needs
+      return rid
+   
+   def update(self, rid, needs):
+      """Replace the needs of reservation rid, without waiting; for jobs that have written part of their data."""
+      with self._cond:
+         if not (rid in self._reservations):
+            # Released already.
+            return
+         self._reservations[rid] = list(needs)
+         self._cond.notify_all()
+   
+   def release(self, rid):
+      with self._cond:
+         if (self._reservations.pop(rid, None) is None):
+            # Released already.
+            return
+         self._cond.notify_all()
+
+
+class YTBatchPlan:
+   """Dry run of a batch: resolves metadata and fmt choice for each video using only cheap probes, and reports what a
+   real run would download."""
+   logger = logging.getLogger('YTBatchPlan')
+   log = logger.log
+   
+   def __init__(self, make_ref, dtm, workers=8):
+      self.make_ref = make_ref
+      self.dtm = dtm
+      self.workers = workers
+      # vid -> (status, fmt, bytes); status is one of 'download', 'stored', 'done' or 'failed'.
+      self.results = OrderedDict()
+   
+   def _plan_video(self, vid):
+      ref = self.make_ref(vid)
+      if not (ref.find_cataloged(self.dtm) is None):
+         return ('done', None, 0)
+      
+      ref.prefetch()
+      if (self.dtm & DATATYPE_VIDEO):
+         fn_final = ref._choose_final_fn()
+         if (os.path.exists(fn_final)):
+            return ('done', ref._fmt, 0)
+         if not (ref._blob is None):
+            return ('stored', ref._fmt, 0)
+         try:
+            have = os.path.getsize(ref._choose_tmp_fn())
+         except OSError:
+            have = 0
+         return ('download', ref._fmt, max(ref._content_length - have, 0))
+      
+      if (ref.make_mkv and os.path.exists(ref._choose_final_fn())):
+         return ('done', ref._fmt, 0)
+      return ('download', ref._fmt, 0)
+   
+   def _plan_video_safe(self, vid):
+      try:
+         return self._plan_video(vid)
+      except YTError:
+         self.log(30, 'Failed to resolve video {0!a}:'.format(vid), exc_info=True)
+      except Exception:
+         self.log(40, 'Unexpected error while resolving video {0!a}:'.format(vid), exc_info=True)
+      return ('failed', None, 0)
+   
+   def run(self, vids):
+      from concurrent.futures import ThreadPoolExecutor
+      with ThreadPoolExecutor(self.workers) as executor:
+         for (vid, res) in zip(vids, executor.map(self._plan_video_safe, vids)):
+            self.results[vid] = res
+   
+   @staticmethod
+   def _fmt_size(size):
+      for unit in ('B', 'KiB', 'MiB', 'GiB'):
+         if (size < 1024):
+            break
+         size /= 1024
+      else:
+         unit = 'TiB'
+      return '{0:.2f} {1}'.format(size, unit)
+   
+   def fmt_report(self, rate=None):
+      """Return summary of results as a list of lines; rate is the expected throughput in bytes per second, if known."""
+      fmt_counts = collections.Counter()
+      fmt_bytes = collections.Counter()
+      status_counts = collections.Counter()
+      failed = []
+      for (vid, (status, fmt, size)) in self.results.items():
+         status_counts[status] += 1
+         if (status == 'download'):
+            fmt_counts[fmt] += 1
+            fmt_bytes[fmt] += size
+         elif (status == 'failed'):
+            failed.append(vid)
+      
+      total = sum(fmt_bytes.values())
+      rv = ['Plan for {0:d} videos:'.format(len(self.results))]
+      for fmt in sorted(fmt_counts, key=lambda f: (-fmt_bytes[f], f)):
+         rv.append('  fmt {0!s:>4}: {1:6d} videos, {2:>12}'.format(fmt, fmt_counts[fmt], self._fmt_size(fmt_bytes[fmt])))
+      rv.append('  to download: {0:d} videos, {1}'.format(status_counts['download'], self._fmt_size(total)))
+      rv.append('  from stored data: {0:d} videos'.format(status_counts['stored']))
+      rv.append('  skippable (done already): {0:d} videos'.format(status_counts['done']))
+      if (failed):
+         rv.append('  failed to resolve: {0:d} videos ({1})'.format(len(failed), ' '.join(failed)))
+      if (rate):
+         secs = int(total/rate)
+         rv.append('  estimated transfer time at {0}/s: {1:d}:{2:02d}:{3:02d}'.format(self._fmt_size(rate), secs//3600,
+            secs//60 % 60, secs % 60))
+      else:
+         rv.append('  (use --plan-rate to get a transfer time estimate)')
+      return rv
+
+
+class _PipelineEOF:
+   pass
+
+PIPELINE_EOF = _PipelineEOF()
+
+class YTPipelineStage:
+   """One stage of a YTPipeline: a set of worker threads, taking jobs from a bounded input queue.
+   
+   The stage function is called as func(vid, job) for each job; if it returns anything other than None, the return
+   value is passed on to the next stage. A full input queue on the next stage blocks the worker, so slow stages
+   apply backpressure to the ones feeding them."""
+   logger = logging.getLogger('YTPipelineStage')
+   log = logger.log
+   
+   def __init__(self, pipeline, name, func, workers, queue_len):
+      import queue
+      import threading
+      
+      if (workers < 1):
+         raise ValueError('Invalid worker count {0!a} for stage {1!a}.'.format(workers, name))
+      if (queue_len < 1):
+         raise ValueError('Invalid queue length {0!a} for stage {1!a}.'.format(queue_len, name))
+      
+      self.pipeline = pipeline
+      self.name = name
+      self.func = func
+      self.workers = workers
+      self.queue_len = queue_len
+      self.queue = queue.Queue(queue_len)
+      self.next = None
+      
+      self._lock = threading.Lock()
+      self._threads = []
+      self._exited = 0
+      # occupancy statistics
+      self.busy = 0
+      self.time_busy = 0.0
+      self.time_blocked = 0.0
+      self.jobs_done = 0
+      self.jobs_failed = 0
+      self._qlen_sum = 0
+      self._busy_sum = 0
+      self._samples = 0
+   
+   def start(self):
+      import threading
+      for i in range(self.workers):
+         t = threading.Thread(target=self._run, name='{0}-{1:d}'.format(self.name, i))
+         t.daemon = True
+         self._threads.append(t)
+         t.start()
+   
+   def put(self, vid, job):
+      self.queue.put((vid, job))
+   
+   def _pass_on(self, vid, job):
+      import time
+      ts = time.time()
+      self.next.put(vid, job)
+      with self._lock:
+         self.time_blocked += time.time() - ts
+   
+   def _run(self):
+      import time
+      while (True):
+         item = self.queue.get()
+         if (item is PIPELINE_EOF):
+            break
+         
+         (vid, job) = item
+         ts = time.time()
+         with self._lock:
+            self.busy += 1
+         
+         exc_unexpected = None
+         try:
+            rv = self.func(vid, job)
+         except YTError:
+            self.log(30, 'Failed to retrieve video {0!a}:'.format(vid), exc_info=True)
+            rv = None
+            failed = True
+         except Exception as exc:
+            # Most likely a bug; the pipeline re-raises these once it's done.
+            self.log(40, 'Unexpected error while processing video {0!a} in stage {1!a}:'.format(vid, self.name),
+               exc_info=True)
+            rv = None
+            failed = True
+            exc_unexpected = exc
+         else:
+            failed = False
+         
+         with self._lock:
+            self.busy -= 1
+            self.time_busy += time.time() - ts
+            if (failed):
+               self.jobs_failed += 1
+            else:
+               self.jobs_done += 1
+         
+         if (failed):
+            if (hasattr(job, 'discard')):
+               job.discard()
+            elif (hasattr(job, 'close')):
+               job.close()
+            self.pipeline._job_failed(vid, job, exc_unexpected)
+         elif not (rv is None):
+            self._pass_on(vid, rv)
+      
+      with self._lock:
+         self._exited += 1
+         last = (self._exited == self.workers)
+      
+      if (last and not (self.next is None)):
+         for i in range(self.next.workers):
+            self.next.queue.put(PIPELINE_EOF)
+   
+   def sample(self):
+      """Record current occupancy for averaging, and return (busy workers, queued jobs)."""
+      qlen = self.queue.qsize()
+      with self._lock:
+         busy = self.busy
+         self._qlen_sum += qlen
+         self._busy_sum += busy
+         self._samples += 1
+      return (busy, qlen)
+   
+   def fmt_occupancy(self):
+      (busy, qlen) = self.sample()
+      return '{0}: {1:d}/{2:d} busy, {3:d}/{4:d} queued'.format(self.name, busy, self.workers, qlen, self.queue_len)
+   
+   def fmt_summary(self, time_total):
+      with self._lock:
+         if (self._samples):
+            busy_avg = self._busy_sum/self._samples
+            qlen_avg = self._qlen_sum/self._samples
+         else:
+            busy_avg = qlen_avg = 0
+         util = self.time_busy/max(time_total*self.workers, 1e-9)
+         return ('{0}: {1:d} done, {2:d} failed; utilization {3:.1%}, mean busy workers {4:.2f}/{5:d}, mean queue fill '
+            '{6:.2f}/{7:d}, {8:.1f}s blocked on next stage.').format(self.name, self.jobs_done, self.jobs_failed, util,
+            busy_avg, self.workers, qlen_avg, self.queue_len, self.time_blocked)
+
+
+class YTPipeline:
+   """Staged batch processor for videos.
+   
+   Videos pass through the prefetch, download, demux and mux stages in order; each stage runs its own set of workers, and
+   is connected to the next one by a bounded queue. This allows e.g. video N+1 to be downloaded while video N is being
+   muxed.
+   The prefetch stage resolves metadata and picks a video format; the length of the download stage queue determines how
+   many videos are resolved ahead of time, so download workers can start transferring data right away. With
+   prefetch_ahead set to 0, there's no separate prefetch stage; download workers resolve metadata themselves instead."""
+   logger = logging.getLogger('YTPipeline')
+   log = logger.log
+   
+   STAGES = ('prefetch', 'download', 'demux', 'mux')
+   WORKERS_DEFAULT = {
+      'prefetch': 2
+   }
+   
+   def __init__(self, make_ref, dtm, workers, queue_len=2, report_interval=60, mux_pool=None, prefetch_ahead=None,
+         url_refresh_margin=600, catalog=None, space=None):
+      import threading
+      self.make_ref = make_ref
+      self.catalog = catalog
+      self.space = space
+      self.dtm = dtm
+      self.mux_pool = mux_pool
+      self.report_interval = report_interval
+      self.url_refresh_margin = url_refresh_margin
+      self.vids_failed = []
+      # (vid, exception) pairs for failures caused by something other than a YTError.
+      self.errors_unexpected = []
+      self._lock = threading.Lock()
+      
+      funcs = {
+         'prefetch': self._stage_prefetch,
+         'download': self._stage_download,
+         'demux': self._stage_demux,
+         'mux': self._stage_mux
+      }
+      
+      workers_in = workers
+      workers = dict(self.WORKERS_DEFAULT)
+      workers.update(workers_in)
+      if not ((mux_pool is None) or ('mux' in workers_in)):
+         # Each mux stage worker keeps one pool process busy.
+         workers['mux'] = mux_pool.processes
+      
+      queue_lens = {}
+      stage_names = self.STAGES
+      if (prefetch_ahead == 0):
+         stage_names = self.STAGES[1:]
+         funcs['download'] = self._stage_prefetch_download
+      elif not (prefetch_ahead is None):
+         if (prefetch_ahead < 0):
+            raise ValueError('Invalid prefetch count {0!a}.'.format(prefetch_ahead))
+         queue_lens['download'] = prefetch_ahead
+      
+      self.stages = []
+      for name in stage_names:
+         stage = YTPipelineStage(self, name, funcs[name], workers.get(name, 1), queue_lens.get(name, queue_len))
+         if (self.stages):
+            self.stages[-1].next = stage
+         self.stages.append(stage)
+   
+   def _stage_prefetch(self, vid, job):
+      self.log(20, 'Resolving metadata for video with id {0!a}.'.format(vid))
+      ref = self.make_ref(vid)
+      if not (ref.find_cataloged(self.dtm) is None):
+         return None
+      ref.prefetch()
+      return ref
+   
+   def _stage_prefetch_download(self, vid, job):
+      ref = self._stage_prefetch(vid, job)
+      if (ref is None):
+         return None
+      return self._stage_download(vid, ref)
+   
+   def _stage_download(self, vid, ref):
+      ref.refresh_urls_if_stale(self.url_refresh_margin)
+      rid = self._reserve_space(vid, ref)
+      
+      def fmt_changed():
+         # Our reservation was made for a different fmt.
+         nonlocal rid
+         self._release_space(rid)
+         rid = None
+         rid = self._reserve_space(vid, ref)
+      
+      self.log(20, 'Fetching data for video with id {0!a}.'.format(vid))
+      ref.fmt_change_cb = fmt_changed
+      try:
+         job = ref.fetch_data_raw(self.dtm)
+      except BaseException:
+         self._release_space(rid)
+         raise
+      finally:
+         ref.fmt_change_cb = None
+      
+      if (job is None):
+         self._release_space(rid)
+      else:
+         # The raw data is on disk now; what's left is held until the MKV file is done.
+         if not (rid is None):
+            self.space.update(rid, ref.get_space_needs(self.dtm, raw_done=True))
+         job.space_reservation = rid
+      return job
+   
+   def _stage_demux(self, vid, job):
+      if (self.mux_pool is None):
+         job.demux()
+      # Otherwise, the pool worker process will take care of demuxing as part of the job.
+      return job
+   
+   def _stage_mux(self, vid, job):
+      if (self.mux_pool is None):
+         job.mux()
+      else:
+         job = self.mux_pool.run(job)
+      self._release_space(job.space_reservation)
+      if not (self.catalog is None):
+         self.catalog.record_mux_job(job)
+   
+   def _reserve_space(self, vid, ref):
+      if (self.space is None):
+         return None
+      return self.space.reserve(ref.get_space_needs(self.dtm), 'video {0!a}'.format(vid))
+   
+   def _release_space(self, rid):
+      if not (rid is None):
+         self.space.release(rid)
+   
+   def _job_failed(self, vid, job, exc=None):
+      self._release_space(getattr(job, 'space_reservation', None))
+      with self._lock:
+         self.vids_failed.append(vid)
+         if not (exc is None):
+            self.errors_unexpected.append((vid, exc))
+   
+   def fmt_occupancy(self):
+      return '; '.join(stage.fmt_occupancy() for stage in self.stages)
+   
+   def run(self, vids):
+      """Process all specified videos, and return list of the ones that failed.
+      
+      Failures other than YTErrors don't stop processing of other videos, but the first such exception is re-raised once
+      all of them have been processed."""
+      import queue
+      import time
+      ts_start = time.time()
+      for stage in self.stages:
+         stage.start()
+      
+      # We wake up at least once per second while waiting on the pipeline, to sample stage occupancy.
+      self._ts_report = ts_start
+      stage0 = self.stages[0]
+      for vid in vids:
+         while (True):
+            try:
+               stage0.queue.put((vid, None), timeout=1)
+            except queue.Full:
+               self._tick()
+            else:
+               break
+      
+      for i in range(stage0.workers):
+         stage0.queue.put(PIPELINE_EOF)
+      
+      for stage in self.stages:
+         for t in stage._threads:
+            while (t.is_alive()):
+               t.join(1)
+               self._tick()
+      
+      time_total = time.time() - ts_start
+      for stage in self.stages:
+         self.log(20, 'Pipeline stage {0}'.format(stage.fmt_summary(time_total)))
+      
+      if (self.errors_unexpected):
+         self.log(40, 'Unexpected errors for {0:d} video(s): {1}; failed videos: {2}.'.format(
+            len(self.errors_unexpected), [vid for (vid, exc) in self.errors_unexpected], self.vids_failed))
+         raise self.errors_unexpected[0][1]
+      return self.vids_failed
+   
+   def _tick(self):
+      import time
+      now = time.time()
+      if (self.report_interval and (now - self._ts_report >= self.report_interval)):
+         self.log(20, 'Pipeline occupancy: {0}'.format(self.fmt_occupancy()))
+         self._ts_report = now
+      else:
+         for stage in self.stages:
+            stage.sample()
+
+
 # ---------------------------------------------------------------- Cmdline / config interpretation code
 def spec2vidset(s, fallback=True):
    import logging
@@ -1377,6 +3771,32 @@ def get_embedded_yturls(url):
    return set(urls)
 
 
+def parse_time_range(s):
+   """Parse time range string of the form 'START-END' into a (t_start, t_end) tuple of seconds.
+   
+   Times may be given as plain seconds or as [[H:]M:]S; an empty END yields None, for a range extending to the end of
+   the video."""
+   def parse_time(ts):
+      rv = 0
+      for frag in ts.split(':'):
+         rv = rv*60 + float(frag)
+      return rv
+   
+   try:
+      (t_start, t_end) = s.split('-')
+      t_start = parse_time(t_start)
+      if (t_end.strip()):
+         t_end = parse_time(t_end)
+      else:
+         t_end = None
+   except ValueError as exc:
+      raise ValueError('Invalid time range {0!a}.'.format(s)) from exc
+   
+   if ((t_start < 0) or not ((t_end is None) or (t_end > t_start))):
+      raise ValueError('Invalid time range {0!a}.'.format(s))
+   return (t_start, t_end)
+
+
 class Config:
    # internal stuff
    logger = logging.getLogger('config')
@@ -1401,6 +3821,34 @@ class Config:
    dl_path_final = '.'
    try_html5 = False
    drop_tt = ''
+   pipeline_workers = {}
+   pipeline_queue_len = 2
+   pipeline_report_interval = 60
+   mux_processes = 0
+   prefetch_ahead = 2
+   prefetch_url_margin = 600
+   mux_process_mem_limit = None
+   mux_process_max_jobs = None
+   disk_space_margin = 256*1024**2
+   disk_space_wait_max = 6*3600
+   max_time_per_video = None
+   batch_time_limit = None
+   rate_probe_time = 10
+   fmt_stats_fn = None
+   probe_concurrency = 1
+   host_request_limit = None
+   plan = False
+   plan_rate = None
+   plan_workers = 8
+   catalog_fn = None
+   catalog_rebuild = None
+   blob_store_path = None
+   blob_store_verify = True
+   output_layout = 'flat'
+   output_layout_shard_len = 2
+   migrate_layout = None
+   t_range = None
+   stripe_gateways = None
    
    def __init__(self):
       self._urllib_handler_lists = {}
@@ -1418,6 +3866,7 @@ class Config:
       self.users = []
       self.playlist = None
       self.user = None
+      self.vid_infos = {}
 
    def url_mapper_reg(self, name):
       def r(val):
@@ -1443,6 +3892,17 @@ class Config:
          return ''.join((baseurl, '/index.php?q=', encodebytes(url.encode('utf-8','surrogateescape')).replace(b'\n',b'').decode('ascii'), '&hl=e8'))
       return url_mangle
 
+   def make_urlmangler_httpcache(self, name, baseurl):
+      @self.url_mapper_reg(name)
+      def url_mangle(url):
+         from urllib.parse import quote
+         return ''.join((baseurl, '/get?url=', quote(url, safe='')))
+      return url_mangle
+
+   def make_uhl_httpcache(self, name, proxyurl):
+      from urllib.request import ProxyHandler
+      return self.urllib_handler_list_reg(name)([ProxyHandler({'http': proxyurl})])
+
    def _read_config_file(self):
       from os.path import expanduser, expandvars
       if (self.config_fn is None):
@@ -1494,6 +3954,7 @@ class Config:
       oa('--user', help='DEPRECATED: Parse (additional) video ids from specified (space-separated) user video lists')
       oa('--list-url-manglers', dest='list_url_manglers', action='store_true', help='Print lists of known URL manglers and exit')
       oa('--url-mangler', '-u', dest='url_mangler', metavar='UMNAME', help='Fetch metadata pages through specified HTTP gateway')
+      oa('--stripe', dest='stripe_gateways', metavar='UMNAME,...', help="Stripe video downloads across the specified url manglers ('direct' for no mangling).")
       oa('--urllib-handler-list', '-H', dest='urllib_handler_list', metavar='UHLNAME', help='Use specified urllib handler list for HTTP fetches.')
       oa('--mkv', '-m', dest='make_mkv', action='store_true', help='Mux downloaded data (AV+Subs) into MKV file.')
       oa('--nomkv', dest='make_mkv', action='store_false', help="Don't mux downloaded data (AV+Subs) into MKV file.")
@@ -1501,6 +3962,23 @@ class Config:
       oa('--nohtml5', dest='try_html5', action='store_false', help="Opt into html5 experiment for watch page retrieval (this is required for webm downloads, but will disable parsing of flv urls from watch pages.)")
       oa('-k', '--drop-track-types', dest='drop_tt', action='store', metavar='TTSPEC', help="Track types to drop ('v': video; 'a': audio).")
       oa('-q', '--quiet', dest='loglevel', action='store_const', const=30, help='Limit output to errors.')
+      oa('--prefetch', dest='prefetch_ahead', type=int, metavar='K', help='Resolve metadata for up to K videos ahead of the download stage (0: resolve it right before downloading).')
+      oa('--mux-processes', dest='mux_processes', type=int, metavar='N', help='Mux MKV files in N worker processes (0: mux in-process).')
+      oa('--catalog', dest='catalog_fn', metavar='FILENAME', help='Keep track of finished downloads in specified SQLite catalog file.')
+      oa('--catalog-rebuild', dest='catalog_rebuild', metavar='DIR', help='Rebuild catalog entries from files found below DIR and exit.')
+      oa('--blob-store', dest='blob_store_path', metavar='DIR', help='Keep raw AV downloads in a deduplicating store in DIR, and build output files from there.')
+      oa('--layout', dest='output_layout', metavar='LAYOUT', help="Output directory layout ({0}).".format(', '.join(YTOutputLayout.LAYOUTS)))
+      oa('--migrate-layout', dest='migrate_layout', metavar='DIR', help='Move existing output files below DIR into the configured layout and exit.')
+      oa('--disk-space-margin', dest='disk_space_margin', type=int, metavar='BYTES', help='Keep this much disk space free on download filesystems; -1 disables disk space checks.')
+      oa('--disk-space-wait-max', dest='disk_space_wait_max', type=float, metavar='SECONDS', help='Give up on videos that have waited this long for disk space.')
+      oa('--max-time', dest='max_time_per_video', type=float, metavar='SECONDS', help='Fall back to later fmts in the preference list for videos that would take longer than this to download.')
+      oa('--time-limit', dest='batch_time_limit', type=float, metavar='SECONDS', help='Fall back to later fmts in the preference list for videos that would not finish downloading within this time from now.')
+      oa('--probe-concurrency', dest='probe_concurrency', type=int, metavar='N', help='Probe up to N video fmts per video in parallel.')
+      oa('--host-limit', dest='host_request_limit', type=int, metavar='N', help='Send at most N concurrent HTTP requests to any single host.')
+      oa('--plan', dest='plan', action='store_true', help='Resolve metadata and fmt choices for all videos, print a summary of what would be downloaded, and exit.')
+      oa('--plan-rate', dest='plan_rate', metavar='RATE', help="Expected throughput for --plan time estimates, in bytes per second (with optional 'k', 'M' or 'G' suffix).")
+      oa('--range', dest='t_range', metavar='START-END', help="Only download and mux AV data for the specified time range, e.g. '1:30-2:15' (requires --mkv; END may be omitted).")
+      oa('-w', '--workers', dest='pipeline_workers', metavar='STAGE=N,...', help="Worker counts for pipeline stages ('prefetch', 'download', 'demux', 'mux').")
       
       rv = op.parse_args()
       op.destroy()
@@ -1520,6 +3998,26 @@ class Config:
             list(self._url_manglers.keys()))) from exc
       return rv
    
+   def _get_gateways(self):
+      names = self.stripe_gateways
+      if (names is None):
+         return None
+      if (isinstance(names, str)):
+         names = [name.strip() for name in names.split(',')]
+      
+      rv = []
+      for name in names:
+         if (name == 'direct'):
+            rv.append(YTGateway(name, lambda url: url))
+            continue
+         try:
+            um = self._url_manglers[name]
+         except KeyError as exc:
+            raise Exception('Unknown url mangler {0!a}; available ums are {1}.'.format(name,
+               list(self._url_manglers.keys()))) from exc
+         rv.append(YTGateway(name, um))
+      return rv
+   
    def _get_uhl(self):
       if (self.urllib_handler_list is None):
          return ()
@@ -1534,13 +4032,24 @@ class Config:
    def _get_vids(self):
       vids_set = set()
       rv = []
+      vid_infos = self.vid_infos
    
-      def update_vids(s):
-         for vid in s:
-            if (vid in vids_set):
+      def update_vis(vis):
+         for vi in vis:
+            if (vi.vid in vids_set):
+               # Keep the first source, but fill in whatever info we didn't have so far.
+               vi_old = vid_infos[vi.vid]
+               if (vi_old.upload_ts is None):
+                  vi_old.upload_ts = vi.upload_ts
+               if (vi_old.source is None):
+                  vi_old.source = vi.source
                continue
-            vids_set.add(vid)
-            rv.append(vid)
+            vids_set.add(vi.vid)
+            vid_infos[vi.vid] = vi
+            rv.append(vi.vid)
+      
+      def update_vids(s, source=None):
+         update_vis(YTVideoInfo(vid, None, source) for vid in s)
 
       arg_handlers = {}
       def reg_ah(type_str):
@@ -1577,7 +4086,7 @@ class Config:
       for playlist in self.playlists:
          plr = YTPlayListRef(playlist)
          plr.fetch_pl()
-         update_vids(plr.vids)
+         update_vids(plr.vids, ('playlist', playlist))
 
       if not (self.user is None):
          self.log(30, '--user is deprecated; use user:<id> args instead.')
@@ -1586,7 +4095,7 @@ class Config:
       for user in self.users:
          ur = YTUserRef(user)
          ur.fetch_vids()
-         update_vids(ur.get_vids())
+         update_vis(ur.vis)
 
       return rv
    
@@ -1603,6 +4112,42 @@ class Config:
       
       return self._default_fpl
    
+   def _get_pipeline_workers(self):
+      spec = self.pipeline_workers
+      if (isinstance(spec, str)):
+         rv = {}
+         for frag in spec.split(','):
+            try:
+               (name, count) = frag.split('=', 1)
+               rv[name.strip()] = int(count)
+            except ValueError as exc:
+               raise ValueError('Invalid worker count spec {0!a}.'.format(frag)) from exc
+      else:
+         rv = dict(spec)
+      
+      for name in rv:
+         if not (name in YTPipeline.STAGES):
+            raise ValueError('Unknown pipeline stage {0!a}; available stages are {1}.'.format(name, YTPipeline.STAGES))
+      return rv
+   
+   def _get_plan_rate(self):
+      rate = self.plan_rate
+      if ((rate is None) or not isinstance(rate, str)):
+         return rate
+      mult = 1
+      if (rate[-1:] in ('k', 'M', 'G')):
+         mult = 1024**('kMG'.index(rate[-1]) + 1)
+         rate = rate[:-1]
+      try:
+         return float(rate) * mult
+      except ValueError as exc:
+         raise ValueError('Invalid rate {0!a}.'.format(self.plan_rate)) from exc
+   
+   def _get_t_range(self):
+      if ((self.t_range is None) or not isinstance(self.t_range, str)):
+         return self.t_range
+      return parse_time_range(self.t_range)
+   
    def _get_dtypemask(self):
       rv = 0
       for c in self.dtype:
@@ -1618,7 +4163,7 @@ def main():
    logger = logging.getLogger()
    log = logger.log
    
-   logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+   logging.basicConfig(format='%(asctime)s %(levelname)s [%(threadName)s] %(message)s',
       stream=sys.stderr, level=logging.DEBUG)
    
    conf = Config()
@@ -1630,35 +4175,119 @@ def main():
    
    log(20, 'Settings determined.')
    
+   if (conf.catalog_fn is None):
+      catalog = None
+      if not (conf.catalog_rebuild is None):
+         raise ValueError('--catalog-rebuild requires a catalog file to be set.')
+   else:
+      catalog = YTCatalog(os.path.expanduser(conf.catalog_fn))
+      if not (conf.catalog_rebuild is None):
+         catalog.rebuild(conf.catalog_rebuild)
+         catalog.close()
+         return
+   
    for c in conf.dtype:
       if not (c in conf._dt_map):
          raise ValueError('Unknown data type {0!a}.'.format(c))
    
    um = conf._get_um()
    uhl = conf._get_uhl()
+   gateways = conf._get_gateways()
    vids = conf._get_vids()
    
    log(20, 'Final vid set: {0}'.format(vids))
-   vids_failed = []
    
    fpl = conf._get_fpl()
+   layout = YTOutputLayout(conf.output_layout, conf.vid_infos, conf.output_layout_shard_len)
+   if (conf.blob_store_path is None):
+      blobs = None
+   else:
+      blobs = YTBlobStore(os.path.expanduser(conf.blob_store_path), conf.blob_store_verify)
+   if not (conf.migrate_layout is None):
+      layout.migrate(conf.migrate_layout, catalog)
+      if not (catalog is None):
+         catalog.close()
+      return
 
    dtypemask = conf._get_dtypemask()
+   
+   if ((conf.max_time_per_video is None) and (conf.batch_time_limit is None)):
+      throughput = None
+      deadline = None
+   else:
+      throughput = YTThroughputEstimator()
+      if (conf.batch_time_limit is None):
+         deadline = None
+      else:
+         deadline = time.time() + conf.batch_time_limit
 
-   for vid in vids:
-      log(20, 'Fetching data for video with id {0!a}.'.format(vid))
-      ref = YTVideoRef(vid, fpl, conf.dl_path_temp, conf.dl_path_final, conf.make_mkv, conf.try_html5, conf.drop_tt, uhl)
-      
+   if (conf.fmt_stats_fn is None):
+      fmt_stats = None
+   else:
+      fmt_stats = YTFormatStats(os.path.expanduser(conf.fmt_stats_fn))
+   
+   if (conf.host_request_limit is None):
+      host_limiter = None
+   else:
+      host_limiter = YTHostLimiter(conf.host_request_limit)
+   
+   t_range = conf._get_t_range()
+   if not ((t_range is None) or conf.make_mkv):
+      raise ValueError('--range requires MKV output.')
+   
+   def make_ref(vid):
+      ref = YTVideoRef(vid, fpl, conf.dl_path_temp, layout.get_dir(conf.dl_path_final, vid), conf.make_mkv, conf.try_html5,
+         conf.drop_tt, uhl, catalog, blobs, t_range)
       if not (um is None):
          ref.mangle_yt_url = um
          ref.force_fmt_url_map_use = True
-      
+      if not (throughput is None):
+         ref.throughput = throughput
+         ref.max_time = conf.max_time_per_video
+         ref.deadline = deadline
+         ref.rate_probe_time = conf.rate_probe_time
+      ref.fmt_stats = fmt_stats
+      ref.fmt_stats_keys = YTFormatStats.get_keys(conf.vid_infos.get(vid))
+      ref.probe_concurrency = conf.probe_concurrency
+      ref.host_limiter = host_limiter
+      ref.gateways = gateways
+      return ref
+   
+   if (conf.plan):
+      plan_rate = conf._get_plan_rate()
+      plan = YTBatchPlan(make_ref, dtypemask, conf.plan_workers)
       try:
-         ref.fetch_data(dtypemask)
-      except YTError:
-         log(30, 'Failed to retrieve video {0!a}:'.format(vid), exc_info=True)
-         vids_failed.append(vid)
-         continue
+         plan.run(vids)
+      finally:
+         if not (catalog is None):
+            catalog.close()
+         if not (fmt_stats is None):
+            fmt_stats.save()
+      for line in plan.fmt_report(plan_rate):
+         print(line)
+      return
+   
+   if (conf.make_mkv and conf.mux_processes):
+      mux_pool = YTMuxPool(conf.mux_processes, conf.mux_process_mem_limit, conf.mux_process_max_jobs)
+   else:
+      mux_pool = None
+   
+   if ((conf.disk_space_margin is None) or (conf.disk_space_margin < 0)):
+      space = None
+   else:
+      space = YTSpaceReserver(conf.disk_space_margin, conf.disk_space_wait_max)
+   
+   pipeline = YTPipeline(make_ref, dtypemask, conf._get_pipeline_workers(), conf.pipeline_queue_len,
+      conf.pipeline_report_interval, mux_pool, conf.prefetch_ahead, conf.prefetch_url_margin, catalog, space)
+   try:
+      vids_failed = pipeline.run(vids)
+   finally:
+      if not (mux_pool is None):
+         mux_pool.shutdown()
+      if not (catalog is None):
+         catalog.close()
+      if not (fmt_stats is None):
+         fmt_stats.save()
    
    if (vids_failed):
       log(30, 'Failed to retrieve videos: {0}.'.format(vids_failed))